@@ -0,0 +1,133 @@
+# admission.py — プロセス全体で OpenAI 呼び出しの同時実行数・RPM・TPM を抑える受付係
+import os
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import observe
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))   # 同時に飛ばす呼び出し数
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))                         # 1分あたりのリクエスト上限（0で無制限）
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))                         # 1分あたりのトークン上限（0で無制限）
+LLM_MAX_WAIT_CHAT = float(os.getenv("LLM_MAX_WAIT_CHAT", "10"))    # チャットが順番待ちできる最長秒数
+LLM_MAX_WAIT_SUMMARY = float(os.getenv("LLM_MAX_WAIT_SUMMARY", "120"))
+
+PRIORITY = {"chat": 0, "summary": 1}  # 小さいほど優先
+
+
+class AdmissionTimeout(Exception):
+    """順番待ちが上限時間を超えた"""
+
+
+class _Bucket:
+    """1分あたり rate のトークンバケツ（rate<=0 なら無制限）"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.level = rate
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.rate, self.level + (now - self.stamp) * self.rate / 60.0)
+        self.stamp = now
+
+    def wait_for(self, amount, now):
+        """amount を取り出せるまでの秒数（0なら今すぐ可）"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.rate)  # 上限より大きい1件は満タンまで待てば通す
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.rate
+
+    def take(self, amount):
+        if self.rate > 0:
+            self.level -= min(amount, self.rate)
+
+
+class AdmissionController:
+    """
+    - 同時実行数・RPM・TPM のいずれかが足りなければ順番待ち
+    - 待ち行列は（優先度, 到着順）。チャットは要約より先に通し、同じ優先度なら先着順
+    - 先頭の人しか通さない（後から来た小さな要求に追い越されて飢餓にならないように）
+    - 待ち時間は kind ごとに記録（llm.admission.wait.<kind>）
+    """
+
+    def __init__(self, *, concurrency=LLM_MAX_CONCURRENCY, rpm=LLM_RPM, tpm=LLM_TPM):
+        self.concurrency = concurrency
+        self._active = 0
+        self._rpm = _Bucket(rpm)
+        self._tpm = _Bucket(tpm)
+        self._cond = threading.Condition()
+        self._waiters = []             # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._counts = {"admitted": 0, "timeouts": 0}
+
+    def _ready(self, tokens, now):
+        """今通せるなら 0、だめなら次に見直すまでの秒数"""
+        if self._active >= self.concurrency:
+            return None  # 誰かが終わるまで（notify で起こされる）
+        return max(self._rpm.wait_for(1, now), self._tpm.wait_for(tokens, now))
+
+    def acquire(self, kind="chat", tokens=0, max_wait=None):
+        prio = PRIORITY.get(kind, 1)
+        if max_wait is None:
+            max_wait = LLM_MAX_WAIT_CHAT if prio == 0 else LLM_MAX_WAIT_SUMMARY
+        me = (prio, next(self._seq))
+        start = time.monotonic()
+        deadline = start + max_wait
+        with self._cond:
+            heapq.heappush(self._waiters, me)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._ready(tokens, now) if self._waiters[0] == me else None
+                    if wait == 0:
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._counts["timeouts"] += 1
+                        raise AdmissionTimeout("ただいま混み合っています。少し時間をおいてもう一度お試しください。")
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+                heapq.heappop(self._waiters)
+                self._active += 1
+                self._rpm.take(1)
+                self._tpm.take(tokens)
+                self._counts["admitted"] += 1
+            except BaseException:
+                if me in self._waiters:
+                    self._waiters.remove(me)
+                    heapq.heapify(self._waiters)
+                raise
+            finally:
+                self._cond.notify_all()  # 先頭が変わったかもしれない
+        waited = time.monotonic() - start
+        observe(f"llm.admission.wait.{kind}", waited)
+        return waited
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, kind="chat", tokens=0, max_wait=None):
+        self.acquire(kind, tokens, max_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._counts)
+            s["active"] = self._active
+            s["waiting"] = len(self._waiters)
+            s["waiting_chat"] = sum(1 for p, _ in self._waiters if p == 0)
+        return s
+
+
+admission = AdmissionController()
@@ -1,19 +1,28 @@
 # app.py — Streamlit × static 画像完全対応版（OpenAIなしでも動く）
 import os
-import base64
 import streamlit as st
 import streamlit.components.v1 as components
-from pathlib import Path
 import time
-from summary_mailer import ensure_registration, render_booking_cta_persistent
-
-
-# --- OpenAIをオプション扱い ---
+from summary_mailer import ensure_registration, render_booking_cta_persistent, summarize_and_store_async
+import assets
+import stylesheet
+import llm_gateway
+import usage_meter
+from metrics import span, start_exporter
+from context_window import build_context
+from prompt_assets import get_prompt_assets, prefix_for
+from response_cache import get_response_cache, cacheable_prompt, normalize_prompt
+from chat_stream import user_bubble_html, iter_demo_chunks, iter_llm_chunks, render_stream
+from conversation_state import get_conversation, save_session
+from conversation_log import log_message
+from idle_reaper import start_idle_reaper
+from chat_render import render_frozen, render_history, chat_fragment, rerun_chat
+
+
+# --- dotenv はオプション扱い（OpenAI は llm_gateway 側で“あれば使う”） ---
 try:
     from dotenv import load_dotenv
-    from openai import OpenAI
 except ImportError:
-    OpenAI = None
     load_dotenv = lambda: None
 
 
@@ -31,9 +40,11 @@ load_dotenv()
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 API_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "5"))  # 何発話ごとに要約を保存するか（0で無効）
 
-# APIキーがなければ None にして「ダミーモード」扱い
-client = OpenAI(api_key=API_KEY) if (API_KEY and OpenAI) else None
+response_cache = get_response_cache()  # プロセス共有（初回の定番相談だけ）
+start_exporter()  # METRICS_PORT / METRICS_LOG_INTERVAL が設定されていれば計測値を外に出す
+start_idle_reaper()  # 放置セッションの要約→保存を裏で（IDLE_TIMEOUT=0 で無効）
 
 st.set_page_config(
     page_title="占い×AI 女神メッセージBot by もりえみ",
@@ -47,84 +58,14 @@ if params is None:
 
 
 
-ensure_registration(st)  # ← 未登録ならフォームを出して停止
-
-
-
-# ===== 外部スタイル & few-shot ローダ（追加） =====
-
-APP_DIR = Path(__file__).parent
-
-
-def _pick_first_exist(cands):
-    for p in cands:
-        p = APP_DIR / p
-        if p.exists():
-            return p
-    return None
-
-
-def load_style():
-    # ファイル名ゆらぎ対応（半角/全角/先頭アンダーバー）
-    path = _pick_first_exist(["style_mother.txt", "_style_mother.txt", "＿style_mother.txt"])
-    if not path:
-        return ""  # 無くても動く
-    return path.read_text(encoding="utf-8").strip()
-
+with span("app.registration"):
+    ensure_registration(st)  # ← 未登録ならフォームを出して停止
 
-def load_fewshot():
-    import json
-    shots = []
-    path = _pick_first_exist(["examples_mother.jsonl", "example_mother.jsonl"])
-    if not path:
-        return shots
 
-    buf = path.read_text(encoding="utf-8").strip()
-    # 誤って配列JSONで保存しても読めるように
-    if buf.startswith("["):
-        try:
-            arr = json.loads(buf)
-            for obj in arr:
-                role = obj.get("role");
-                content = (obj.get("content") or "").strip()
-                if role in ("user", "assistant") and content:
-                    shots.append({"role": role, "content": content})
-        except Exception as e:
-            st.warning(f"{path.name} の解析に失敗: {e}")
-        return shots
-
-    # 正式: JSONL（1行=1JSON）
-    for lineno, line in enumerate(buf.splitlines(), 1):
-        s = line.strip()
-        if not s:
-            continue
-        try:
-            obj = json.loads(s)
-            role = obj.get("role");
-            content = (obj.get("content") or "").strip()
-            if role in ("user", "assistant") and content:
-                shots.append({"role": role, "content": content})
-            else:
-                st.warning(f"{path.name}:{lineno} 不正（role/content）→スキップ")
-        except Exception as e:
-            st.error(f"{path.name}:{lineno} JSONエラー: {e}")
-    return shots
-
-
-# ===== ファイル探索 & base64 =====
-def find_asset(candidates):
-    for p in candidates:
-        if os.path.exists(p):
-            return p
-    return None
-
-
-def b64(path):
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode()
 
+# ===== 画像アセット（解決・縮小・エンコードはプロセス内で一度だけ） =====
 # タイトル画像優先順
-TITLE_IMG = find_asset([
+TITLE_IMG = assets.find_asset([
     os.path.join("static", "title3.png"),
     os.path.join("static", "title2.png"),
     os.path.join("static", "title1.png"),
@@ -132,175 +73,22 @@ TITLE_IMG = find_asset([
 ])
 
 # 背景画像
-BG_IMG = find_asset([os.path.join("static", "bg.png")])
+BG_IMG = assets.find_asset([os.path.join("static", "bg.png")])
 
 
-# ===== 背景CSS =====
-def apply_background():
-    bg_css = ""
-    if BG_IMG:
-        bg_css = f"background-image: url('data:image/png;base64,{b64(BG_IMG)}');"
-    st.markdown(
-        f"""
-        <style>
-        [data-testid="stAppViewContainer"] {{
-            {bg_css}
-            background-size: cover;
-            background-position: center top;
-            background-attachment: fixed;
-        }}
-        [data-testid="stHeader"] {{ background: transparent; }}
-        footer {{ visibility: hidden; }}
-
-        /* 入力欄デザイン */
-        .stChatInput > div {{
-            background: rgba(255,255,255,0.85) !important;
-            border: 1px solid #e3d4ff !important;
-            border-radius: 14px !important;
-        }}
-        .stChatInput textarea {{
-            background: transparent !important;
-            color: #3b2a57 !important;
-        }}
-        .stChatInput textarea::placeholder {{
-            color: #856fa5 !important;
-        }}
-
-
-        button[kind="primary"] {{
-            background: linear-gradient(90deg, #d9c3ff, #ffe99b) !important;
-            color: #3b2a57 !important;
-            border-radius: 10px !important;
-            font-weight: 600 !important;
-        }}
-
-        /* 吹き出し */
-        .bubble-user {{
-            text-align:right;
-            background:#f2eaff;
-            border:1px solid #dcd0ff;
-            border-radius:12px;
-            padding:10px 14px;
-            margin:8px 0;
-            display:inline-block;
-            color:#45335a;
-        }}
-        .bubble-bot {{
-            text-align:left;
-            background:#fff9f3;
-            border:1px solid #f4dccf;
-            border-radius:12px;
-            padding:10px 14px;
-            margin:8px 0;
-            display:inline-block;
-        }}
-        .glass {{
-            background: rgba(255,255,255,0.65);
-            backdrop-filter: blur(8px);
-            border-radius: 20px;
-            box-shadow: 0 8px 30px rgba(160,130,255,.18);
-            padding: 14px 18px;
-        }}
-        
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
+# ===== スタイル（styles/app.css を圧縮・ハッシュ付きで配信。背景画像もここで埋め込む） =====
+def apply_styles():
+    st.markdown(stylesheet.style_tag(BG_IMG), unsafe_allow_html=True)
 
 
-apply_background()
-
-# ===== 追加のスタイル（明るい入力欄や全体トーン） =====
-st.markdown("""
-<style>
-[data-testid="stAppViewContainer"] * {
-  color: #2f2447 !important;
-}
-.stImage img {
-  border-radius: 18px !important;
-  box-shadow: 0 12px 40px rgba(120, 90, 160, 0.18) !important;
-  position: relative;
-  z-index: 3;
-}
-.bubble-bot {
-  background: rgba(255, 249, 243, 0.95) !important;
-  border: 1px solid #f0d8c9 !important;
-  color: #2f2447 !important;
-}
-.bubble-user {
-  background: rgba(242, 234, 255, 0.96) !important;
-  border: 1px solid #d6c8ff !important;
-  color: #2f2447 !important;
-}
-[data-testid="stBottomBlockContainer"] {
-  background: transparent !important;
-  padding-bottom: 12px !important;
-}
-.stChatInput > div {
-  background: rgba(255,255,255,0.95) !important;
-  border: 1px solid #e3d4ff !important;
-  border-radius: 14px !important;
-  box-shadow: 0 6px 22px rgba(110, 80, 160, 0.12) !important;
-}
-/* ===== 入力欄の文字を明るくして見えるように ===== */
-.stChatInput textarea,
-.stChatInput [contenteditable="true"],
-div[data-baseweb="textarea"] textarea {
-  color: #2f2447 !important;          /* PCの暗背景でも読める濃い紫グレー */
-  caret-color: #2f2447 !important;
-  background: rgba(255,255,255,0.85) !important;  /* 半透明の白背景を常に敷く */
-  font-size: 16px !important;
-  font-weight: 500 !important;
-  border-radius: 10px !important;
-}
-
-
-/* プレースホルダー（入力前の薄文字） */
-.stChatInput textarea::placeholder {
-  color: #e5d8ff !important;        /* 淡い紫 */
-  opacity: 0.9 !important;
-}
-
-.stChatInput, .stChatInput > div,
-.bubble-user, .bubble-bot, .glass {
-  position: relative !important;
-  z-index: 10 !important;  /* 女神(4)より上 */
-}
-
-.glass {
-  background: rgba(255,255,255,0.78) !important;
-}
-[data-testid="stAppViewContainer"] .block-container {
-  background: rgba(255, 248, 242, 0.45) !important;
-  backdrop-filter: blur(4px) !important;
-  border-radius: 28px !important;
-  padding: 34px 30px 34px 30px !important;
-  max-width: 800px !important;
-  margin-top: 36px !important;
-  box-shadow: 0 18px 50px rgba(120, 80, 60, 0.10) !important;
-}
-}
-.booking-cta {
-  display: inline-block;
-  background: rgba(255, 250, 248, 0.88);
-  color: #7a5b6f !important;
-  border: 1px solid rgba(220, 180, 190, 0.55);
-  border-radius: 999px;
-  padding: 14px 28px;
-  font-size: 22px;
-  font-weight: 600;
-  box-shadow: 0 10px 28px rgba(130, 90, 110, 0.13);
-  text-decoration: none !important;
-}
-
-</style>
-""", unsafe_allow_html=True)
+with span("app.style"):
+    apply_styles()
 
 
 
 # ===== タイトル =====
 if TITLE_IMG:
-    st.image(TITLE_IMG, use_container_width=True)
+    st.image(assets.variant(TITLE_IMG, assets.TITLE_MAX_WIDTH), use_container_width=True)
 else:
     st.markdown(
         "<h2 style='text-align:center;color:#6b4ea1;margin:10px 0 6px;'>占い×AI 女神メッセージBot by もりえみ</h2>",
@@ -310,64 +98,93 @@ st.markdown("<div style='text-align:center;color:#4b306e;'>🪶 あなたに今
             unsafe_allow_html=True)
 
 # ===== 会話管理 =====
-if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {"role": "assistant", "content": "どんなことでも相談してみて✨もりえみAIが答えるよ✨"}
-    ]
-
-# ===== チャットUI =====
-with st.container():
-
-    for m in st.session_state.messages:
-        if m["role"] == "user":
-            st.markdown(f"<div style='text-align:right;'>🧑‍💼<div class='bubble-user'>{m['content']}</div></div>",
-                        unsafe_allow_html=True)
-        else:
-            st.markdown(f"<div>🧚‍♀️<div class='bubble-bot'>{m['content']}</div></div>", unsafe_allow_html=True)
-
-    render_booking_cta_persistent(st, threshold=10, embed_iframe=False, place="main")
-
-    prompt = st.chat_input("ここに入力してください…（例：流れを整えたい）", key="main_chat_input")
-    if prompt:
-        touch()
-        st.session_state.messages.append({"role": "user", "content": prompt})
-
-        if client is None:
-            reply = "（デモ応答）運命はいつでもあなたの味方です🌙 小さな喜びを選ぶと、流れは自然と整っていきます。"
-        else:
-            try:
-                # --- ここに追加 ---
-                STYLE_FILE = "style_mother.txt"
-                if os.path.exists(STYLE_FILE):
-                    with open(STYLE_FILE, "r", encoding="utf-8") as f:
-                        style_prompt = f.read().strip()
+conv = get_conversation(st, greeting="どんなことでも相談してみて✨もりえみAIが答えるよ✨")
+
+# 確定した古い発言はブロック単位で、全体の再実行のときだけ描く（fragment の再実行では送り直さない）
+with span("app.history_frozen"):
+    render_frozen(st, conv)
+
+# ===== チャットUI（fragment：入力→返信ではこの中だけ再実行） =====
+@chat_fragment
+def chat_area():
+    with st.container():
+
+        # ここで描くのは確定ブロックより後ろの直近分だけ
+        with span("app.history"):
+            render_history(st, conv)
+
+        render_booking_cta_persistent(st, threshold=10, embed_iframe=False, place="main")
+
+        prompt = st.chat_input("ここに入力してください…（例：流れを整えたい）", key="main_chat_input")
+        if prompt:
+            touch()
+            usage_meter.set_nickname(st.session_state.get("nickname"))  # このターンの LLM 使用量の付け先
+            conv.append("user", prompt)
+            log_message(st, "user", prompt)  # 追記ログへ（書き込みは裏でまとめて）
+
+            # 送信したメッセージを先に出し、返信は届いた分から吹き出しに流す
+            st.markdown(user_bubble_html(prompt), unsafe_allow_html=True)
+            placeholder = st.empty()
+
+            cache_key, cached = None, None
+            # APIキーがなければ None で「ダミーモード」。SDK の import・クライアント作成は最初の送信時に一度だけ
+            client = llm_gateway.get_client()
+            if client is None:
+                chunks = iter_demo_chunks()
+            else:
+                # --- ペルソナ（system + few-shot）はプロセス共有キャッシュから ---
+                with span("app.prompt_assets"):
+                    prompt_assets = get_prompt_assets()
+
+                # --- 初回の短い定番相談は、全ユーザー共通の返信キャッシュを使う ---
+                first_prompt = cacheable_prompt(conv)
+                if first_prompt is not None:
+                    cache_key = response_cache.key(prompt_assets["version"], MODEL, first_prompt)
+                    cached = response_cache.get(cache_key)
+
+                if cached is not None:
+                    chunks = iter([cached])
+                elif cache_key is not None:
+                    # 挨拶（ニックネーム入り）を含めず送る → 誰に返しても良い返信になる
+                    # few-shot は相談に近いものだけ。キャッシュキーと同じ正規化後の文で選ぶ
+                    # （「運を知りたい」と「運を知りたい!?」は同じ返信を共有するので、同じ few-shot で作る）
+                    msgs = (prefix_for(normalize_prompt(first_prompt), prompt_assets)
+                            + [{"role": "user", "content": first_prompt}])
+                    chunks = iter_llm_chunks(model=MODEL, messages=msgs, temperature=0.7)
                 else:
-                    style_prompt = "あなたは優しく包み込むように話すAIです。"
-
-                # --- 既存のここを置き換える ---
-                msgs = [{"role": "system", "content": style_prompt}] + st.session_state.messages
-
-                resp = client.chat.completions.create(
-                    model=MODEL,
-                    messages=msgs,
-                    temperature=0.7,
-                )
-                reply = resp.choices[0].message.content.strip()
-            except Exception as e:
-                reply = f"⚠️ AI応答エラー：{e}"
-
-        st.session_state.messages.append({"role": "assistant", "content": reply})
-        # ✅ 要約→Supabase保存（必ずこの位置）
-        # from summary_mailer import summarize_and_store
-        #
-        # nickname = st.session_state.get("nickname") or st.session_state.get("user_id") or ""
-        # turns = sum(1 for m in st.session_state.messages if m["role"] == "user")
-        # summary = summarize_and_store(st.session_state.messages, nickname, turns)
-        #
-        # # デバッグ：保存が呼ばれたことを画面に小さく出す
-
-        st.rerun()
-    st.markdown("</div>", unsafe_allow_html=True)
+                    # --- 全履歴ではなく「直近ターン＋要約」をトークン予算内で送る ---
+                    ctx_state = st.session_state.setdefault("context_window", {})
+                    msgs, ctx_stats = build_context(
+                        prefix_for(prompt, prompt_assets), conv, ctx_state
+                    )
+                    # 今回どれだけ節約できたか（ターンごとの記録と累計）
+                    st.session_state["context_stats"] = ctx_stats
+                    ctx_state["saved_total"] = ctx_state.get("saved_total", 0) + ctx_stats["saved_tokens"]
+
+                    chunks = iter_llm_chunks(model=MODEL, messages=msgs, temperature=0.7)
+
+            # ストリーム終了（または途中エラー）で確定したテキストだけを履歴に積む
+            started = time.monotonic()
+            reply, ok = render_stream(placeholder, chunks)
+            if cache_key is not None and cached is None and ok and reply != llm_gateway.FALLBACK_REPLY:
+                response_cache.put(cache_key, reply, time.monotonic() - started)
+
+            conv.append("assistant", reply)
+            log_message(st, "assistant", reply)
+            save_session(st)  # 共有状態へ（別のレプリカにつなぎ直しても続きから）
+            # ✅ 要約→Supabase保存（必ずこの位置）。LLM要約も保存もワーカー任せでUIは待たない
+            # 前回の要約より後のターンだけを取り置くので、見回りや別のレプリカと同じターンを二度要約しない
+            turns = conv.user_turns
+            if SUMMARY_EVERY_TURNS and turns % SUMMARY_EVERY_TURNS == 0:
+                nickname = st.session_state.get("nickname") or st.session_state.get("user_id") or ""
+                summarize_and_store_async(conv, nickname, turns)
+
+            rerun_chat(st, conv)  # チャット欄だけ描き直す（CSS・背景・タイトル・確定ブロックは送り直さない）
+        st.markdown("</div>", unsafe_allow_html=True)
+
+
+chat_area()
+
 BOOKING_URL = os.getenv("BOOKING_URL")
 # 画像をbase64で埋め込む
 
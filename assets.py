@@ -0,0 +1,150 @@
+# assets.py — 背景/タイトル画像をプロセス内で一度だけ解決・変換・エンコードして使い回す
+import os
+import base64
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+from lazy import lazy_import
+
+APP_DIR = Path(__file__).parent
+STATIC_DIR = APP_DIR / "static"
+CACHE_DIR = STATIC_DIR / "_cache"          # 縮小/WebP 版の置き場（静的配信される）
+
+ASSET_CHECK_INTERVAL = float(os.getenv("ASSET_CHECK_INTERVAL", "2.0"))  # mtime 確認の最短間隔（秒）
+BG_MAX_WIDTH = int(os.getenv("BG_MAX_WIDTH", "1280"))
+TITLE_MAX_WIDTH = int(os.getenv("TITLE_MAX_WIDTH", "960"))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+
+# --- Pillow は“あれば使う”（無ければ元画像をそのまま使う）。import は最初に変換するときまで待つ ---
+Image = lazy_import("PIL.Image")
+
+_lock = threading.Lock()
+_resolved = {}   # candidates(tuple) -> (path or None, checked_at)
+_entries = {}    # (path, max_width) -> {"mtime", "checked_at", "variant", "data_uri"}
+_stats = {"original_bytes": 0, "emitted_bytes": 0}
+
+
+# ===== 解決（os.path.exists を毎回叩かない） =====
+def find_asset(candidates):
+    """候補のうち最初に存在するパス（APP_DIR 相対）。結果はプロセス内で保持し、間隔をあけて再確認する"""
+    key = tuple(candidates)
+    now = time.monotonic()
+    hit = _resolved.get(key)
+    if hit and now - hit[1] < ASSET_CHECK_INTERVAL:
+        return hit[0]
+    found = None
+    for p in candidates:
+        full = APP_DIR / p
+        if full.exists():
+            found = str(full)
+            break
+    _resolved[key] = (found, now)
+    return found
+
+
+# ===== 変換（縮小 + WebP） =====
+def _variant_path(path, mtime, max_width):
+    src = Path(path)
+    tag = hashlib.sha1(f"{src.name}:{mtime}:{max_width}:{WEBP_QUALITY}".encode()).hexdigest()[:10]
+    return CACHE_DIR / f"{src.stem}.{max_width}.{tag}.webp"
+
+
+def _build_variant(path, mtime, max_width):
+    """縮小 WebP を作って保存。Pillow が無い/失敗したら元画像を返す"""
+    out = _variant_path(path, mtime, max_width)
+    if out.exists():
+        return str(out)
+    if not Image.available():
+        return path
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with Image.open(path) as im:
+            if im.width > max_width:
+                im = im.resize((max_width, round(im.height * max_width / im.width)), Image.LANCZOS)
+            tmp = out.with_suffix(".tmp")
+            im.save(tmp, "WEBP", quality=WEBP_QUALITY, method=4)
+        os.replace(tmp, out)
+        return str(out)
+    except Exception:
+        return path
+
+
+def _entry(path, max_width):
+    """(path, max_width) のキャッシュ。mtime が変わったときだけ作り直す"""
+    key = (path, max_width)
+    now = time.monotonic()
+    ent = _entries.get(key)
+    if ent and now - ent["checked_at"] < ASSET_CHECK_INTERVAL:
+        return ent
+    with _lock:
+        ent = _entries.get(key)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            _entries.pop(key, None)
+            return None
+        if ent and ent["mtime"] == mtime:
+            ent["checked_at"] = now
+            return ent
+        ent = {
+            "mtime": mtime,
+            "checked_at": now,
+            "original_size": os.path.getsize(path),
+            "variant": _build_variant(path, mtime, max_width),
+            "data_uri": None,
+        }
+        _entries[key] = ent
+        return ent
+
+
+def variant(path, max_width):
+    """縮小/WebP 版のパス（st.image などにそのまま渡せる）"""
+    ent = _entry(path, max_width)
+    return ent["variant"] if ent else path
+
+
+def _mime(path):
+    ext = Path(path).suffix.lower()
+    return {".webp": "image/webp", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}.get(ext, "image/png")
+
+
+def static_serving_enabled():
+    try:
+        import streamlit as st
+        return bool(st.get_option("server.enableStaticServing"))
+    except Exception:
+        return False
+
+
+def css_url(path, max_width):
+    """
+    CSS の url(...) に入れる文字列。
+    - 静的配信が有効なら app/static/... の URL（ブラウザがキャッシュできる）
+    - 無効なら縮小版の data URI（一度だけエンコードして使い回す）
+    """
+    ent = _entry(path, max_width)
+    if not ent:
+        return ""
+    var = Path(ent["variant"])
+    # 元 PNG をインライン化していた場合の送信量（比較用）
+    original = len("data:image/png;base64,") + (ent["original_size"] + 2) // 3 * 4
+
+    if static_serving_enabled() and STATIC_DIR in var.parents:
+        url = "app/static/" + var.relative_to(STATIC_DIR).as_posix()
+    else:
+        if ent["data_uri"] is None:
+            ent["data_uri"] = f"data:{_mime(var)};base64," + base64.b64encode(var.read_bytes()).decode()
+        url = ent["data_uri"]
+
+    _stats["original_bytes"] = original
+    _stats["emitted_bytes"] = len(url)
+    return url
+
+
+def stats():
+    """直近の背景出力で、元のインライン PNG と比べて 1 rerun あたり何バイト減ったか"""
+    s = dict(_stats)
+    s["saved_bytes_per_rerun"] = max(0, s["original_bytes"] - s["emitted_bytes"])
+    return s
@@ -0,0 +1 @@
+# bench — ネットワーク無しで app.py を回す計測スクリプト群（python -m bench.xxx で実行）
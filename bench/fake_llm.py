@@ -0,0 +1,96 @@
+# bench/fake_llm.py — 決まった返事を決まった遅延で返す OpenAI 互換のダミー
+import os
+import random
+import tempfile
+import time
+import threading
+from types import SimpleNamespace
+
+REPLY_UNIT = "小さな喜びを選ぶと、流れは自然と整っていきます🌙"
+
+
+class FakeCompletions:
+    """
+    chat.completions.create 互換。
+    - ttft: 最初のチャンク（非ストリームなら応答全体）までの秒数
+    - token_interval: ストリーム時のチャンク間隔（秒）
+    - completion_tokens: 返事の長さ（概算トークン＝文字数）
+    - jitter: ttft を対数正規分布でばらつかせる幅（0 なら毎回同じ。0.5 で p99 が中央値の 3 倍くらい）
+    """
+
+    def __init__(self, *, ttft=0.05, token_interval=0.0, completion_tokens=120, chunk_tokens=8, jitter=0.0):
+        self.ttft = ttft
+        self.jitter = jitter
+        self.token_interval = token_interval
+        self.completion_tokens = completion_tokens
+        self.chunk_tokens = chunk_tokens
+        self.calls = 0
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def _reply(self):
+        text = REPLY_UNIT * (self.completion_tokens // len(REPLY_UNIT) + 1)
+        return text[:self.completion_tokens]
+
+    def _ttft(self):
+        if not self.jitter:
+            return self.ttft
+        return self.ttft * random.lognormvariate(0.0, self.jitter)
+
+    def _usage(self, messages):
+        prompt = sum(len(m["content"]) for m in messages)
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += prompt
+        return SimpleNamespace(prompt_tokens=prompt, completion_tokens=self.completion_tokens,
+                               total_tokens=prompt + self.completion_tokens,
+                               prompt_tokens_details=SimpleNamespace(cached_tokens=0))
+
+    def create(self, *, model=None, messages=(), stream=False, **kw):
+        usage = self._usage(messages)
+        text = self._reply()
+        ttft = self._ttft()
+        if not stream:
+            time.sleep(ttft)
+            msg = SimpleNamespace(role="assistant", content=text)
+            return SimpleNamespace(model=model, choices=[SimpleNamespace(message=msg, finish_reason="stop")],
+                                   usage=usage)
+
+        def gen():
+            time.sleep(ttft)
+            for i in range(0, len(text), self.chunk_tokens):
+                if i and self.token_interval:
+                    time.sleep(self.token_interval)
+                delta = SimpleNamespace(content=text[i:i + self.chunk_tokens])
+                yield SimpleNamespace(model=model, choices=[SimpleNamespace(delta=delta, finish_reason=None)],
+                                      usage=None)
+            # stream_options.include_usage 相当の最後のチャンク
+            yield SimpleNamespace(model=model, choices=[], usage=usage)
+        return gen()
+
+
+class FakeOpenAI:
+    """OpenAI(api_key=...) 互換。全インスタンスで同じ FakeCompletions を共有する"""
+    completions = FakeCompletions()
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=FakeOpenAI.completions)
+
+
+def install(**options):
+    """
+    openai.OpenAI をダミーに差し替え、ダミーのAPIキーを入れる（app.py / summary_mailer の import 前に呼ぶ）。
+    Supabase 等の外部接続は切っておく。返り値は共有の FakeCompletions（呼び出し回数などの確認用）。
+    """
+    import openai
+    FakeOpenAI.completions = FakeCompletions(**options)
+    openai.OpenAI = FakeOpenAI
+    os.environ["OPENAI_API_KEY"] = "sk-fake"
+    for name in ("SUPABASE_URL", "SUPABASE_ANON_KEY", "GMAIL_FROM", "RECIPIENT_EMAIL"):
+        os.environ[name] = ""  # 空文字で「未設定」扱い（.env からも上書きされない）
+    # 会話ログ・使用量・共有状態は毎回まっさらな一時ファイルに（前回の計測の会話を読み戻さない）
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("CONV_LOG_PATH", os.path.join(tmp, "conversation_log.sqlite3"))
+    os.environ.setdefault("USAGE_DB_PATH", os.path.join(tmp, "usage.sqlite3"))
+    os.environ.setdefault("SHARED_STATE_PATH", os.path.join(tmp, "shared_state.sqlite3"))
+    return FakeOpenAI.completions
@@ -0,0 +1,89 @@
+# bench/fewshot.py — few-shot 索引の作成時間と、1回の選択にかかる時間を測る
+#
+#   python -m bench.fewshot                       # 100 / 1000 / 10000 組
+#   python -m bench.fewshot --sizes 10000 --queries 500 --out bench/results/fewshot.json
+#
+# 例は合成（相談のテーマと言い回しを組み合わせる）。ファイルもネットワークも使わない。
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from fewshot_index import FewshotIndex  # noqa: E402
+
+TOPICS = ["仕事", "恋愛", "結婚", "転職", "お金", "家族", "友人関係", "健康", "引っ越し", "子育て",
+          "人間関係", "夢", "勉強", "占い", "運勢", "自信", "不安", "将来", "職場", "趣味"]
+PHRASES = ["について悩んでいます", "の流れを整えたい", "がうまくいかない", "でモヤモヤしています",
+           "の決断に迷っています", "をどう考えたらいい？", "で気持ちが沈みがち", "のタイミングを知りたい"]
+
+
+def synth_pairs(n, rng):
+    pairs = []
+    for i in range(n):
+        q = "".join(rng.choice(TOPICS) for _ in range(rng.randint(1, 3))) + rng.choice(PHRASES) + f"（{i}）"
+        a = "大丈夫、" + rng.choice(TOPICS) + "の流れはゆっくり整っていきます🌙" * rng.randint(1, 3)
+        pairs.append(({"role": "user", "content": q}, {"role": "assistant", "content": a}))
+    return pairs
+
+
+def _ms(xs, q):
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(q * len(xs)))] * 1000, 3)
+
+
+def run(sizes, queries, seed=0):
+    rng = random.Random(seed)
+    results = []
+    for n in sizes:
+        pairs = synth_pairs(n, rng)
+        t0 = time.perf_counter()
+        index = FewshotIndex(pairs)
+        build_ms = (time.perf_counter() - t0) * 1000
+
+        qs = [rng.choice(TOPICS) + rng.choice(PHRASES) for _ in range(queries)]
+        times = []
+        for q in qs:
+            t0 = time.perf_counter()
+            index.select(q)
+            times.append(time.perf_counter() - t0)
+        row = {"examples": n, "terms": len(index.vocab), "build_ms": round(build_ms, 3),
+               "select_p50_ms": _ms(times, 0.5), "select_p95_ms": _ms(times, 0.95),
+               "select_mean_ms": round(statistics.mean(times) * 1000, 3)}
+        results.append(row)
+        print(json.dumps(row, ensure_ascii=False), file=sys.stderr)
+    return {
+        "bench": "fewshot",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {"sizes": sizes, "queries": queries, "seed": seed},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="few-shot 索引の作成・選択時間を計測")
+    ap.add_argument("--sizes", default="100,1000,10000", help="例の組数（カンマ区切り）")
+    ap.add_argument("--queries", type=int, default=200, help="1サイズあたりの検索回数")
+    ap.add_argument("--out", default=None, help="結果JSONの保存先（省略時は標準出力）")
+    args = ap.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+    text = json.dumps(run(sizes, args.queries), ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
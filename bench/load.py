@@ -0,0 +1,358 @@
+# bench/load.py — 同時に何人も相談しているときの負荷試験（1プロセスに AppTest のセッションを並べる）
+#
+#   python -m bench.load                                  # 20 セッション × 5 ターン
+#   python -m bench.load --sessions 50 --rate 5 --think 2 --out bench/results/load.json
+#   python -m bench.load --baseline bench/results/load.json --tolerance 0.2   # 悪化したら終了コード 1
+#   python -m bench.load --max-p99-ms 3000 --max-rss-mb-per-session 5
+#
+# 各セッションは別々の AppTest（＝別々の session_state）で、登録→相談を --turns 回。
+# 到着はポアソン（平均 --rate 人/秒）、相談の間の考える時間は指数分布（平均 --think 秒）。
+# ダミーLLMは ttft を対数正規でばらつかせ、チャンクも間隔をあけて返す（本番の待ち方に近づける）。
+# ネットワークには出ない（OpenAI はダミー、Supabase/メールは未設定扱い）。
+# アプリの失敗（スクリプトの例外・時間切れ）と、計測側の失敗（AppTest の操作・待っても出ない部品）は分けて数える。
+import argparse
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from bench import fake_llm  # noqa: E402
+
+# --baseline と比べる項目: (キー, 大きいほど悪いか)
+COMPARED = (
+    ("turn_p50_ms", True),
+    ("turn_p95_ms", True),
+    ("turn_p99_ms", True),
+    ("rss_mb_per_session", True),
+    ("threads_per_session", True),
+    ("throughput_turns_per_s", False),
+)
+HARNESS_RETRIES = 3  # 部品が描かれていないときに再描画して待つ回数
+
+
+class HarnessError(Exception):
+    """計測側（AppTest の操作）の失敗。アプリの失敗とは別に数える"""
+
+
+def _is_timeout(e):
+    # AppTest の「script run timed out」はアプリが遅すぎた＝アプリ側の失敗
+    return "timed out" in str(e)
+
+
+def _wait_for(at, find, what):
+    """find(at) が部品を返すまで再描画して待つ（並べたセッションでは描画が途中のことがある）"""
+    for attempt in range(HARNESS_RETRIES + 1):
+        found = find(at)
+        if found:
+            return found[0]
+        if attempt < HARNESS_RETRIES:
+            time.sleep(0.1 * (attempt + 1))
+            at.run()
+    raise HarnessError(f"{what} not rendered after {HARNESS_RETRIES} reruns")
+
+
+def _rss_bytes():
+    """今の RSS（/proc が無ければ最大 RSS で代用）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    xs = sorted(values)
+    i = (len(xs) - 1) * q
+    lo, hi = int(i), min(int(i) + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (i - lo)
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+@contextmanager
+def shared_runtime():
+    """
+    AppTest は run() のたびにプロセス共有の Runtime._instance を差し替え、終わると None に戻す。
+    セッションを並べると他のセッションの実行中に消されてしまうので、計測中は最後に作られたものを使い続ける。
+    """
+    from streamlit.runtime import Runtime
+    orig = {name: Runtime.__dict__[name] for name in ("instance", "exists")}
+    last = []
+
+    def current(cls):
+        if cls._instance is not None:
+            last[:] = [cls._instance]
+        return last[0] if last else None
+
+    def instance(cls):
+        rt = current(cls)
+        if rt is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return rt
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: current(cls) is not None)
+    try:
+        yield
+    finally:
+        for name, fn in orig.items():
+            setattr(Runtime, name, fn)
+
+
+class Sampler:
+    """スレッド数と RSS を一定間隔で記録する"""
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.peak_rss = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="load-sampler", daemon=True)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, _rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Session:
+    """1人分のブラウザ。登録してから turns 回相談する"""
+
+    def __init__(self, index, *, turns, think, rng, timeout):
+        self.index = index
+        self.turns = turns
+        self.think = think
+        self.rng = rng
+        self.timeout = timeout
+        self.at = None  # 終わっても計測の最後まで持っておく（開いたままのタブ）
+        self.latencies_ms = []
+        self.errors = []          # アプリの失敗
+        self.harness_errors = []  # 計測側の失敗
+
+    def _fail(self, e):
+        if isinstance(e, HarnessError) or not _is_timeout(e):
+            self.harness_errors.append(f"{type(e).__name__}: {e}")
+        else:
+            self.errors.append(str(e))
+
+    def run(self):
+        from streamlit.testing.v1 import AppTest
+        try:
+            self.at = at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=self.timeout)
+            at.run()
+            _wait_for(at, lambda a: a.text_input, "nickname input").input(f"load{self.index}")
+            _wait_for(at, lambda a: a.button, "register button").click()
+            at.run()
+            if at.exception:
+                self.errors.append(f"registration failed: {at.exception[0].message}")
+                return
+        except Exception as e:
+            self._fail(e)
+            return
+        for turn in range(1, self.turns + 1):
+            if turn > 1 and self.think > 0:
+                time.sleep(self.rng.expovariate(1.0 / self.think))
+            try:
+                box = _wait_for(at, lambda a: a.chat_input, "chat input")
+            except Exception as e:
+                self._fail(e)
+                continue
+            t0 = time.perf_counter()
+            try:
+                # 送信（返信のストリーミング込み）→ 再描画まで。応答キャッシュに当たらないよう人ごとに文面を変える
+                box.set_value(f"相談その{turn}：{self.index}番の流れを整えたい").run()
+            except Exception as e:
+                self._fail(e)
+                continue
+            if at.exception:
+                self.errors.append(at.exception[0].message)
+                continue
+            self.latencies_ms.append((time.perf_counter() - t0) * 1000)
+
+
+def _warm_up(timeout):
+    """import やスタイルの初回ビルドを計測から外すため、1セッションだけ先に流す"""
+    s = Session(-1, turns=1, think=0, rng=random.Random(0), timeout=timeout)
+    s.run()
+    if s.errors or s.harness_errors:
+        raise RuntimeError(f"warm-up failed: {(s.errors + s.harness_errors)[0]}")
+
+
+def run(*, sessions, rate, turns, think, ttft, token_interval, jitter, completion_tokens, seed=0, timeout=120):
+    fake = fake_llm.install(ttft=ttft, token_interval=token_interval, jitter=jitter,
+                            completion_tokens=completion_tokens)
+    _warm_up(timeout)
+    # use_container_width / ScriptRunContext の警告で出力が埋まらないように（streamlit は子ロガーごとに level を持つ）
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    import conversation_state
+
+    rng = random.Random(seed)
+    calls_before = fake.calls
+    threads_before = threading.active_count()
+    rss_before = _rss_bytes()
+    workers = []
+    with shared_runtime(), Sampler() as sampler:
+        t0 = time.perf_counter()
+        for i in range(sessions):
+            if i and rate > 0:
+                time.sleep(rng.expovariate(rate))
+            s = Session(i, turns=turns, think=think, rng=random.Random(rng.random()), timeout=timeout)
+            th = threading.Thread(target=s.run, name=f"load-session-{i}", daemon=True)
+            th.start()
+            workers.append((s, th))
+        for _, th in workers:
+            th.join()
+        elapsed = time.perf_counter() - t0
+        rss_after = _rss_bytes()
+        threads_after = threading.active_count()
+        live = len(conversation_state.live_conversations())
+
+    latencies = [ms for s, _ in workers for ms in s.latencies_ms]
+    errors = [e for s, _ in workers for e in s.errors]
+    harness_errors = [e for s, _ in workers for e in s.harness_errors]
+    mb = 1024 * 1024
+    summary = {
+        "sessions": sessions,
+        "turns_ok": len(latencies),
+        "errors": len(errors),
+        "error_rate": round(len(errors) / max(1, sessions * turns), 4),
+        "harness_errors": len(harness_errors),
+        "harness_error_rate": round(len(harness_errors) / max(1, sessions * turns), 4),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_turns_per_s": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "turn_p50_ms": round(_percentile(latencies, 0.50) or 0.0, 3),
+        "turn_p95_ms": round(_percentile(latencies, 0.95) or 0.0, 3),
+        "turn_p99_ms": round(_percentile(latencies, 0.99) or 0.0, 3),
+        "turn_max_ms": round(max(latencies, default=0.0), 3),
+        "rss_before_mb": round(rss_before / mb, 2),
+        "rss_after_mb": round(rss_after / mb, 2),
+        "rss_peak_mb": round(sampler.peak_rss / mb, 2),
+        "rss_mb_per_session": round((rss_after - rss_before) / mb / max(1, sessions), 3),
+        "threads_before": threads_before,
+        "threads_peak": sampler.peak_threads,
+        "threads_after": threads_after,
+        # 全セッションが終わっても残るスレッド（セッションごとに漏れていないか）
+        "threads_per_session": round((threads_after - threads_before) / max(1, sessions), 3),
+        "live_conversations": live,
+        "llm_calls": fake.calls - calls_before,
+    }
+    return {
+        "bench": "load",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "config": {"sessions": sessions, "rate": rate, "turns": turns, "think": think, "ttft": ttft,
+                   "token_interval": token_interval, "jitter": jitter,
+                   "completion_tokens": completion_tokens, "seed": seed},
+        "summary": summary,
+        "error_samples": sorted(set(errors))[:5],
+        "harness_error_samples": sorted(set(harness_errors))[:5],
+    }
+
+
+def check(summary, *, baseline=None, tolerance=0.2, max_p99_ms=None, max_rss_mb_per_session=None,
+          max_error_rate=0.0, max_harness_error_rate=0.0):
+    """しきい値・基準の結果と比べて、悪化していた項目の説明を返す（空なら合格）"""
+    problems = []
+    if summary["error_rate"] > max_error_rate:
+        problems.append(f"error_rate {summary['error_rate']} > {max_error_rate}")
+    if summary.get("harness_error_rate", 0.0) > max_harness_error_rate:
+        problems.append(f"harness_error_rate {summary['harness_error_rate']} > {max_harness_error_rate} "
+                        f"(bench harness, not the app)")
+    if max_p99_ms is not None and summary["turn_p99_ms"] > max_p99_ms:
+        problems.append(f"turn_p99_ms {summary['turn_p99_ms']} > {max_p99_ms}")
+    if max_rss_mb_per_session is not None and summary["rss_mb_per_session"] > max_rss_mb_per_session:
+        problems.append(f"rss_mb_per_session {summary['rss_mb_per_session']} > {max_rss_mb_per_session}")
+    for key, higher_is_worse in COMPARED if baseline else ():
+        base, now = baseline.get(key), summary.get(key)
+        if base is None or now is None:
+            continue
+        # 小さすぎる値（RSS の揺れなど）の比較で誤検知しないよう、基準に少し下駄をはかせる
+        slack = abs(base) * tolerance + (0.5 if key.startswith(("rss", "threads")) else 0.0)
+        if higher_is_worse and now > base + slack:
+            problems.append(f"{key} {now} > baseline {base} (+{tolerance:.0%})")
+        if not higher_is_worse and now < base - slack:
+            problems.append(f"{key} {now} < baseline {base} (-{tolerance:.0%})")
+    return problems
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="同時セッションの負荷試験（オフライン）")
+    ap.add_argument("--sessions", type=int, default=20, help="セッション数")
+    ap.add_argument("--rate", type=float, default=4.0, help="新しいセッションの到着（人/秒、ポアソン）")
+    ap.add_argument("--turns", type=int, default=5, help="1セッションあたりの相談回数")
+    ap.add_argument("--think", type=float, default=1.0, help="相談の間に考える時間の平均（秒）")
+    ap.add_argument("--ttft", type=float, default=0.6, help="ダミーLLMの最初のチャンクまでの秒数（中央値）")
+    ap.add_argument("--token-interval", type=float, default=0.02, help="ダミーLLMのチャンク間隔（秒）")
+    ap.add_argument("--jitter", type=float, default=0.4, help="ttft のばらつき（対数正規の σ）")
+    ap.add_argument("--completion-tokens", type=int, default=120, help="ダミーLLMの返事の長さ")
+    ap.add_argument("--seed", type=int, default=0, help="到着・考える時間の乱数の種")
+    ap.add_argument("--baseline", default=None, help="比べる基準の結果JSON（悪化していたら終了コード 1）")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="基準からの許容幅（割合）")
+    ap.add_argument("--max-p99-ms", type=float, default=None, help="ターン所要時間 p99 の上限（ミリ秒）")
+    ap.add_argument("--max-rss-mb-per-session", type=float, default=None, help="1セッションあたりの RSS 増加の上限（MB）")
+    ap.add_argument("--max-error-rate", type=float, default=0.0, help="アプリが失敗したターンの割合の上限")
+    ap.add_argument("--max-harness-error-rate", type=float, default=0.0,
+                    help="計測側（AppTest の操作）が失敗したターンの割合の上限")
+    ap.add_argument("--out", default=None, help="結果JSONの保存先（省略時は標準出力）")
+    args = ap.parse_args(argv)
+
+    report = run(sessions=args.sessions, rate=args.rate, turns=args.turns, think=args.think, ttft=args.ttft,
+                 token_interval=args.token_interval, jitter=args.jitter,
+                 completion_tokens=args.completion_tokens, seed=args.seed)
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))["summary"]
+    problems = check(report["summary"], baseline=baseline, tolerance=args.tolerance,
+                     max_p99_ms=args.max_p99_ms, max_rss_mb_per_session=args.max_rss_mb_per_session,
+                     max_error_rate=args.max_error_rate,
+                     max_harness_error_rate=args.max_harness_error_rate)
+    report["regressions"] = problems
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    for p in problems:
+        print(f"REGRESSION: {p}", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# bench/startup.py — コールドスタートの計測（import 時間と、登録フォームが出るまでの時間）
+#
+#   python -m bench.startup                     # 5回（毎回まっさらなプロセス）の中央値
+#   python -m bench.startup --repeat 10 --out bench/results/startup.json
+#
+# ネットワークには出ない（OpenAI のキーはダミー、Supabase/メールは未設定扱い）。
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# app.py が先頭で import するモジュール（streamlit 本体は別に測る）
+APP_MODULES = (
+    "summary_mailer", "assets", "stylesheet", "llm_gateway", "metrics", "context_window",
+    "prompt_assets", "response_cache", "chat_stream", "conversation_state", "conversation_log",
+    "shared_state", "chat_render",
+)
+# 登録フォームを出すだけなら読み込まれてほしくないもの
+HEAVY_MODULES = ("pandas", "openai", "supabase", "httpx", "PIL", "tiktoken", "numpy")
+
+
+def _child():
+    """1回分の計測（新しいプロセスの中で実行）。結果を JSON 1行で出す"""
+    t0 = time.perf_counter()
+    import importlib
+    import streamlit  # noqa: F401
+    t_streamlit = time.perf_counter()
+
+    sys.path.insert(0, str(ROOT))
+    for name in APP_MODULES:
+        importlib.import_module(name)
+    t_modules = time.perf_counter()
+
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=60)
+    t_run = time.perf_counter()
+    at.run()
+    t_paint = time.perf_counter()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    if not at.text_input:
+        raise RuntimeError("registration form was not rendered")
+
+    print(json.dumps({
+        "streamlit_import_ms": round((t_streamlit - t0) * 1000, 3),
+        "app_modules_import_ms": round((t_modules - t_streamlit) * 1000, 3),
+        "first_paint_run_ms": round((t_paint - t_run) * 1000, 3),
+        "time_to_first_paint_ms": round((t_paint - t0) * 1000, 3),
+        "heavy_modules_loaded": sorted(m for m in HEAVY_MODULES if m in sys.modules),
+    }))
+
+
+def _env():
+    env = dict(os.environ)
+    env["OPENAI_API_KEY"] = "sk-fake"  # キーがあってもフォーム表示までにクライアントを作らないこと
+    for name in ("SUPABASE_URL", "SUPABASE_ANON_KEY", "GMAIL_FROM", "RECIPIENT_EMAIL"):
+        env[name] = ""
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    env["CONV_LOG_PATH"] = os.path.join(tmp, "conversation_log.sqlite3")
+    env["SHARED_STATE_PATH"] = os.path.join(tmp, "shared_state.sqlite3")
+    return env
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(repeat):
+    samples = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, "-m", "bench.startup", "--child"], cwd=ROOT, env=_env(),
+                             capture_output=True, text=True, check=True)
+        row = json.loads(out.stdout.strip().splitlines()[-1])
+        samples.append(row)
+        print(json.dumps(row, ensure_ascii=False), file=sys.stderr)
+
+    keys = [k for k in samples[0] if k.endswith("_ms")]
+    return {
+        "bench": "startup",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "config": {"repeat": repeat},
+        "median": {k: round(statistics.median(s[k] for s in samples), 3) for k in keys},
+        "heavy_modules_loaded": samples[-1]["heavy_modules_loaded"],
+        "samples": samples,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="app.py のコールドスタートを計測（オフライン）")
+    ap.add_argument("--repeat", type=int, default=5, help="計測回数（毎回新しいプロセス）")
+    ap.add_argument("--out", default=None, help="結果JSONの保存先（省略時は標準出力）")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+
+    if args.child:
+        _child()
+        return
+    report = run(args.repeat)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
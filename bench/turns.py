@@ -0,0 +1,229 @@
+# bench/turns.py — 登録→N ターンの会話を AppTest で流し、1 rerun あたりのコストを測る
+#
+#   python -m bench.turns                       # 1/10/50/100 ターン時点を計測
+#   python -m bench.turns --turns 1,10 --ttft 0.2 --out bench/results/base.json
+#
+# 毎ターン fragment 内で描いた履歴のバイト数（history_bytes）を記録し、履歴が長くなっても
+# 増えていなければ OK（最初と最後の HISTORY_BLOCK ターンの最大値を比べ、増えていたら終了コード1）。
+#
+# ネットワークには出ない（OpenAI はダミー、Supabase/メールは未設定扱い）。
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from bench import fake_llm  # noqa: E402
+
+
+class Probe:
+    """st.markdown / st.image / 履歴描画 を包んで、1 rerun ごとの時間とバイト数を数える"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.css_seconds = 0.0
+        self.css_bytes = 0
+        self.history_seconds = 0.0
+        self.history_bytes = 0
+        self.markdown_bytes = 0
+        self.image_bytes = 0
+
+    @contextmanager
+    def installed(self):
+        import streamlit as st
+        import assets
+        import chat_render
+        from streamlit.delta_generator import DeltaGenerator
+
+        probe = self
+        in_history = [False]
+        orig_st_markdown = st.markdown
+        orig_dg_markdown = DeltaGenerator.markdown
+        orig_st_image = st.image
+        orig_history = chat_render.render_history
+        orig_css_url = assets.css_url
+
+        def count_markdown(call, body, *a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return call(body, *a, **kw)
+            finally:
+                n = len(str(body).encode("utf-8"))
+                probe.markdown_bytes += n
+                if in_history[0]:
+                    probe.history_bytes += n
+                if "<style" in str(body):
+                    probe.css_seconds += time.perf_counter() - t0
+                    probe.css_bytes += n
+
+        def st_markdown(body, *a, **kw):
+            return count_markdown(orig_st_markdown, body, *a, **kw)
+
+        def dg_markdown(self_, body, *a, **kw):
+            return count_markdown(lambda b, *aa, **kk: orig_dg_markdown(self_, b, *aa, **kk), body, *a, **kw)
+
+        def st_image(image, *a, **kw):
+            if isinstance(image, (str, os.PathLike)) and os.path.exists(image):
+                probe.image_bytes += os.path.getsize(image)
+            return orig_st_image(image, *a, **kw)
+
+        def css_url(*a, **kw):
+            # apply_styles の画像解決ぶんも CSS 側の時間に含める
+            t0 = time.perf_counter()
+            try:
+                return orig_css_url(*a, **kw)
+            finally:
+                probe.css_seconds += time.perf_counter() - t0
+
+        def render_history(*a, **kw):
+            t0 = time.perf_counter()
+            in_history[0] = True
+            try:
+                return orig_history(*a, **kw)
+            finally:
+                in_history[0] = False
+                probe.history_seconds += time.perf_counter() - t0
+
+        st.markdown, DeltaGenerator.markdown, st.image = st_markdown, dg_markdown, st_image
+        chat_render.render_history = render_history
+        assets.css_url = css_url
+        try:
+            yield self
+        finally:
+            st.markdown, DeltaGenerator.markdown, st.image = orig_st_markdown, orig_dg_markdown, orig_st_image
+            chat_render.render_history = orig_history
+            assets.css_url = orig_css_url
+
+    def snapshot(self):
+        return {
+            "css_ms": round(self.css_seconds * 1000, 3),
+            "css_bytes": self.css_bytes,
+            "history_ms": round(self.history_seconds * 1000, 3),
+            "history_bytes": self.history_bytes,
+            "markdown_bytes": self.markdown_bytes,
+            "image_bytes": self.image_bytes,
+            "bytes_emitted": self.markdown_bytes + self.image_bytes,
+        }
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(checkpoints, *, ttft, token_interval, completion_tokens, timeout=60):
+    fake = fake_llm.install(ttft=ttft, token_interval=token_interval, completion_tokens=completion_tokens)
+    from streamlit.testing.v1 import AppTest
+
+    probe = Probe()
+    results = []
+    history_bytes = []  # ターンごと（fragment の再実行で送り直す履歴の量）
+    max_turns = max(checkpoints)
+    tracemalloc.start()
+    with probe.installed():
+        at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=timeout)
+
+        # --- 登録（ensure_registration） ---
+        t0 = time.perf_counter()
+        at.run()
+        at.text_input[0].input("bench")
+        at.button[0].click()
+        at.run()
+        registration_ms = (time.perf_counter() - t0) * 1000
+        if at.exception:
+            raise RuntimeError(f"registration failed: {at.exception[0].message}")
+
+        for turn in range(1, max_turns + 1):
+            probe.reset()
+            tracemalloc.reset_peak()
+            t0 = time.perf_counter()
+            # 送信（返信のストリーミング込み）→ rerun_chat による再描画まで
+            at.chat_input[0].set_value(f"相談その{turn}：流れを整えたい").run()
+            wall_ms = (time.perf_counter() - t0) * 1000
+            if at.exception:
+                raise RuntimeError(f"turn {turn} failed: {at.exception[0].message}")
+
+            history_bytes.append(probe.history_bytes)
+
+            if turn in checkpoints:
+                row = {"turns": turn, "rerun_wall_ms": round(wall_ms, 3),
+                       "peak_mem_bytes": tracemalloc.get_traced_memory()[1]}
+                row.update(probe.snapshot())
+                results.append(row)
+                print(json.dumps(row, ensure_ascii=False), file=sys.stderr)
+    tracemalloc.stop()
+
+    return {
+        "bench": "turns",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "config": {"ttft": ttft, "token_interval": token_interval,
+                   "completion_tokens": completion_tokens, "checkpoints": sorted(checkpoints)},
+        "registration_ms": round(registration_ms, 3),
+        "llm_calls": fake.calls,
+        "history_bytes": history_bytes,
+        "results": results,
+    }
+
+
+def check(report, tolerance):
+    """
+    fragment で送る履歴が履歴の長さに比例して増えていないか。
+    最初と最後の HISTORY_BLOCK ターン（それぞれ直近分が一巡以上する長さ）の最大値を比べる。
+    返り値: 問題の説明のリスト（空なら OK）
+    """
+    from chat_render import HISTORY_BLOCK
+
+    per_turn = report["history_bytes"]
+    if len(per_turn) < 2 * HISTORY_BLOCK:
+        return []  # 比べられるほどターンが無い
+    first, last = max(per_turn[:HISTORY_BLOCK]), max(per_turn[-HISTORY_BLOCK:])
+    if last > first * (1 + tolerance):
+        return [f"history_bytes grew with history: {first} -> {last} bytes per turn"]
+    return []
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="app.py の1ターンあたりのコストを計測（オフライン）")
+    ap.add_argument("--turns", default="1,10,50,100", help="計測するターン数（カンマ区切り）")
+    ap.add_argument("--ttft", type=float, default=0.05, help="ダミーLLMの最初のチャンクまでの秒数")
+    ap.add_argument("--token-interval", type=float, default=0.0, help="ダミーLLMのチャンク間隔（秒）")
+    ap.add_argument("--completion-tokens", type=int, default=120, help="ダミーLLMの返事の長さ")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="history_bytes の増加をどこまで許すか（割合）")
+    ap.add_argument("--out", default=None, help="結果JSONの保存先（省略時は標準出力）")
+    args = ap.parse_args(argv)
+
+    checkpoints = {int(x) for x in args.turns.split(",") if x.strip()}
+    report = run(checkpoints, ttft=args.ttft, token_interval=args.token_interval,
+                 completion_tokens=args.completion_tokens)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    problems = check(report, args.tolerance)
+    for p in problems:
+        print(f"FAIL: {p}", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# chat_render.py — 履歴の吹き出しHTMLを使い回し、古い発言はまとめて1要素で（fragment の外に）出す
+import functools
+
+from chat_stream import user_bubble_html, bot_bubble_html
+
+HISTORY_BLOCK = 20     # この件数ごとに「確定ブロック」として1つの st.markdown にまとめる
+HISTORY_TAIL_MAX = HISTORY_BLOCK  # fragment で1件ずつ描くのはここまで。超えたら全体を再実行して確定ブロックへ移す
+
+
+@functools.lru_cache(maxsize=4096)
+def bubble_html(role, content):
+    """吹き出しHTML（同じ内容は組み立て直さない。内容だけで決まるのでプロセス共有でよい）"""
+    return user_bubble_html(content) if role == "user" else bot_bubble_html(content)
+
+
+def _block_html(cache, messages, start):
+    """確定ブロック [start, start+HISTORY_BLOCK) の連結HTML。セッションごとに一度だけ作る"""
+    hit = cache.get(start)
+    if hit is not None:
+        return hit
+    html = "\n".join(bubble_html(m["role"], m["content"]) for m in messages[start:start + HISTORY_BLOCK])
+    cache[start] = html
+    return html
+
+
+def _first_shown(messages):
+    # 退避済み（ConversationState の古い分）は描かない。ブロックの区切りに切り上げる
+    first = getattr(messages, "first_in_memory", 0)
+    return first + -first % HISTORY_BLOCK
+
+
+def render_frozen(st, messages):
+    """
+    確定ブロック（HISTORY_BLOCK 件そろった古い発言）を1ブロック=1要素で描く。
+    全体の再実行でだけ呼ぶこと（fragment の外）。fragment の再実行では送り直されない。
+    """
+    cache = st.session_state.setdefault("_history_blocks", {})
+    n = len(messages)
+    sealed = n - n % HISTORY_BLOCK
+    if cache and max(cache) >= sealed:
+        cache.clear()  # 履歴がリセット/短縮された
+
+    first = _first_shown(messages)
+    if first:
+        st.caption(f"（これより前の {first} 件のやりとりは省略しています）")
+        for k in [k for k in cache if k < first]:
+            del cache[k]
+
+    for start in range(first, sealed, HISTORY_BLOCK):
+        st.markdown(_block_html(cache, messages, start), unsafe_allow_html=True)
+    st.session_state["_history_frozen"] = max(first, sealed)
+
+
+def render_history(st, messages):
+    """
+    確定ブロックより後ろの直近の発言だけを1件ずつ描く（fragment の中で呼ぶ）。
+    古い発言は render_frozen が全体の再実行時に描いているので、1ターンで送るのは
+    直近の HISTORY_TAIL_MAX 件程度に収まり、履歴が長くなっても増えない。
+    """
+    start = max(st.session_state.get("_history_frozen", 0), _first_shown(messages))
+    for m in messages[min(start, len(messages)):]:
+        st.markdown(bubble_html(m["role"], m["content"]), unsafe_allow_html=True)
+
+
+def chat_fragment(func):
+    """
+    チャット欄を st.fragment で切り出すデコレータ（入力→返信の再実行をこの中だけに閉じる）。
+    背景/CSS/タイトルは全体の再実行時にしか送られなくなる。
+    """
+    import streamlit as st
+    return st.fragment(func)
+
+
+def rerun_chat(st, messages=None):
+    """
+    チャット欄（fragment）だけ再実行する。全体の再実行中に呼ばれた場合は全体を再実行。
+    messages を渡すと、直近分が HISTORY_TAIL_MAX 件を超えたときは全体を再実行して確定ブロックへ移す。
+    """
+    from streamlit.errors import StreamlitAPIException
+    if messages is not None and len(messages) - st.session_state.get("_history_frozen", 0) > HISTORY_TAIL_MAX:
+        st.rerun()
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
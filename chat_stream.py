@@ -0,0 +1,65 @@
+# chat_stream.py — 返信をチャンク単位で吹き出しに流し込む（OpenAIなしでも動く）
+import time
+
+import llm_gateway
+from metrics import span, observe
+
+DEMO_REPLY = llm_gateway.FALLBACK_REPLY
+
+
+# ===== 吹き出しHTML =====
+def user_bubble_html(text):
+    return f"<div style='text-align:right;'>🧑‍💼<div class='bubble-user'>{text}</div></div>"
+
+
+def bot_bubble_html(text):
+    return f"<div>🧚‍♀️<div class='bubble-bot'>{text}</div></div>"
+
+
+# ===== チャンク供給元 =====
+def iter_demo_chunks(text=DEMO_REPLY, *, chunk_chars=4, delay=0.03):
+    """デモ応答を数文字ずつ返す（ネットワーク無しでストリーミングを確認できる）"""
+    for i in range(0, len(text), chunk_chars):
+        if delay:
+            time.sleep(delay)
+        yield text[i:i + chunk_chars]
+
+
+def iter_llm_chunks(*, model, messages, temperature=0.7):
+    """共有ゲートウェイ経由で stream=True で呼び、差分テキストだけを返す（最初の1文字までの時間も記録）"""
+    with span("llm.chat"):
+        t0 = time.perf_counter()
+        first = True
+        for delta in llm_gateway.stream_chat(messages, model=model, temperature=temperature):
+            if first:
+                observe("llm.chat.ttft", time.perf_counter() - t0)
+                first = False
+            yield delta
+
+
+# ===== 描画 =====
+def render_stream(placeholder, chunks, *, cursor="▌", min_interval=0.05):
+    """
+    chunks を受け取りながら placeholder（st.empty()）の bot 吹き出しを書き換える。
+    - 書き換えは min_interval 秒ごとに間引く（websocket の送信回数を抑える）
+    - 途中で例外が起きたら、そこまでの本文にエラー注記を付けて返す
+    返り値は (確定した返信テキスト（messages に積む用）, 最後まで受け取れたか)。
+    """
+    parts = []
+    last = 0.0
+    ok = True
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            now = time.monotonic()
+            if now - last >= min_interval:
+                placeholder.markdown(bot_bubble_html("".join(parts) + cursor), unsafe_allow_html=True)
+                last = now
+        text = "".join(parts).strip()
+    except Exception as e:
+        partial = "".join(parts).strip()
+        text = f"{partial}\n\n⚠️ AI応答エラー：{e}" if partial else f"⚠️ AI応答エラー：{e}"
+        ok = False
+
+    placeholder.markdown(bot_bubble_html(text), unsafe_allow_html=True)
+    return text, ok
@@ -0,0 +1,214 @@
+# context_window.py — 毎ターン全履歴を送らず、直近ターン＋要約でトークン予算内に収める
+import os
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy import lazy_import
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))  # system含む送信上限（概算トークン）
+CONTEXT_KEEP_TURNS = int(os.getenv("CONTEXT_KEEP_TURNS", "6"))          # そのまま送る直近のユーザー発話数
+CONTEXT_FOLD_MIN = int(os.getenv("CONTEXT_FOLD_MIN", "12"))             # 要約に畳むのはこの件数が溜まってから
+CONTEXT_FOLD_WORKERS = int(os.getenv("CONTEXT_FOLD_WORKERS", "2"))      # 裏で要約を作る数（プロセス共有）
+CONTEXT_FOLD_TIMEOUT = float(os.getenv("CONTEXT_FOLD_TIMEOUT", "180"))  # これ以上返ってこない要約は諦めて出し直す（秒）
+CONTEXT_FOLD_RETRY = float(os.getenv("CONTEXT_FOLD_RETRY", "60"))       # 要約に失敗したら、この秒数は出し直さない
+
+MSG_OVERHEAD = 4  # 1メッセージあたりのロール等の上乗せ分
+
+
+# ===== トークン概算 =====
+tiktoken = lazy_import("tiktoken")
+_enc = {"encoder": None, "ready": False}  # エンコーダの読み込みは最初に数えるときまで待つ
+
+
+def _encoder():
+    if not _enc["ready"]:
+        try:
+            _enc["encoder"] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _enc["encoder"] = None
+        _enc["ready"] = True
+    return _enc["encoder"]
+
+
+def estimate_tokens(text):
+    """tiktoken があれば正確に、無ければ概算（日本語≒1文字1トークン、英数字≒4文字1トークン）"""
+    if not text:
+        return 0
+    enc = _encoder()
+    if enc is not None:
+        return len(enc.encode(text))
+    ascii_cnt = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_cnt) + (ascii_cnt + 3) // 4
+
+
+def messages_tokens(msgs):
+    return sum(estimate_tokens(m["content"]) + MSG_OVERHEAD for m in msgs)
+
+
+def _history_tokens(messages):
+    # ConversationState は追加のたびに数えてあるので全件を舐めない
+    total = getattr(messages, "tokens", None)
+    return total if total is not None else messages_tokens(messages)
+
+
+# ===== 要約（summary_mailer._summarize を流用） =====
+def default_summarizer(prev_summary, msgs):
+    """失敗は例外のまま（失敗文を要約として持ち回さない）"""
+    from summary_mailer import _summarize
+    summary, _ = _summarize(list(msgs), prev_summary=prev_summary, raise_errors=True)
+    return summary
+
+
+_fold_pool = None
+_fold_lock = threading.Lock()
+_fold_counts = {"scheduled": 0, "folded": 0, "failed": 0, "stale": 0}
+
+
+def _pool():
+    global _fold_pool
+    if _fold_pool is None:
+        with _fold_lock:
+            if _fold_pool is None:
+                _fold_pool = ThreadPoolExecutor(max_workers=CONTEXT_FOLD_WORKERS, thread_name_prefix="context-fold")
+    return _fold_pool
+
+
+def _count(key):
+    with _fold_lock:
+        _fold_counts[key] += 1
+
+
+def _fold_job(state, summarizer, prev_summary, pending, frm, upto):
+    """裏で要約を作り、結果を state["folded"] に置く（反映は次の build_context で）。失敗したら何も残さない"""
+    try:
+        summary = summarizer(prev_summary, pending)
+    except Exception:
+        # 前の要約のまま。畳む予定だった分は残し、少し置いてから出し直す
+        _count("failed")
+        state["folding"] = {"from": frm, "upto": upto, "at": time.time(), "failed": True}
+        return
+    state.pop("folding", None)
+    state["folded"] = {"from": frm, "upto": upto, "summary": summary}
+    _count("folded")
+
+
+def _schedule_fold(state, summarizer, summary, pending, frm, upto):
+    running = state.get("folding")
+    wait = CONTEXT_FOLD_RETRY if running and running.get("failed") else CONTEXT_FOLD_TIMEOUT
+    if running and running["from"] == frm and time.time() - running["at"] < wait:
+        return False  # 同じ範囲をもう作っている（か、失敗したばかり）
+    state["folding"] = {"from": frm, "upto": upto, "at": time.time()}
+    ctx = contextvars.copy_context()  # 使用量の付け先（usage_meter）をワーカーにも引き継ぐ
+    _pool().submit(ctx.run, _fold_job, state, summarizer, summary, pending, frm, upto)
+    _count("scheduled")
+    return True
+
+
+def fold_stats():
+    with _fold_lock:
+        return dict(_fold_counts)
+
+
+def _apply_folded(state):
+    """裏で出来上がった要約を反映。途中で要約の起点が変わっていたら捨てる"""
+    done = state.pop("folded", None)
+    if not done:
+        return
+    if done["from"] != state.get("upto", 0):
+        _count("stale")
+        return
+    state["summary"] = done["summary"]
+    state["upto"] = done["upto"]
+
+
+def _summary_message(summary):
+    return {"role": "system", "content": f"これまでの会話の要約：\n{summary}"}
+
+
+# ===== 本体 =====
+def build_context(system_msgs, messages, state, *, budget=None, keep_turns=None,
+                  fold_min=None, summarizer=default_summarizer, background=True):
+    """
+    system_msgs + （要約）+ 直近ターン のメッセージ列を返す。
+    messages は dict のリストか ConversationState（通し番号で引ける）。
+    - state は st.session_state 上の dict（summary / upto を持ち回す。upto=要約済みの件数）
+    - 直近 keep_turns 発話ぶんを budget 内でそのまま残し、それより古いものは要約に畳む
+    - 畳む件数が fold_min 未満で予算に余裕があれば、要約せずそのまま送る（LLM呼び出しを間引く）
+    - 要約は裏のワーカーで作り、出来上がった次のターンから使う（返信を待たせない）。
+      それまでは畳む予定の分も予算の許す限りそのまま送る。background=False ならその場で畳む
+    返り値: (msgs, stats)  stats には今回節約できた概算トークン数などが入る
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    keep_turns = CONTEXT_KEEP_TURNS if keep_turns is None else keep_turns
+    fold_min = CONTEXT_FOLD_MIN if fold_min is None else fold_min
+
+    _apply_folded(state)
+    summary = state.get("summary", "")
+    upto = min(state.get("upto", 0), len(messages))
+
+    fixed = messages_tokens(system_msgs)
+    summary_cost = messages_tokens([_summary_message(summary)]) if summary else 0
+
+    # 後ろから、ターン数と予算が許す範囲で残す（最後のメッセージは必ず残す）
+    start = len(messages)
+    used = fixed + summary_cost
+    turns = 0
+    while start > upto:
+        m = messages[start - 1]
+        cost = estimate_tokens(m["content"]) + MSG_OVERHEAD
+        if start < len(messages) and used + cost > budget:
+            break
+        if m["role"] == "user":
+            if turns >= keep_turns:
+                break
+            turns += 1
+        used += cost
+        start -= 1
+
+    pending = messages[upto:start]
+    if pending and len(pending) < fold_min and used + messages_tokens(pending) <= budget:
+        # まだ畳むほど溜まっていない → そのまま送る
+        start = upto
+        pending = []
+
+    folded = 0
+    scheduled = False
+    if pending and background:
+        scheduled = _schedule_fold(state, summarizer, summary, pending, upto, start)
+    elif pending:
+        try:
+            summary = summarizer(summary, pending)
+        except Exception:
+            _count("failed")  # 前の要約のまま。畳めなかった分は次のターンでもう一度
+        else:
+            folded = len(pending)
+            upto = start
+            state["summary"] = summary
+            state["upto"] = upto
+    if start > upto:
+        # 要約がまだ無い分も、新しい方から予算の許す限りそのまま送る
+        while start > upto:
+            cost = estimate_tokens(messages[start - 1]["content"]) + MSG_OVERHEAD
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+
+    msgs = list(system_msgs)
+    if summary:
+        msgs.append(_summary_message(summary))
+    msgs.extend(messages[start:])
+
+    full = fixed + _history_tokens(messages)
+    sent = messages_tokens(msgs)
+    stats = {
+        "full_tokens": full,
+        "sent_tokens": sent,
+        "saved_tokens": max(0, full - sent),
+        "kept_messages": len(messages) - start,
+        "folded_messages": folded,
+        "fold_scheduled": scheduled,
+    }
+    return msgs, stats
@@ -0,0 +1,274 @@
+# conversation_log.py — 会話を追記専用ログに残す（書き込みはまとめて裏で）。同じタブ（?sid=）に戻ったら直近だけ読み戻す
+import os
+import atexit
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import observe, span
+
+CONV_LOG_BACKEND = os.getenv("CONV_LOG_BACKEND", "sqlite")  # sqlite / supabase / off
+CONV_LOG_PATH = os.getenv("CONV_LOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "data", "conversation_log.sqlite3"))
+CONV_LOG_TABLE = os.getenv("CONV_LOG_TABLE", "conversation_log")   # supabase 側のテーブル名
+CONV_LOG_BATCH = int(os.getenv("CONV_LOG_BATCH", "50"))              # 1回の書き込みにまとめる件数
+CONV_LOG_FLUSH_INTERVAL = float(os.getenv("CONV_LOG_FLUSH_INTERVAL", "1.0"))  # 溜まらなくても書く間隔（秒）
+CONV_LOG_QUEUE_MAX = int(os.getenv("CONV_LOG_QUEUE_MAX", "10000"))   # これ以上溜まったら捨てて数える
+CONV_RESUME_MESSAGES = int(os.getenv("CONV_RESUME_MESSAGES", "20"))  # つなぎ直したときに読み戻す件数
+SESSION_RESUME = os.getenv("SESSION_RESUME", "0") == "1"  # 1 なら URL の ?sid= でタブを見分け、同じ名前で入り直せば続きから
+
+_SID = re.compile(r"^[0-9a-f]{32}$")
+
+
+# ===== 保存先 =====
+class SQLiteBackend:
+    """ローカルの SQLite（WAL）。書き込みはライタースレッドだけ、読み込みはスレッドごとの接続で"""
+
+    def __init__(self, path=CONV_LOG_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._conn() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS conversation_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                nickname TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS conversation_log_sid ON conversation_log (session_id, id)")
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")  # WAL なら電源断でも壊れない（直近数件が消えるだけ）
+            self._local.db = db
+        return db
+
+    def write(self, rows):
+        with self._conn() as db:
+            db.executemany(
+                "INSERT INTO conversation_log (nickname, session_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(r["nickname"], r["session_id"], r["role"], r["content"], r["created_at"]) for r in rows])
+
+    def recent(self, session_id, nickname, limit):
+        cur = self._conn().execute(
+            "SELECT role, content FROM conversation_log WHERE session_id = ? AND nickname = ?"
+            " ORDER BY id DESC LIMIT ?",
+            (session_id, nickname, limit))
+        return [{"role": role, "content": content} for role, content in reversed(cur.fetchall())]
+
+
+class SupabaseBackend:
+    """Supabase のテーブル（nickname, session_id, role, content, created_at + 連番の id）"""
+
+    def __init__(self, table=CONV_LOG_TABLE):
+        self.table = table
+
+    def _client(self):
+        from supabase_pool import get_supabase_client
+        sb = get_supabase_client()
+        if sb is None:
+            raise RuntimeError("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY）")
+        return sb
+
+    def write(self, rows):
+        from datetime import datetime, timezone
+        self._client().table(self.table).insert([
+            dict(r, created_at=datetime.fromtimestamp(r["created_at"], timezone.utc).isoformat())
+            for r in rows]).execute()
+
+    def recent(self, session_id, nickname, limit):
+        res = (self._client().table(self.table).select("role,content")
+               .eq("session_id", session_id).eq("nickname", nickname)
+               .order("id", desc=True).limit(limit).execute())
+        return list(reversed(res.data or []))
+
+
+# ===== 本体 =====
+class ConversationLog:
+    """
+    append() はキューに積むだけ（チャットの処理は I/O を待たない）。
+    - ライタースレッドが batch 件ずつ、または flush_interval ごとにまとめて書く
+    - 失敗した分は次の回に持ち越す（キューが溢れたら捨てて dropped に数える）
+    - プロセス終了時（atexit）は残りを書き切る
+    """
+
+    def __init__(self, backend, *, batch=CONV_LOG_BATCH, flush_interval=CONV_LOG_FLUSH_INTERVAL,
+                 maxsize=CONV_LOG_QUEUE_MAX):
+        self.backend = backend
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self._q = queue.Queue(maxsize=maxsize)
+        self._pending = []  # 書き損ねて持ち越している行
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._counts = {"appended": 0, "written": 0, "dropped": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._loop, name="conversation-log", daemon=True)
+        self._thread.start()
+
+    def append(self, nickname, session_id, role, content) -> bool:
+        row = {"nickname": nickname or "", "session_id": session_id or "", "role": role,
+               "content": content, "created_at": time.time()}
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            self._counts["dropped"] += 1
+            return False
+        self._counts["appended"] += 1
+        return True
+
+    def recent(self, session_id, nickname, limit=CONV_RESUME_MESSAGES):
+        """
+        そのセッション（タブ）の直近 limit 件（古い順）。取れなければ空。
+        ニックネームは表示名で誰でも名乗れるので鍵にしない（session_id が鍵。名前は一致も確かめるだけ）
+        """
+        if not session_id or not nickname or limit <= 0:
+            return []
+        try:
+            with span("conversation_log.recent"):
+                return self.backend.recent(session_id, nickname, limit)
+        except Exception:
+            return []
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                row = self._q.get(timeout=self.flush_interval)
+            except queue.Empty:
+                row = None
+            rows = [row] if row is not None else []
+            while len(rows) < self.batch:
+                try:
+                    rows.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(rows)
+
+    def _write(self, rows):
+        with self._write_lock:
+            rows = self._pending + rows
+            if not rows:
+                return
+            t0 = time.perf_counter()
+            try:
+                self.backend.write(rows)
+            except Exception:
+                self._counts["errors"] += 1
+                self._pending = rows[-CONV_LOG_QUEUE_MAX:]
+                return
+            self._pending = []
+            self._counts["written"] += len(rows)
+            observe("conversation_log.write", time.perf_counter() - t0)
+
+    def flush(self):
+        """キューに溜まっている分をいま書く"""
+        rows = []
+        while True:
+            try:
+                rows.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, max(len(rows), 1), self.batch):
+            self._write(rows[i:i + self.batch])
+
+    def shutdown(self, timeout=5.0):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        s = dict(self._counts)
+        s["queue_depth"] = self._q.qsize()
+        s["pending"] = len(self._pending)
+        return s
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def _make_backend(name):
+    if name == "supabase":
+        return SupabaseBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    return None
+
+
+def get_conversation_log():
+    """プロセス共有のログ（CONV_LOG_BACKEND=off や作れないときは None）"""
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                try:
+                    backend = _make_backend(CONV_LOG_BACKEND)
+                except Exception:
+                    backend = None
+                if backend is None:
+                    return None
+                _log = ConversationLog(backend)
+                atexit.register(_log.shutdown)
+    return _log
+
+
+# ===== Streamlit から使う =====
+def _query_sid(st):
+    try:
+        sid = st.query_params.get("sid")
+    except Exception:
+        return None
+    return sid if isinstance(sid, str) and _SID.match(sid) else None
+
+
+def session_id(st):
+    """
+    タブ（セッション）ごとの ID。SESSION_RESUME のときは URL（?sid=）にも載せ、
+    再接続で別のレプリカに振られても同じ ID になるようにする。
+    """
+    sid = st.session_state.get("_session_id")
+    if sid is None:
+        sid = _set_session_id(st, (_query_sid(st) if SESSION_RESUME else None) or uuid.uuid4().hex)
+    return sid
+
+
+def new_session_id(st):
+    """このタブに新しい ID を振り直す（URL の sid が別の人のセッションだったとき）"""
+    return _set_session_id(st, uuid.uuid4().hex)
+
+
+def _set_session_id(st, sid):
+    st.session_state["_session_id"] = sid
+    if SESSION_RESUME:
+        try:
+            st.query_params["sid"] = sid
+        except Exception:
+            pass
+    return sid
+
+
+def log_message(st, role, content) -> bool:
+    """発話を1件ログに積む（すぐ返る）"""
+    log = get_conversation_log()
+    if log is None:
+        return False
+    return log.append(st.session_state.get("nickname"), session_id(st), role, content)
+
+
+def load_recent(st, nickname, limit=CONV_RESUME_MESSAGES):
+    """
+    同じタブ（URL の ?sid=）に戻ってきたときの直近の会話（古い順の dict リスト）。
+    新しいタブ・別の人は同じニックネームでも空から始まる。
+    """
+    log = get_conversation_log()
+    if log is None or not SESSION_RESUME:
+        return []
+    return log.recent(session_id(st), nickname, limit)
@@ -0,0 +1,323 @@
+# conversation_state.py — 会話履歴をコンパクトに持ち、発話数は O(1) で数える
+import os
+import json
+import threading
+import time
+import weakref
+import zlib
+
+from context_window import estimate_tokens, MSG_OVERHEAD
+from conversation_log import session_id, new_session_id, SESSION_RESUME
+from shared_state import get_shared_state
+
+CONV_MAX_IN_MEMORY = int(os.getenv("CONV_MAX_IN_MEMORY", "200"))  # 生のまま手元に置く件数の目安
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 86400)))      # 共有状態にセッションを残す期間（秒）
+SESSION_KEYS = ("nickname", "mail_sent", "booking_shown", "context_window")  # 会話と一緒に残す session_state
+CONV_SPILL_CHUNK = 100  # 退避の単位（履歴描画のブロック 20 件の倍数にしておく）
+SESSION_SAVE_BLOCK = 20  # 共有状態へはこの件数ごとの塊で保存し、毎ターンは変わった塊（末尾）だけ書き直す
+CONV_PIN_TTL = float(os.getenv("CONV_PIN_TTL", "3600"))  # 要約し終えていない会話を、タブが閉じても手元に置いておく最長秒数
+
+ROLES = ("user", "assistant", "system")
+_ROLE_CODE = {r: i for i, r in enumerate(ROLES)}
+
+
+class ConversationState:
+    """
+    st.session_state.messages（dict のリスト）の代わり。
+    - 1件は (ロール番号, 本文) のタプルで持つ
+    - user / assistant の発話数と概算トークン数は追加時に数えておく（毎回 sum() しない）
+    - 手元に置く件数に上限を設け、古いものは CONV_SPILL_CHUNK 件ずつ zlib 圧縮して退避
+    - 添字・スライスは通し番号で引ける（conv[-40:] などは従来の list と同じ感覚で使える）
+    """
+
+    __slots__ = ("_recent", "_spilled", "spilled_count", "user_turns", "assistant_turns",
+                 "tokens", "max_in_memory", "nickname", "session_id", "last_activity", "reaped_turns",
+                 "saved_count", "saved_at", "__weakref__")
+
+    def __init__(self, messages=(), *, max_in_memory=CONV_MAX_IN_MEMORY):
+        self._recent = []          # [(role_code, content), ...]
+        self._spilled = []         # [zlib(json([[role_code, content], ...])), ...]
+        self.spilled_count = 0     # 退避済みの件数（= 手元にある最古の通し番号）
+        self.user_turns = 0
+        self.assistant_turns = 0
+        self.tokens = 0            # 全履歴の概算トークン数
+        self.max_in_memory = max(max_in_memory, CONV_SPILL_CHUNK)
+        self.nickname = None
+        self.session_id = None            # どのタブの会話か（レプリカをまたいだ「一度だけ」の印に使う）
+        self.last_activity = time.time()  # 最後に発話が増えた時刻（放置セッションの判定用）
+        self.reaped_turns = 0             # 要約（定期・放置時）に回したユーザー発話数（同じ分を二度要約しない）
+        self.saved_count = 0              # 共有状態に書き終えた件数（save_session はこれより後ろの塊だけ書く）
+        self.saved_at = 0.0               # 全部の塊を書き直した時刻（古い塊が期限切れになる前に書き直す）
+        for m in messages:
+            self.append(m["role"], m["content"])
+
+    # ===== 追加 =====
+    def append(self, role, content):
+        self._recent.append((_ROLE_CODE[role], content))
+        if role == "user":
+            self.user_turns += 1
+        elif role == "assistant":
+            self.assistant_turns += 1
+        self.tokens += estimate_tokens(content) + MSG_OVERHEAD
+        self.last_activity = time.time()
+        if len(self._recent) > self.max_in_memory + CONV_SPILL_CHUNK:
+            self._spill()
+
+    def _spill(self):
+        chunk, self._recent = self._recent[:CONV_SPILL_CHUNK], self._recent[CONV_SPILL_CHUNK:]
+        raw = json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self._spilled.append(zlib.compress(raw, 6))
+        self.spilled_count += len(chunk)
+
+    # ===== 参照 =====
+    def __len__(self):
+        return self.spilled_count + len(self._recent)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def _record(self, i):
+        if i >= self.spilled_count:
+            return self._recent[i - self.spilled_count]
+        chunk = json.loads(zlib.decompress(self._spilled[i // CONV_SPILL_CHUNK]))
+        return chunk[i % CONV_SPILL_CHUNK]
+
+    @staticmethod
+    def _as_dict(rec):
+        return {"role": ROLES[rec[0]], "content": rec[1]}
+
+    def __getitem__(self, key):
+        """通し番号で dict を返す（スライスは list）。退避分に触れたときだけ展開する"""
+        n = len(self)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            out = []
+            if start < self.spilled_count:
+                for ci in range(start // CONV_SPILL_CHUNK, min(stop, self.spilled_count) // CONV_SPILL_CHUNK + 1):
+                    if ci >= len(self._spilled):
+                        break
+                    base = ci * CONV_SPILL_CHUNK
+                    for j, rec in enumerate(json.loads(zlib.decompress(self._spilled[ci]))):
+                        if start <= base + j < stop:
+                            out.append(self._as_dict(rec))
+            lo = max(start, self.spilled_count) - self.spilled_count
+            hi = stop - self.spilled_count
+            if hi > lo:
+                out.extend(self._as_dict(rec) for rec in self._recent[lo:hi])
+            return out
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError("conversation index out of range")
+        return self._as_dict(self._record(key))
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def recent(self, n=None):
+        """手元にある直近 n 件（省略時は手元の全件）"""
+        recs = self._recent if n is None else self._recent[-n:]
+        return [self._as_dict(r) for r in recs]
+
+    def since_user_turn(self, k):
+        """k 回目のユーザー発話より後（k+1 回目の発話から末尾まで）。後ろから数えるので新しい分だけ見る"""
+        need = self.user_turns - k
+        if need <= 0:
+            return []
+        i = len(self)
+        while need > 0 and i > 0:
+            i -= 1
+            if self._record(i)[0] == 0:  # user
+                need -= 1
+        return self[i:]
+
+    @property
+    def first_in_memory(self):
+        return self.spilled_count
+
+    # ===== 共有状態への保存・復元 =====
+    def records(self, start, stop):
+        """[start, stop) を JSON にできる [[ロール番号, 本文], ...] で"""
+        return [[_ROLE_CODE[m["role"]], m["content"]] for m in self[start:stop]]
+
+    @classmethod
+    def from_records(cls, records, *, max_in_memory=CONV_MAX_IN_MEMORY):
+        conv = cls(max_in_memory=max_in_memory)
+        for code, content in records:
+            conv.append(ROLES[code], content)
+        return conv
+
+
+# ===== 生きている会話の台帳（ニックネーム → 会話。セッションが消えれば自然に消える） =====
+# Streamlit はタブが閉じると（disconnectedSessionTTL 後に）セッションごと会話を捨てる。
+# 放置時の要約より先に消えないよう、まだ要約していない発話がある会話は _pinned で強く持っておき、
+# 見回りが要約し終えたら（または CONV_PIN_TTL を過ぎたら）手放す。
+_live = weakref.WeakValueDictionary()
+_sessions = weakref.WeakSet()  # 同じニックネームの別タブも含めた全セッション
+_pinned = {}                   # id(conv) -> conv（要約待ち）
+_live_lock = threading.Lock()
+
+
+def _prune_pinned(now):
+    # _live_lock の中で呼ぶ。見回りが動いていない（IDLE_TIMEOUT=0 等）ときもここで溜まりすぎない
+    for key in [k for k, c in _pinned.items() if now - c.last_activity > CONV_PIN_TTL]:
+        del _pinned[key]
+
+
+def register_conversation(nickname, conv, session_id=None):
+    if nickname:
+        with _live_lock:
+            conv.nickname = nickname
+            conv.session_id = session_id or conv.session_id
+            _live[nickname] = conv
+            _sessions.add(conv)
+            _prune_pinned(time.time())
+            _pinned[id(conv)] = conv
+
+
+def pin_conversation(conv):
+    """新しい発話があった会話を、要約し終えるまで手放さないようにする（1ターンに1回）"""
+    if conv.nickname:
+        with _live_lock:
+            _pinned[id(conv)] = conv
+
+
+def unpin_conversation(conv):
+    """要約し終えた会話を手放す（タブが生きていればセッション側が持っている）"""
+    with _live_lock:
+        _pinned.pop(id(conv), None)
+
+
+# ===== 要約の取り置き（定期要約と放置時の見回りで同じ発話を二度要約しない） =====
+_claim_lock = threading.Lock()
+
+
+def claim_turns(conv, upto):
+    """
+    conv の reaped_turns〜upto 発話目を要約用に取り置き、reaped_turns を upto まで進める。
+    返り値: 取り置いた始まり（since）。新しい発話が無い・ほかのレプリカが拾ったなら None
+    """
+    with _claim_lock:
+        since = conv.reaped_turns
+        if upto <= since:
+            return None
+        conv.reaped_turns = upto
+    if conv.session_id and not get_shared_state().add("reap", f"{conv.session_id}:{upto}", ttl=SESSION_TTL):
+        return None  # 同じタブの会話を別のレプリカが拾った
+    return since
+
+
+def release_turns(conv, since, upto):
+    """保存できなかった取り置きを戻す（次の定期要約か見回りでやり直す）"""
+    with _claim_lock:
+        if conv.reaped_turns == upto:
+            conv.reaped_turns = since
+    if conv.session_id:
+        get_shared_state().delete("reap", f"{conv.session_id}:{upto}")
+
+
+def live_conversations(now=None):
+    """登録済みで生きている会話の一覧（スナップショット）。期限切れの要約待ちはここで手放す"""
+    with _live_lock:
+        _prune_pinned(time.time() if now is None else now)
+        return list(_sessions)
+
+
+def find_conversation(nickname):
+    """同じプロセスで進行中の会話（無ければ None）"""
+    with _live_lock:
+        return _live.get(nickname)
+
+
+def get_conversation(st, greeting=None, history=()):
+    """
+    セッションの ConversationState を返す（無ければ作る）。
+    旧形式の st.session_state.messages が残っていれば取り込んで置き換える。
+    history（再訪時に読み戻した直近の会話）があれば、その続きに greeting を置く。
+    """
+    conv = st.session_state.get("conversation")
+    if conv is None:
+        old = st.session_state.get("messages") or list(history)
+        conv = ConversationState(old)
+        conv.reaped_turns = conv.user_turns  # 読み戻した分は前のセッションで要約済み
+        if greeting and (history or not conv):
+            conv.append("assistant", greeting)
+        st.session_state["conversation"] = conv
+        register_conversation(st.session_state.get("nickname"), conv, session_id(st))
+        if "messages" in st.session_state:
+            del st.session_state["messages"]
+    return conv
+
+
+# ===== セッションの保存・復元（別のレプリカにつなぎ直しても続きから） =====
+# "session" / sid       … ニックネーム・フラグ＋会話の見出し（件数など。毎ターン書くが小さい）
+# "session_conv" / sid:k … 会話の k 番目の塊（SESSION_SAVE_BLOCK 件ずつ。増えた末尾の塊だけ書く）
+def _save_blocks(shared, sid, conv, now):
+    n, size = len(conv), SESSION_SAVE_BLOCK
+    if now - conv.saved_at > SESSION_TTL / 2:
+        conv.saved_count, conv.saved_at = 0, now  # 古い塊の期限が切れる前に全部書き直す
+    for k in range(min(conv.saved_count, n) // size, -(-n // size)):
+        shared.set("session_conv", f"{sid}:{k}", conv.records(k * size, (k + 1) * size), ttl=SESSION_TTL)
+    conv.saved_count = n
+    return {"length": n, "block": size, "saved_at": conv.saved_at, "reaped_turns": conv.reaped_turns}
+
+
+def _load_blocks(shared, sid, head):
+    n, size = head["length"], head["block"]
+    records = []
+    for k in range(-(-n // size)):
+        block = shared.get("session_conv", f"{sid}:{k}", fresh=True)
+        if block is None:
+            return None  # 期限切れ・書きかけ。会話は諦めて新しく始める
+        records.extend(block)
+    conv = ConversationState.from_records(records[:n])
+    conv.reaped_turns = min(head["reaped_turns"], conv.user_turns)
+    conv.saved_count, conv.saved_at = n, head["saved_at"]
+    return conv
+
+
+def save_session(st):
+    """ニックネーム・フラグと、会話の前回から増えた分を共有状態に書く（1ターンに1回）"""
+    if "nickname" not in st.session_state:
+        return
+    conv = st.session_state.get("conversation")
+    if conv is not None:
+        pin_conversation(conv)  # 放置時の要約まで、タブが閉じても消さない
+    if not SESSION_RESUME:
+        return
+    shared, sid = get_shared_state(), session_id(st)
+    # context_window は裏の要約ワーカーも書き換えるので写しを取ってから
+    data = {k: (dict(v) if isinstance(v, dict) else v)
+            for k, v in ((k, st.session_state[k]) for k in SESSION_KEYS if k in st.session_state)}
+    if conv is not None:
+        data["conversation"] = _save_blocks(shared, sid, conv, time.time())  # 塊を書いてから見出し
+    shared.set("session", sid, data, ttl=SESSION_TTL)
+
+
+def restore_session(st, nickname) -> bool:
+    """
+    URL の ?sid= に対応するセッションが共有状態にあり、ニックネームも一致すれば session_state に戻して True。
+    sid だけでは戻さない（転送・共有されたリンクから他人の相談が見えないように）。
+    別のプロセスが書いた最新を読むため、手元のコピーは使わない。
+    """
+    if not SESSION_RESUME or not nickname:
+        return False
+    shared, sid = get_shared_state(), session_id(st)
+    data = shared.get("session", sid, fresh=True)
+    if not data:
+        return False
+    if data.get("nickname") != nickname:
+        new_session_id(st)  # 別の人のタブ。上書きしないよう、このタブは新しい ID で始める
+        return False
+    for k in SESSION_KEYS:
+        if k in data:
+            st.session_state[k] = data[k]
+    head = data.get("conversation")
+    if head:
+        conv = _load_blocks(shared, sid, head)
+        if conv is not None:
+            st.session_state["conversation"] = conv
+            register_conversation(nickname, conv, sid)
+    return True
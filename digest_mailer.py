@@ -0,0 +1,242 @@
+# digest_mailer.py — 要約をまとめて1通のダイジェストにし、SMTP接続を使い回して送る
+import os
+import atexit
+import queue
+import smtplib
+import threading
+import time
+from datetime import datetime
+from email.header import Header
+from email.mime.text import MIMEText
+
+DIGEST_BATCH_SIZE = int(os.getenv("DIGEST_BATCH_SIZE", "20"))             # 1通にまとめる最大件数
+DIGEST_FLUSH_INTERVAL = float(os.getenv("DIGEST_FLUSH_INTERVAL", "600"))  # 最初の1件から送信までの最長待ち（秒）
+DIGEST_QUEUE_MAX = int(os.getenv("DIGEST_QUEUE_MAX", "500"))              # 溜め込める上限（超えたら待たせる/断る）
+DIGEST_PUT_TIMEOUT = float(os.getenv("DIGEST_PUT_TIMEOUT", "0.5"))        # 満杯時に add() が待つ最長秒数
+DIGEST_IDLE_CLOSE = float(os.getenv("DIGEST_IDLE_CLOSE", "240"))          # これ以上使わなければ接続を閉じる（秒）
+DIGEST_RETRIES = int(os.getenv("DIGEST_RETRIES", "3"))                    # 1回の送信で試す回数（切断の張り直しは別）
+DIGEST_RETRY_BACKOFF = float(os.getenv("DIGEST_RETRY_BACKOFF", "2"))      # 再送までの待ち（秒、毎回2倍）
+DIGEST_REQUEUE_MAX = int(os.getenv("DIGEST_REQUEUE_MAX", "3"))            # 送れなかった要約を次の回に回す上限
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "20"))
+
+
+def smtp_settings():
+    """送信設定（環境変数は呼ばれた時点で読む）。Gmail なら 465/SSL が既定"""
+    port = int(os.getenv("SMTP_PORT", "465"))
+    return {
+        "host": os.getenv("SMTP_HOST", "smtp.gmail.com"),
+        "port": port,
+        "ssl": os.getenv("SMTP_SSL", "1" if port == 465 else "0") == "1",
+        "starttls": os.getenv("SMTP_STARTTLS", "1" if port == 587 else "0") == "1",
+        "user": os.getenv("GMAIL_FROM"),
+        "password": os.getenv("GMAIL_APP_PASSWORD"),
+        "sender": os.getenv("GMAIL_FROM"),
+        "recipient": os.getenv("RECIPIENT_EMAIL"),
+    }
+
+
+def mail_configured(settings=None):
+    s = settings or smtp_settings()
+    return bool(s["sender"] and s["recipient"])
+
+
+class DigestMailer:
+    """
+    add() で要約を積むと、batch_size 件たまるか flush_interval 秒たった時点で1通にまとめて送る。
+    - SMTP はログイン済みの接続を保持して使い回す（切れていたら張り直す）
+    - 拒否・接続エラーは retries 回まで間をあけて再送し、それでも駄目なら要約をキューに戻して次の回に回す
+    - キューが満杯なら add() は put_timeout 秒だけ待ち、それでも空かなければ False（バックプレッシャー）
+    - ローカルの SMTP スタブ（aiosmtpd 等）に向けるときは settings で host/port を渡し、ssl/starttls を切る
+    """
+
+    def __init__(self, settings=None, *, batch_size=DIGEST_BATCH_SIZE, flush_interval=DIGEST_FLUSH_INTERVAL,
+                 maxsize=DIGEST_QUEUE_MAX, put_timeout=DIGEST_PUT_TIMEOUT, idle_close=DIGEST_IDLE_CLOSE,
+                 retries=DIGEST_RETRIES, backoff=DIGEST_RETRY_BACKOFF, requeue_max=DIGEST_REQUEUE_MAX):
+        self.settings = settings or smtp_settings()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.idle_close = idle_close
+        self.retries = retries
+        self.backoff = backoff
+        self.requeue_max = requeue_max
+        self._items = queue.Queue(maxsize=maxsize)
+        self._smtp = None
+        self._last_used = 0.0
+        self._flush_now = threading.Event()
+        self._stop = threading.Event()
+        self._counts = {"queued": 0, "rejected": 0, "sent_items": 0, "sent_mails": 0,
+                        "failed_mails": 0, "retries": 0, "requeued_items": 0, "dropped_items": 0, "logins": 0}
+        self._thread = threading.Thread(target=self._loop, name="digest-mailer", daemon=True)
+        self._thread.start()
+
+    # ===== 受付 =====
+    def add(self, nickname, turns, summary) -> bool:
+        if self._stop.is_set():
+            return False
+        item = {"nickname": nickname or "", "turns": int(turns), "summary": summary,
+                "at": datetime.now().strftime("%Y-%m-%d %H:%M"), "tries": 0}
+        try:
+            self._items.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            self._counts["rejected"] += 1
+            return False
+        self._counts["queued"] += 1
+        if self._items.qsize() >= self.batch_size:
+            self._flush_now.set()
+        return True
+
+    def flush(self):
+        """溜まっている分をすぐ送る（送信はワーカースレッドで行う）"""
+        self._flush_now.set()
+
+    # ===== ワーカー =====
+    def _loop(self):
+        batch = []
+        first_at = None
+        while True:
+            timeout = self.flush_interval if first_at is None else max(0.0, first_at + self.flush_interval - time.monotonic())
+            try:
+                batch.append(self._items.get(timeout=min(timeout, 1.0)))
+                first_at = first_at or time.monotonic()
+            except queue.Empty:
+                pass
+
+            due = first_at is not None and time.monotonic() - first_at >= self.flush_interval
+            if batch and (len(batch) >= self.batch_size or due or self._flush_now.is_set()):
+                # まとめて取れる分は取ってから送る
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._items.get_nowait())
+                    except queue.Empty:
+                        break
+                if not self._send_digest(batch):
+                    self._requeue(batch)
+                    if not self._stop.is_set():
+                        self._flush_now.clear()  # 戻した分は次の回（flush_interval 後）に
+                batch, first_at = [], None
+                if self._items.empty():
+                    self._flush_now.clear()
+                continue
+
+            if self._stop.is_set() and self._items.empty():
+                break
+            if not batch:
+                self._flush_now.clear()
+            self._close_if_idle()
+        self._close()
+
+    # ===== 送信 =====
+    def _build(self, batch):
+        s = self.settings
+        lines = [f"要約ダイジェスト（{len(batch)}件）", ""]
+        for i, it in enumerate(batch, 1):
+            lines.append(f"■ {i}. {it['nickname'] or '(不明)'}（{it['turns']}発話 / {it['at']}）")
+            lines.append(it["summary"].strip())
+            lines.append("")
+        msg = MIMEText("\n".join(lines), "plain", "utf-8")
+        msg["Subject"] = Header(f"【女神メッセージBot】要約ダイジェスト {len(batch)}件", "utf-8")
+        msg["From"] = s["sender"]
+        msg["To"] = s["recipient"]
+        return msg
+
+    def _connect(self):
+        s = self.settings
+        if s["ssl"]:
+            smtp = smtplib.SMTP_SSL(s["host"], s["port"], timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(s["host"], s["port"], timeout=SMTP_TIMEOUT)
+            if s["starttls"]:
+                smtp.starttls()
+        if s["user"] and s["password"]:
+            smtp.login(s["user"], s["password"])
+            self._counts["logins"] += 1
+        return smtp
+
+    def _send_digest(self, batch):
+        msg = self._build(batch)
+        attempt = reconnects = 0
+        while True:
+            try:
+                if self._smtp is None:
+                    self._smtp = self._connect()
+                self._smtp.sendmail(self.settings["sender"], [self.settings["recipient"]], msg.as_string())
+                self._last_used = time.monotonic()
+                self._counts["sent_mails"] += 1
+                self._counts["sent_items"] += len(batch)
+                return True
+            except smtplib.SMTPServerDisconnected:
+                # 使い回していた接続がサーバ側で切られていた → 張り直してすぐ1回だけ再送
+                self._close()
+                reconnects += 1
+                if reconnects == 1:
+                    continue
+            except (smtplib.SMTPException, OSError):
+                # 拒否（4xx/5xx）・接続エラー。接続の状態が分からないので閉じてから間をあけて再送
+                self._close()
+            attempt += 1
+            if attempt >= self.retries:
+                break
+            self._counts["retries"] += 1
+            self._stop.wait(self.backoff * (2 ** (attempt - 1)))  # 終了処理中は待たずに試し切る
+        self._counts["failed_mails"] += 1
+        return False
+
+    def _requeue(self, batch):
+        """送れなかった要約をキューに戻す（requeue_max 回まで。満杯なら諦める）"""
+        for it in batch:
+            it["tries"] += 1
+            if it["tries"] > self.requeue_max:
+                self._counts["dropped_items"] += 1
+                continue
+            try:
+                self._items.put_nowait(it)
+                self._counts["requeued_items"] += 1
+            except queue.Full:
+                self._counts["dropped_items"] += 1
+
+    def _close_if_idle(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > self.idle_close:
+            self._close()
+
+    def _close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            pass
+        self._smtp = None
+
+    # ===== 終了処理・可視化 =====
+    def shutdown(self, timeout=30.0):
+        """受付を止め、残りを送り切って接続を閉じる"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._flush_now.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        s = dict(self._counts)
+        s["queue_depth"] = self._items.qsize()
+        s["connected"] = self._smtp is not None
+        return s
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_digest_mailer():
+    """プロセス共有のメーラー。送信元/送信先が未設定なら None"""
+    global _mailer
+    if _mailer is None:
+        with _mailer_lock:
+            if _mailer is None:
+                settings = smtp_settings()
+                if not mail_configured(settings):
+                    return None
+                _mailer = DigestMailer(settings)
+                atexit.register(_mailer.shutdown)
+    return _mailer
@@ -0,0 +1,117 @@
+# fewshot_index.py — few-shot の例（user→assistant の組）から、今の相談に近いものだけを選ぶ検索索引
+import os
+import math
+import re
+import unicodedata
+from collections import Counter
+
+from context_window import estimate_tokens, MSG_OVERHEAD
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+FEWSHOT_TOP_K = int(os.getenv("FEWSHOT_TOP_K", "4"))                  # 1回に入れる例の数（組）
+FEWSHOT_TOKEN_BUDGET = int(os.getenv("FEWSHOT_TOKEN_BUDGET", "800"))  # 例に使ってよい概算トークン
+NGRAM_SIZES = (2, 3)  # 日本語は単語に切らず文字 2-gram / 3-gram で見る
+
+
+def _normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", "", text)
+
+
+def char_ngrams(text):
+    s = _normalize(text)
+    grams = []
+    for n in NGRAM_SIZES:
+        grams.extend(s[i:i + n] for i in range(len(s) - n + 1))
+    if not grams and s:
+        grams.append(s)  # 1文字だけの相談
+    return grams
+
+
+def pairs_from_shots(shots):
+    """[{"role","content"}, ...] から (user, assistant) の組を取り出す（組にならないものは捨てる）"""
+    pairs = []
+    for a, b in zip(shots, shots[1:]):
+        if a["role"] == "user" and b["role"] == "assistant":
+            pairs.append((a, b))
+    return pairs
+
+
+class FewshotIndex:
+    """
+    user 側の文字 n-gram TF-IDF（1+log(tf)、L2 正規化）を語ごとの転置リストで持つ。
+    - postings_ptr[t]:postings_ptr[t+1] が語 t を含む例の番号と重み（NumPy 配列）
+    - 検索は相談文に出てくる語の転置リストだけを足し合わせる（例が 1 万件でも数ミリ秒）
+    """
+
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+        self.costs = [sum(estimate_tokens(m["content"]) + MSG_OVERHEAD for m in p) for p in self.pairs]
+        vocab = {}
+        rows, cols, tfs = [], [], []
+        for doc, (user, _) in enumerate(self.pairs):
+            for gram, tf in Counter(char_ngrams(user["content"])).items():
+                rows.append(doc)
+                cols.append(vocab.setdefault(gram, len(vocab)))
+                tfs.append(1.0 + math.log(tf))
+        self.vocab = vocab
+        n_docs, n_terms = len(self.pairs), len(vocab)
+
+        docs = np.asarray(rows, dtype=np.int32)
+        terms = np.asarray(cols, dtype=np.int32)
+        df = np.bincount(terms, minlength=n_terms)
+        self.idf = (np.log((1.0 + n_docs) / (1.0 + df)) + 1.0).astype(np.float32)
+        weights = np.asarray(tfs, dtype=np.float32) * self.idf[terms]
+        norms = np.sqrt(np.bincount(docs, weights=weights * weights, minlength=n_docs)).astype(np.float32)
+        weights /= np.maximum(norms[docs], 1e-12)
+
+        order = np.argsort(terms, kind="stable")
+        self.postings_doc = docs[order]
+        self.postings_weight = weights[order]
+        self.postings_ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=self.postings_ptr[1:])
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def scores(self, query):
+        """各例との cos 類似度（相談側は長さで割らなくても順位は同じなので省く）"""
+        out = np.zeros(len(self.pairs), dtype=np.float32)
+        for gram, tf in Counter(char_ngrams(query)).items():
+            t = self.vocab.get(gram)
+            if t is None:
+                continue
+            lo, hi = self.postings_ptr[t], self.postings_ptr[t + 1]
+            out[self.postings_doc[lo:hi]] += (1.0 + math.log(tf)) * self.idf[t] * self.postings_weight[lo:hi]
+        return out
+
+    def select(self, query, k=FEWSHOT_TOP_K, budget=FEWSHOT_TOKEN_BUDGET):
+        """
+        近い順に最大 k 組、合計が budget に収まる分だけ選び、messages の形で返す。
+        近いものほど後ろ（相談文の直前）に置く。どれも似ていなければ先頭から選ぶ。
+        """
+        if not self.pairs or k <= 0:
+            return []
+        if len(self.pairs) <= k and sum(self.costs) <= budget:
+            return [m for p in self.pairs for m in p]  # 少ないうちは全部（元の順番のまま）
+
+        scores = self.scores(query)
+        hits = np.flatnonzero(scores > 0)
+        if len(hits) == 0:
+            ranked = list(range(len(self.pairs)))
+        else:
+            if len(hits) > k * 4:
+                hits = hits[np.argpartition(-scores[hits], k * 4 - 1)[:k * 4]]  # 予算で落ちる分の余裕を見て多めに
+            ranked = hits[np.argsort(-scores[hits], kind="stable")].tolist()
+
+        chosen, used = [], 0
+        for i in ranked:
+            if used + self.costs[i] > budget:
+                continue
+            chosen.append(i)
+            used += self.costs[i]
+            if len(chosen) >= k:
+                break
+        return [m for i in reversed(chosen) for m in self.pairs[i]]
@@ -0,0 +1,181 @@
+# idle_reaper.py — 放置されたセッションを定期的に拾い、まとめて要約→保存する（ユーザーの操作は待たせない）
+import os
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from conversation_state import live_conversations, unpin_conversation, claim_turns, release_turns
+from metrics import observe, span
+import usage_meter
+
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "600"))              # 最後の発話からこれだけ経ったら放置扱い（秒）
+IDLE_SCAN_INTERVAL = float(os.getenv("IDLE_SCAN_INTERVAL", "30"))   # 見回りの間隔（秒）
+IDLE_BATCH_SIZE = int(os.getenv("IDLE_BATCH_SIZE", "20"))           # 1回の insert にまとめる件数
+IDLE_WORKERS = int(os.getenv("IDLE_WORKERS", "2"))                  # 要約（LLM）を同時に回す数
+IDLE_MIN_TURNS = int(os.getenv("IDLE_MIN_TURNS", "1"))              # これ未満の新しい発話しか無ければ拾わない
+
+
+class IdleReaper:
+    """
+    - scan(): 放置され、まだ要約していない発話があるセッションを「取り置き」する
+      （conv.reaped_turns をその場で進めるので、同じ発話を二度拾わない。定期要約で回した分も拾わない）
+    - 取り置いた分を batch_size ずつ、workers 本で要約し、1回の insert でまとめて保存
+    - 保存に失敗したバッチは取り置きを戻し、次の見回りでやり直す
+    - 同じタブの会話が別のレプリカにも残っている（つなぎ直した）ときは、共有状態の印で片方だけが拾う
+    - タブが閉じた会話も、要約し終えるまでは台帳が持っている（conversation_state の _pinned）
+    """
+
+    def __init__(self, *, timeout=IDLE_TIMEOUT, interval=IDLE_SCAN_INTERVAL, batch_size=IDLE_BATCH_SIZE,
+                 workers=IDLE_WORKERS, min_turns=IDLE_MIN_TURNS, summarize=None, insert=None,
+                 commit=None, notify=None, enabled=None):
+        if None in (summarize, insert, commit, notify, enabled):
+            import summary_mailer
+            summarize = summarize or summary_mailer.incremental_summary_row
+            insert = insert or summary_mailer._insert_summaries
+            commit = commit or summary_mailer.mark_summarized
+            notify = notify or summary_mailer.queue_summary_mail
+            enabled = enabled or (lambda: summary_mailer._supabase_client() is not None)
+        self._summarize = summarize
+        self._insert = insert
+        self._commit = commit    # 保存できた要約を「ここまで要約済み」として記録
+        self._notify = notify    # ダイジェストメールへ回す
+        self._enabled = enabled  # 保存先が無いときは拾わない（要約の LLM 代を無駄にしない）
+        self.timeout = timeout
+        self.interval = interval
+        self.batch_size = batch_size
+        self.min_turns = min_turns
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="idle-summary")
+        self._claim_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counts = {"scans": 0, "claimed": 0, "stored": 0, "failed": 0, "batches": 0}
+        self._stat_lock = threading.Lock()
+
+    # ===== 見回り =====
+    def scan(self, now=None):
+        """放置セッションを取り置く。返り値: [(conv, nickname, since, upto), ...]"""
+        now = time.time() if now is None else now
+        claimed = []
+        with self._claim_lock:
+            for conv in live_conversations(now):
+                if not conv.nickname or now - conv.last_activity < self.timeout:
+                    continue
+                since, upto = conv.reaped_turns, conv.user_turns
+                if upto - since < self.min_turns:
+                    unpin_conversation(conv)  # 拾うものが無い（タブが生きていればまた発話で持ち直す）
+                    continue
+                since = claim_turns(conv, upto)
+                if since is None:
+                    continue  # 定期要約かほかのレプリカが拾った
+                claimed.append((conv, conv.nickname, since, upto))
+        self._count("scans")
+        self._count("claimed", len(claimed))
+        return claimed
+
+    @staticmethod
+    def _release(job):
+        conv, _, since, upto = job
+        release_turns(conv, since, upto)
+
+    def _unpin(self, job):
+        conv, _, _, upto = job
+        with self._claim_lock:
+            if conv.user_turns <= upto:
+                unpin_conversation(conv)  # 要約し終えた（その後に発話があれば持ったまま）
+
+    def _summarize_one(self, job):
+        conv, nickname, since, upto = job
+        with usage_meter.attribute(nickname):
+            row, _ = self._summarize(nickname, conv, since=since, upto=upto)
+        return row
+
+    def run_once(self, now=None):
+        """1回分の見回り→要約→保存。保存できた件数を返す"""
+        if not self._enabled():
+            return 0
+        jobs = self.scan(now)
+        stored = 0
+        for i in range(0, len(jobs), self.batch_size):
+            stored += self._process(jobs[i:i + self.batch_size])
+        return stored
+
+    def _process(self, batch):
+        t0 = time.perf_counter()
+        rows, done = [], []
+        for job, fut in [(job, self._pool.submit(self._summarize_one, job)) for job in batch]:
+            try:
+                row = fut.result()
+            except Exception:
+                self._release(job)
+                self._count("failed")
+                continue
+            if row is not None:
+                rows.append(row)
+                done.append(job)
+        if not rows:
+            return 0
+        try:
+            with span("idle_reaper.insert"):
+                self._insert(rows)
+        except Exception:
+            for job in done:
+                self._release(job)
+            self._count("failed", len(rows))
+            return 0
+        for job, row in zip(done, rows):
+            self._commit(job[0], row["turns"], row["summary"])
+            self._unpin(job)
+            try:
+                self._notify(row["nickname"], row["turns"], row["summary"])
+            except Exception:
+                pass
+        self._count("stored", len(rows))
+        self._count("batches")
+        observe("idle_reaper.batch", time.perf_counter() - t0)
+        return len(rows)
+
+    # ===== スレッド =====
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                pass
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="idle-reaper", daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._pool.shutdown(wait=False)
+
+    def _count(self, key, n=1):
+        with self._stat_lock:
+            self._counts[key] += n
+
+    def stats(self):
+        with self._stat_lock:
+            return dict(self._counts)
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def start_idle_reaper():
+    """プロセスで一度だけ見回りを始める（何度呼んでもよい）。IDLE_TIMEOUT=0 なら何もしない"""
+    global _reaper
+    if IDLE_TIMEOUT <= 0:
+        return None
+    if _reaper is None:
+        with _reaper_lock:
+            if _reaper is None:
+                _reaper = IdleReaper().start()
+                atexit.register(_reaper.shutdown)
+    return _reaper
@@ -0,0 +1,62 @@
+# lazy.py — 重い依存（pandas / openai / supabase / PIL / tiktoken）は最初に使うときまで import しない
+import importlib
+import threading
+
+_lock = threading.RLock()  # import 中に別の lazy_import が走っても詰まらないように
+_modules = {}
+
+
+class LazyModule:
+    """
+    属性に初めて触れたときに import するモジュールの代理。
+    入っていないモジュールは、そのとき ImportError（available() で先に確かめられる）。
+    """
+
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+        object.__setattr__(self, "_missing", None)  # import に失敗したときのメッセージ（毎回探しに行かない）
+
+    def _load(self):
+        mod = self._module
+        if mod is None:
+            with _lock:
+                mod = self._module
+                if mod is None:
+                    if self._missing is not None:
+                        raise ImportError(self._missing, name=self._name)
+                    try:
+                        mod = importlib.import_module(self._name)
+                    except ImportError as e:
+                        # 例外そのものは持たない（traceback が最初の呼び出し元のフレームと変数を掴み続ける）
+                        object.__setattr__(self, "_missing", str(e))
+                        raise
+                    object.__setattr__(self, "_module", mod)
+        return mod
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def available(self):
+        """import できるか（まだなら、ここで import する）"""
+        try:
+            self._load()
+            return True
+        except ImportError:
+            return False
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{' (loaded)' if self.loaded else ''}>"
+
+
+def lazy_import(name):
+    """import name の代わり。同じ名前には同じ代理を返す"""
+    with _lock:
+        mod = _modules.get(name)
+        if mod is None:
+            mod = _modules[name] = LazyModule(name)
+    return mod
@@ -0,0 +1,262 @@
+# llm_gateway.py — チャットと要約で共有する OpenAI の出入口（接続プール・期限・再試行・サーキットブレーカー）
+import os
+import random
+import threading
+import time
+
+from admission import admission, AdmissionTimeout  # AdmissionTimeout は呼び出し側が捕まえる用に再公開
+from context_window import messages_tokens, estimate_tokens
+from metrics import observe
+from lazy import lazy_import
+import usage_meter
+
+openai = lazy_import("openai")  # SDK の import はクライアントを作るときまで待つ
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))                  # 1回の呼び出し全体の期限（秒）
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))   # 接続確立の期限（秒）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))             # 一時的なエラーの再試行回数
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "0.5"))           # バックオフの初期値（秒）
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))
+LLM_KEEPALIVE = int(os.getenv("LLM_KEEPALIVE", "20"))
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))       # 連続失敗でブレーカーを開く
+BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))          # 開いてから試しに1回通すまでの秒数
+LLM_COMPLETION_ESTIMATE = int(os.getenv("LLM_COMPLETION_ESTIMATE", "500"))  # max_tokens 未指定時の返信トークン見積もり
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "1") == "1"  # ストリームの最後に usage を付けてもらう（非対応の互換APIなら 0）
+
+FALLBACK_REPLY = "（デモ応答）運命はいつでもあなたの味方です🌙 小さな喜びを選ぶと、流れは自然と整っていきます。"
+
+
+class LLMUnavailable(Exception):
+    """ブレーカーが開いている / 再試行しても応答が得られない"""
+
+
+# ===== サーキットブレーカー =====
+class CircuitBreaker:
+    """closed → 連続 failures 回失敗で open → reset 秒後に half-open（1件だけ通す）→ 成功で closed"""
+
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.state = "closed"
+        self._count = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset:
+                self.state = "half-open"
+                self._trial = False
+            if self.state == "half-open" and not self._trial:
+                self._trial = True
+                return "trial"  # 試しの1件（結果を記録しないまま終わるなら end_trial() を呼ぶ）
+            return False
+
+    def end_trial(self):
+        """half-open の試し1件が成功とも失敗とも記録されずに終わったとき（次の1件を通せるように）"""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._count = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._count += 1
+            if self.state == "half-open" or self._count >= self.failures:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+breaker = CircuitBreaker()
+
+
+# ===== クライアント（プロセスで1つ） =====
+_lock = threading.Lock()
+_state = {"client": None, "override": None}
+
+
+def _http_client():
+    """SDK 既定の httpx クライアントを、プールと期限を調整して作る"""
+    httpx = lazy_import("httpx")
+    return openai.DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_KEEPALIVE),
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    )
+
+
+def get_client():
+    """共有 OpenAI クライアント。APIキーや SDK が無ければ None（= デモモード）"""
+    client = _state["client"]
+    if client is not None:
+        return client
+    override = _state["override"] or {}
+    api_key = override.get("api_key") or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    with _lock:
+        if _state["client"] is None:
+            if not openai.available():
+                return None
+            kwargs = {"api_key": api_key, "max_retries": 0, "http_client": _http_client()}
+            base_url = override.get("base_url") or os.getenv("OPENAI_BASE_URL")
+            if base_url:
+                kwargs["base_url"] = base_url
+            _state["client"] = openai.OpenAI(**kwargs)
+        return _state["client"]
+
+
+def configure(api_key=None, base_url=None):
+    """接続先を差し替える（ローカルのモックサーバに向けるテスト用）。引数なしで環境変数に戻す"""
+    with _lock:
+        _state["override"] = {"api_key": api_key, "base_url": base_url} if (api_key or base_url) else None
+        _state["client"] = None
+    breaker.record_success()
+
+
+def available():
+    return get_client() is not None
+
+
+# ===== 再試行 =====
+def is_transient(exc):
+    """時間をおけば通りそうなエラーか（タイムアウト・接続断・429・5xx）"""
+    if not openai.loaded:
+        return False  # SDK を読み込む前に起きた例外は SDK 由来ではない
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError,
+                        openai.RateLimitError, openai.InternalServerError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    return status in (408, 409, 429) or (status is not None and status >= 500)
+
+
+def _backoff(attempt):
+    delay = LLM_RETRY_BASE * (2 ** attempt)
+    return delay / 2 + random.random() * delay / 2  # ジッタ付き
+
+
+def _call(create_kwargs, *, deadline, kind, tokens=0):
+    """
+    期限内で再試行しながら create を呼ぶ。ブレーカーが開いていれば即 LLMUnavailable。
+    呼び出しごとに admission の枠を取り、成功したら枠を持ったまま返す（呼び出し側で admission.release()）。
+    再試行までの待ちの間は枠を手放し、他の呼び出しを通す。
+    """
+    client = get_client()
+    if client is None:
+        raise LLMUnavailable("OpenAI未設定")
+    start = end = None
+    last = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        allowed = breaker.allow()
+        if not allowed:
+            raise LLMUnavailable("LLMバックエンド停止中（ブレーカー開）")
+        try:
+            if start is None:
+                admission.acquire(kind, tokens)  # 最初の順番待ちは期限に含めない
+                start = time.monotonic()
+                end = start + deadline
+            else:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    admission.acquire(kind, tokens, max_wait=remaining)
+                except AdmissionTimeout:
+                    break
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                admission.release()
+                break
+            try:
+                result = client.chat.completions.create(timeout=remaining, **create_kwargs)
+            except Exception as e:
+                admission.release()
+                last = e
+                if not is_transient(e):
+                    breaker.record_success()  # 入力起因のエラーで止めない
+                    raise
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # 応答が返った時点で成功（ストリームを最後まで読むかは呼び出し側次第）
+                return result
+        finally:
+            if allowed == "trial":
+                breaker.end_trial()  # 順番待ちの期限切れなどで成否が付かなくても、試しの枠を残さない
+        observe(f"llm.{kind}.retry", time.monotonic() - start)
+        wait = _backoff(attempt)
+        if attempt == LLM_MAX_RETRIES or time.monotonic() + wait >= end:
+            break
+        time.sleep(wait)
+    raise LLMUnavailable(f"LLM応答なし: {last}")
+
+
+# ===== 公開API =====
+def _estimate(messages, max_tokens):
+    """TPM の見積もり（送る分の概算 + 返ってくる分の上限/目安）"""
+    return messages_tokens(messages) + (max_tokens or LLM_COMPLETION_ESTIMATE)
+
+
+def chat(messages, *, model, temperature=0.7, max_tokens=None, deadline=LLM_TIMEOUT, kind="chat"):
+    """非ストリーミング。返信テキストを返す（失敗時は例外）。混雑時は admission で順番待ち"""
+    kwargs = {"model": model, "messages": messages, "temperature": temperature}
+    if max_tokens:
+        kwargs["max_tokens"] = max_tokens
+    start = time.monotonic()
+    resp = _call(kwargs, deadline=deadline, kind=kind, tokens=_estimate(messages, max_tokens))
+    admission.release()
+    text = resp.choices[0].message.content.strip()
+    usage_meter.record(kind=kind, model=model, usage=getattr(resp, "usage", None),
+                       latency=time.monotonic() - start,
+                       estimate=lambda: (messages_tokens(messages), estimate_tokens(text)))
+    return text
+
+
+def stream_chat(messages, *, model, temperature=0.7, deadline=LLM_TIMEOUT, kind="chat",
+                fallback=FALLBACK_REPLY):
+    """
+    ストリーミング。差分テキストを yield する。
+    - 再試行するのは呼び出し（create）が失敗したときだけ（途中で切れたものは再試行しない＝二重表示を避ける）
+    - バックエンド不調（ブレーカー開・再試行切れ）のときは fallback をそのまま返す
+    - 順番待ちが上限を超えたら AdmissionTimeout（呼び出し側でエラー表示）
+    """
+    kwargs = {"model": model, "messages": messages, "temperature": temperature, "stream": True}
+    if LLM_STREAM_USAGE:
+        kwargs["stream_options"] = {"include_usage": True}  # 最後のチャンク（choices が空）に usage が載る
+    received = False
+    start = time.monotonic()
+    usage, parts = None, []
+    try:
+        # 枠はストリームを読み終えるまで持ち続ける（同時実行数は「生成中の本数」）
+        stream = _call(kwargs, deadline=deadline, kind=kind, tokens=_estimate(messages, None))
+        try:
+            for event in stream:
+                if getattr(event, "usage", None) is not None:
+                    usage = event.usage
+                if not event.choices:
+                    continue
+                delta = event.choices[0].delta.content
+                if delta:
+                    received = True
+                    parts.append(delta)
+                    yield delta
+        finally:
+            admission.release()
+    except LLMUnavailable:
+        if fallback is None:
+            raise
+        yield fallback
+        return
+    except Exception as e:
+        if is_transient(e):
+            breaker.record_failure()
+        raise
+    if received:
+        usage_meter.record(kind=kind, model=model, usage=usage, latency=time.monotonic() - start,
+                           estimate=lambda: (messages_tokens(messages), estimate_tokens("".join(parts))))
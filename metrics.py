@@ -0,0 +1,170 @@
+# metrics.py — 区間計測（span）をプロセス内で集計し、p50/p95/p99 を Prometheus 形式 / JSON ログで出す
+import os
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))                   # >0 なら /metrics を別ポートで公開
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "0"))  # >0 なら N 秒ごとに JSON を1行ログ
+METRICS_RESERVOIR = int(os.getenv("METRICS_RESERVOIR", "2048"))      # 分位点計算に使う直近サンプル数
+QUANTILES = (0.5, 0.95, 0.99)
+
+log = logging.getLogger("metrics")
+
+
+class _Series:
+    __slots__ = ("count", "total", "max", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=METRICS_RESERVOIR)
+
+
+_lock = threading.Lock()
+_series = {}
+_errors = {}
+
+
+def observe(name, seconds):
+    """1サンプル記録（秒）。ロック内は数個の代入だけ"""
+    with _lock:
+        s = _series.get(name)
+        if s is None:
+            s = _series[name] = _Series()
+        s.count += 1
+        s.total += seconds
+        if seconds > s.max:
+            s.max = seconds
+        s.samples.append(seconds)
+
+
+@contextmanager
+def span(name):
+    """with span("llm.chat"): ...  例外が出ても時間は記録し、エラー件数も数える"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # st.rerun / st.stop の制御用例外はエラーに数えない
+        if not type(e).__name__.endswith(("RerunException", "StopException")):
+            with _lock:
+                _errors[name] = _errors.get(name, 0) + 1
+        raise
+    finally:
+        observe(name, time.perf_counter() - t0)
+
+
+def timed(name):
+    """関数デコレータ版の span"""
+    def deco(func):
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return deco
+
+
+# ===== 集計 =====
+def _quantile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+def snapshot():
+    """{name: {count, sum, max, p50, p95, p99, errors}}（秒）"""
+    with _lock:
+        items = [(n, s.count, s.total, s.max, list(s.samples)) for n, s in _series.items()]
+        errors = dict(_errors)
+    out = {}
+    for name, count, total, mx, samples in items:
+        samples.sort()
+        row = {"count": count, "sum": round(total, 6), "max": round(mx, 6), "errors": errors.get(name, 0)}
+        for q in QUANTILES:
+            row[f"p{int(q * 100)}"] = round(_quantile(samples, q), 6)
+        out[name] = row
+    return out
+
+
+def export_prometheus():
+    """Prometheus テキスト形式（summary 型）"""
+    lines = [
+        "# HELP app_span_seconds Time spent in instrumented spans.",
+        "# TYPE app_span_seconds summary",
+    ]
+    snap = snapshot()
+    for name in sorted(snap):
+        row = snap[name]
+        for q in QUANTILES:
+            lines.append(f'app_span_seconds{{span="{name}",quantile="{q}"}} {row[f"p{int(q * 100)}"]}')
+        lines.append(f'app_span_seconds_sum{{span="{name}"}} {row["sum"]}')
+        lines.append(f'app_span_seconds_count{{span="{name}"}} {row["count"]}')
+    lines.append("# TYPE app_span_errors_total counter")
+    for name in sorted(snap):
+        lines.append(f'app_span_errors_total{{span="{name}"}} {snap[name]["errors"]}')
+    return "\n".join(lines) + "\n"
+
+
+# ===== 出力（任意） =====
+_started = {"exporter": False}
+
+
+def _serve(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/metrics.json"):
+                self.send_error(404)
+                return
+            if self.path.startswith("/metrics.json"):
+                body, ctype = json.dumps(snapshot()).encode(), "application/json"
+            else:
+                body, ctype = export_prometheus().encode(), "text/plain; version=0.0.4"
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+
+def _log_loop(interval):
+    while True:
+        time.sleep(interval)
+        log.info(json.dumps({"ts": time.time(), "spans": snapshot()}, ensure_ascii=False))
+
+
+def start_exporter(port=METRICS_PORT, log_interval=METRICS_LOG_INTERVAL):
+    """環境変数で有効化されたときだけ、プロセスで一度だけ出力を始める（何度呼んでもよい）"""
+    if _started["exporter"]:
+        return
+    with _lock:
+        if _started["exporter"]:
+            return
+        _started["exporter"] = True
+    if port:
+        try:
+            _serve(port)
+        except OSError as e:
+            log.warning("metrics exporter not started on port %s: %s", port, e)
+    if log_interval:
+        if not log.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s metrics %(message)s"))
+            log.addHandler(handler)
+            log.setLevel(logging.INFO)
+        threading.Thread(target=_log_loop, args=(log_interval,), name="metrics-log", daemon=True).start()
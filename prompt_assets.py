@@ -0,0 +1,141 @@
+# prompt_assets.py — style_mother.txt / few-shot をプロセスで一度だけ読み、mtime が変わったら読み直す
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+
+from fewshot_index import FewshotIndex, pairs_from_shots
+from metrics import span
+
+APP_DIR = Path(__file__).parent
+
+STYLE_CANDIDATES = ["style_mother.txt", "_style_mother.txt", "＿style_mother.txt"]  # 半角/全角/先頭アンダーバー
+FEWSHOT_CANDIDATES = ["examples_mother.jsonl", "example_mother.jsonl"]
+DEFAULT_STYLE = "あなたは優しく包み込むように話すAIです。"
+PROMPT_CHECK_INTERVAL = float(os.getenv("PROMPT_CHECK_INTERVAL", "2.0"))  # mtime 確認の最短間隔（秒）
+
+log = logging.getLogger("prompt_assets")
+
+_lock = threading.Lock()
+_cache = {"key": None, "checked_at": 0.0, "assets": None}
+
+
+def _pick_first_exist(cands):
+    for p in cands:
+        p = APP_DIR / p
+        if p.exists():
+            return p
+    return None
+
+
+# ===== パーサ（app.py の旧 load_style / load_fewshot 相当） =====
+def load_style(path):
+    if not path:
+        return ""  # 無くても動く
+    return path.read_text(encoding="utf-8").strip()
+
+
+def _shot(obj):
+    role = obj.get("role")
+    content = (obj.get("content") or "").strip()
+    if role in ("user", "assistant") and content:
+        return {"role": role, "content": content}
+    return None
+
+
+def load_fewshot(path, issues):
+    """JSONL（正式）/ 配列JSON のどちらでも読む。問題のある行は issues に積んでスキップ"""
+    shots = []
+    if not path:
+        return shots
+
+    buf = path.read_text(encoding="utf-8").strip()
+    # 誤って配列JSONで保存しても読めるように
+    if buf.startswith("["):
+        try:
+            for obj in json.loads(buf):
+                shot = _shot(obj)
+                if shot:
+                    shots.append(shot)
+        except Exception as e:
+            issues.append(f"{path.name} の解析に失敗: {e}")
+        return shots
+
+    # 正式: JSONL（1行=1JSON）
+    for lineno, line in enumerate(buf.splitlines(), 1):
+        s = line.strip()
+        if not s:
+            continue
+        try:
+            shot = _shot(json.loads(s))
+        except Exception as e:
+            issues.append(f"{path.name}:{lineno} JSONエラー: {e}")
+            continue
+        if shot:
+            shots.append(shot)
+        else:
+            issues.append(f"{path.name}:{lineno} 不正（role/content）→スキップ")
+    return shots
+
+
+# ===== キャッシュ =====
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime if path else None
+    except OSError:
+        return None
+
+
+def _build(style_path, fewshot_path):
+    issues = []
+    style = load_style(style_path) or DEFAULT_STYLE
+    fewshot = load_fewshot(fewshot_path, issues)
+    prefix = [{"role": "system", "content": style}] + fewshot
+    version = hashlib.sha1(json.dumps(prefix, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+    # 素材の問題は運用者向け。読み直したとき（版ごと）に一度だけログへ出し、チャット画面には出さない
+    for issue in issues:
+        log.warning("prompt assets %s: %s", version, issue)
+    return {
+        "style": style,
+        "fewshot": fewshot,
+        "prefix": prefix,      # system + few-shot 全部（版数の計算用。送るときは prefix_for で絞る）
+        "index": FewshotIndex(pairs_from_shots(fewshot)),  # 相談に近い例を選ぶ索引（読み込み時に一度だけ作る）
+        "version": version,    # ペルソナ版数（キャッシュキー等に使う）
+        "issues": issues,
+    }
+
+
+def get_prompt_assets():
+    """
+    プロセス共有のプロンプト素材を返す（全セッション共通・読み取り専用で使うこと）。
+    ファイルの mtime が変わったときだけ読み直すので、再起動なしでペルソナを差し替えられる。
+    """
+    now = time.monotonic()
+    if _cache["assets"] is not None and now - _cache["checked_at"] < PROMPT_CHECK_INTERVAL:
+        return _cache["assets"]
+
+    with _lock:
+        style_path = _pick_first_exist(STYLE_CANDIDATES)
+        fewshot_path = _pick_first_exist(FEWSHOT_CANDIDATES)
+        key = (style_path, _mtime(style_path), fewshot_path, _mtime(fewshot_path))
+        if key != _cache["key"] or _cache["assets"] is None:
+            _cache["assets"] = _build(style_path, fewshot_path)
+            _cache["key"] = key
+        _cache["checked_at"] = now
+        return _cache["assets"]
+
+
+def get_prompt_prefix():
+    """system + few-shot のメッセージ列（呼び出し側で書き換えないこと）"""
+    return get_prompt_assets()["prefix"]
+
+
+def prefix_for(query, assets=None):
+    """system + 今の相談（query）に近い few-shot だけ（上限は FEWSHOT_TOP_K 組 / FEWSHOT_TOKEN_BUDGET）"""
+    assets = assets or get_prompt_assets()
+    with span("prompt.fewshot_select"):
+        shots = assets["index"].select(query)
+    return [{"role": "system", "content": assets["style"]}] + shots
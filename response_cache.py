@@ -0,0 +1,135 @@
+# response_cache.py — 初回の定番質問（「流れを整えたい」等）への返信をプロセスで共有して使い回す
+import os
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from shared_state import get_shared_state
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))   # 保持する件数（LRU）
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "21600"))  # 有効期限（秒）既定6時間
+RESPONSE_CACHE_MAX_PROMPT = int(os.getenv("RESPONSE_CACHE_MAX_PROMPT", "80"))  # これより長い相談は個別性が高いので対象外
+
+_WS = re.compile(r"\s+")
+_TRAIL = re.compile(r"[。．.!！?？〜~…・、,\s]+$")
+
+
+def normalize_prompt(text):
+    """全角/半角（NFKC）・空白・末尾の句読点や記号のゆれを吸収したキー文字列"""
+    s = unicodedata.normalize("NFKC", text or "")
+    s = _WS.sub(" ", s).strip().lower()
+    return _TRAIL.sub("", s)
+
+
+def cacheable_prompt(messages):
+    """
+    キャッシュしてよい会話ならユーザー発話を返す（だめなら None）。
+    - ユーザー発話がこの1件だけ（= 初回の相談）で、それ以前はこちらの挨拶だけ
+    - 短い定番の相談だけ（長文は個別事情が入るので対象外）
+    挨拶にはニックネームが入るので、キャッシュ対象の問い合わせは挨拶を含めずに送ること。
+    """
+    if not messages or messages[-1]["role"] != "user":
+        return None
+    # 後ろから見て、ほかにユーザー発話があれば初回ではない（長い会話でも早く抜ける）
+    for i in range(len(messages) - 2, -1, -1):
+        if messages[i]["role"] == "user":
+            return None
+    prompt = messages[-1]["content"]
+    if len(normalize_prompt(prompt)) > RESPONSE_CACHE_MAX_PROMPT:
+        return None
+    return prompt
+
+
+class ResponseCache:
+    """
+    LRU + TTL。キーは（ペルソナ版数, モデル, 正規化した相談文）だけで、ユーザー固有の情報を含めない。
+    shared を渡すと、手元に無いときは共有状態を見て、作った返信は共有状態にも書く（ほかのレプリカでも当たる）。
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self._data = OrderedDict()   # key -> (reply, stored_at, gen_seconds)
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "misses": 0, "shared_hits": 0, "stores": 0, "evictions": 0,
+                        "saved_seconds": 0.0}
+
+    @staticmethod
+    def key(persona_version, model, prompt):
+        return (persona_version, model, normalize_prompt(prompt))
+
+    @staticmethod
+    def _shared_key(key):
+        return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _from_shared(self, key, now):
+        if self.shared is None:
+            return None
+        hit = self.shared.get("reply", self._shared_key(key))
+        if not hit or now - hit[1] > self.ttl:
+            return None
+        reply, stored_at, gen_seconds = hit
+        with self._lock:
+            self._store(key, (reply, stored_at, gen_seconds))
+            self._counts["shared_hits"] += 1
+        return reply, stored_at, gen_seconds
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is not None and now - hit[1] > self.ttl:
+                del self._data[key]
+                hit = None
+        if hit is None:
+            hit = self._from_shared(key, now)
+        with self._lock:
+            if hit is None:
+                self._counts["misses"] += 1
+                return None
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._counts["hits"] += 1
+            self._counts["saved_seconds"] += hit[2]
+            return hit[0]
+
+    def _store(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._counts["evictions"] += 1
+
+    def put(self, key, reply, gen_seconds=0.0):
+        entry = (reply, time.time(), gen_seconds)
+        with self._lock:
+            self._store(key, entry)
+            self._counts["stores"] += 1
+        if self.shared is not None:
+            self.shared.set("reply", self._shared_key(key), list(entry), ttl=self.ttl)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counts)
+            s["size"] = len(self._data)
+        lookups = s["hits"] + s["misses"]
+        s["hit_rate"] = s["hits"] / lookups if lookups else 0.0
+        return s
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(shared=get_shared_state())
+    return _cache
@@ -0,0 +1,281 @@
+# shared_state.py — 複数プロセス（レプリカ）で共有する小さな状態。手元にコピーを持ち、書き込みは保存先にも同時に
+import os
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lazy import lazy_import
+from metrics import span
+
+redis = lazy_import("redis")  # SHARED_STATE_BACKEND=redis のときだけ
+
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "sqlite")  # sqlite / redis / memory（プロセス内だけ）
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "data", "shared_state.sqlite3"))
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "morie:")           # Redis のキーの頭（他のアプリと混ざらないように）
+SHARED_STATE_LOCAL_TTL = float(os.getenv("SHARED_STATE_LOCAL_TTL", "2"))  # 手元のコピーを保存先に確かめずに使う秒数
+SHARED_STATE_LOCAL_MAX = int(os.getenv("SHARED_STATE_LOCAL_MAX", "4096"))  # 手元に持つ件数（LRU）
+SHARED_STATE_PURGE_EVERY = 500  # SQLite: これだけ書いたら期限切れをまとめて消す
+
+
+# ===== 保存先（値は JSON 文字列。ttl は秒、None なら無期限） =====
+class MemoryBackend:
+    """プロセス内だけ（レプリカ1つのとき・テスト用）"""
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+
+    def _alive(self, key, now):
+        hit = self._data.get(key)
+        if hit is None:
+            return None
+        if hit[1] is not None and hit[1] <= now:
+            del self._data[key]
+            return None
+        return hit
+
+    def get(self, key):
+        with self._lock:
+            hit = self._alive(key, time.time())
+            return hit[0] if hit else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            if self._alive(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteBackend:
+    """同じホスト（または共有ボリューム）上のレプリカ同士で共有する SQLite（WAL）。スレッドごとの接続で"""
+
+    def __init__(self, path=SHARED_STATE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0
+        with self._conn() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS shared_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL)""")
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _wrote(self, db):
+        self._writes += 1
+        if self._writes % SHARED_STATE_PURGE_EVERY == 0:
+            db.execute("DELETE FROM shared_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def set(self, key, value, ttl=None):
+        with self._conn() as db:
+            db.execute("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                       (key, value, time.time() + ttl if ttl else None))
+            self._wrote(db)
+
+    def add(self, key, value, ttl=None):
+        """無い（か期限切れ）ときだけ書く。1文で済ませるのでプロセスをまたいでも1回だけ True"""
+        now = time.time()
+        with self._conn() as db:
+            cur = db.execute(
+                """INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                   WHERE shared_state.expires_at IS NOT NULL AND shared_state.expires_at <= ?""",
+                (key, value, now + ttl if ttl else None, now))
+            self._wrote(db)
+            return cur.rowcount == 1
+
+    def delete(self, key):
+        with self._conn() as db:
+            db.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+
+class RedisBackend:
+    """Redis 互換（Redis / Valkey / KeyDB など）。ホストをまたいでレプリカを並べるとき"""
+
+    def __init__(self, url=SHARED_STATE_URL, prefix=SHARED_STATE_PREFIX):
+        self.client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=2.0)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+# ===== 本体 =====
+_MISSING = object()
+
+
+class SharedState:
+    """
+    名前空間つきの小さな KV。値は JSON にできるもの。
+    - 読み: 手元のコピーが local_ttl 秒以内なら保存先に行かない（ホットパスはメモリだけ）
+    - 書き: 保存先に書いてから手元も更新（write-through）
+    - add(): 無いときだけ書いて True（「一度だけ」の印。常に保存先で判定する）
+    保存先が落ちていても例外は出さず、手元のコピーだけで動き続ける（errors に数える）。
+    """
+
+    def __init__(self, backend=None, *, local_ttl=SHARED_STATE_LOCAL_TTL, local_max=SHARED_STATE_LOCAL_MAX):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.local_ttl = local_ttl
+        self.local_max = local_max
+        self._local = OrderedDict()  # key -> (value, checked_at)
+        self._lock = threading.Lock()
+        self._counts = {"local_hits": 0, "reads": 0, "writes": 0, "errors": 0}
+
+    @staticmethod
+    def _key(ns, key):
+        return f"{ns}:{key}"
+
+    def _remember(self, k, value):
+        with self._lock:
+            self._local[k] = (value, time.monotonic())
+            self._local.move_to_end(k)
+            while len(self._local) > self.local_max:
+                self._local.popitem(last=False)
+
+    def _forget(self, k):
+        with self._lock:
+            self._local.pop(k, None)
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def get(self, ns, key, default=None, *, fresh=False):
+        """値（無ければ default）。fresh=True なら手元のコピーを使わず保存先を見る"""
+        k = self._key(ns, key)
+        with self._lock:
+            hit = self._local.get(k)
+            if hit is not None and not fresh and time.monotonic() - hit[1] < self.local_ttl:
+                self._local.move_to_end(k)
+                self._counts["local_hits"] += 1
+                return default if hit[0] is _MISSING else hit[0]
+        try:
+            with span("shared_state.get"):
+                raw = self.backend.get(k)
+        except Exception:
+            self._count("errors")
+            if hit is None or hit[0] is _MISSING:
+                return default
+            return hit[0]  # 古くても手元の値で続ける
+        self._count("reads")
+        value = _MISSING if raw is None else json.loads(raw)
+        self._remember(k, value)  # 無かったことも覚えておく（同じキーを何度も見に行かない）
+        return default if value is _MISSING else value
+
+    def set(self, ns, key, value, ttl=None):
+        k = self._key(ns, key)
+        raw = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        try:
+            with span("shared_state.set"):
+                self.backend.set(k, raw, ttl)
+            self._count("writes")
+        except Exception:
+            self._count("errors")
+        self._remember(k, value)
+
+    def add(self, ns, key, value=1, ttl=None) -> bool:
+        """まだ無ければ書いて True。すでにあれば False（レプリカをまたいで一度だけ）"""
+        k = self._key(ns, key)
+        raw = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        try:
+            with span("shared_state.add"):
+                ok = self.backend.add(k, raw, ttl)
+            self._count("writes")
+        except Exception:
+            # 保存先が使えないときはこのプロセスの中でだけ一度きりを守る
+            self._count("errors")
+            with self._lock:
+                hit = self._local.get(k)
+                if hit is not None and hit[0] is not _MISSING:
+                    return False
+                self._local[k] = (value, float("inf"))
+            return True
+        if ok:
+            self._remember(k, value)
+        else:
+            self._forget(k)
+        return ok
+
+    def delete(self, ns, key):
+        k = self._key(ns, key)
+        try:
+            self.backend.delete(k)
+            self._count("writes")
+        except Exception:
+            self._count("errors")
+        self._forget(k)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counts)
+            s["local_size"] = len(self._local)
+        s["backend"] = type(self.backend).__name__
+        return s
+
+
+def _make_backend(name):
+    if name == "redis":
+        return RedisBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    return MemoryBackend()
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_shared_state():
+    """プロセス共有の SharedState（保存先が作れなければプロセス内だけで動く）"""
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                try:
+                    backend = _make_backend(SHARED_STATE_BACKEND)
+                except Exception:
+                    backend = MemoryBackend()
+                _state = SharedState(backend)
+    return _state
+
+
+def once(ns, key, ttl=None) -> bool:
+    """ns/key の処理をまだ誰もしていなければ True（呼んだ側がやる）"""
+    return get_shared_state().add(ns, key, ttl=ttl)
@@ -0,0 +1,172 @@
+# stylesheet.py — styles/app.css を1枚にまとめ（同じセレクタで上書きされる宣言を除去・圧縮）、内容ハッシュ付きで配信する
+import os
+import re
+import posixpath
+import hashlib
+import threading
+
+import assets
+
+STYLE_SRC = assets.APP_DIR / "styles" / "app.css"
+BG_PLACEHOLDER = "__BG_IMAGE__"
+CSS_URL_DIR = "app/static/_cache"  # 書き出した CSS の URL 上の置き場
+
+_lock = threading.Lock()
+_built = {}    # (src mtime, bg_url) -> {"css", "hash"}
+_written = set()
+_stats = {"source_bytes": 0, "built_bytes": 0, "dropped_declarations": 0}
+
+
+# ===== 解析 =====
+def _split_top(text, sep):
+    """括弧・引用符の外にある sep で分割"""
+    parts, buf, depth, quote = [], [], 0, None
+    for ch in text:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append("".join(buf))
+            buf = []
+            continue
+        buf.append(ch)
+    parts.append("".join(buf))
+    return parts
+
+
+def parse(text):
+    """[(selectors, [(prop, value, important)]), ...]。対応の取れない } は読み飛ばす"""
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    rules = []
+    pos = 0
+    while True:
+        open_ = text.find("{", pos)
+        if open_ < 0:
+            break
+        close = text.find("}", open_)
+        if close < 0:
+            break
+        prelude = text[pos:open_].replace("}", " ")  # 余分な } は捨てる
+        selectors = tuple(s for s in (_min_selector(x) for x in _split_top(prelude, ",")) if s)
+        decls = []
+        for d in _split_top(text[open_ + 1:close], ";"):
+            if ":" not in d:
+                continue
+            prop, value = d.split(":", 1)
+            value = value.strip()
+            important = value.lower().endswith("!important")
+            if important:
+                value = value[: -len("!important")].rstrip()
+            decls.append((prop.strip().lower(), _min_value(value), important))
+        if selectors and decls:
+            rules.append((selectors, decls))
+        pos = close + 1
+    return rules
+
+
+def _min_selector(sel):
+    sel = re.sub(r"\s+", " ", sel.strip())
+    return re.sub(r"\s*([>+~])\s*", r"\1", sel)
+
+
+def _min_value(value):
+    value = re.sub(r"\s+", " ", value)
+    return re.sub(r"\s*,\s*", ",", value)
+
+
+# ===== 重複除去 =====
+def dedupe(rules):
+    """
+    同じセレクタ・同じプロパティで後から上書きされる宣言を消す（!important の強弱も考える）。
+    別のセレクタ同士は詳細度が絡むので触らない。ルールの順番も変えない。
+    """
+    winner = {}  # (selector, prop) -> (index, important)
+    flat = [(i, sel, prop, imp) for i, (sels, decls) in enumerate(rules)
+            for sel in sels for prop, _, imp in decls]
+    for i, sel, prop, imp in flat:
+        cur = winner.get((sel, prop))
+        if cur is None or imp or not cur[1]:
+            winner[(sel, prop)] = (i, imp)
+
+    out, dropped = [], 0
+    for i, (sels, decls) in enumerate(rules):
+        seen = {}
+        for prop, value, imp in decls:
+            seen[prop] = (value, imp) if (imp or prop not in seen or not seen[prop][1]) else seen[prop]
+        kept = []
+        for prop, (value, imp) in seen.items():
+            if any(winner[(sel, prop)][0] == i for sel in sels):
+                kept.append((prop, value, imp))
+        dropped += len(decls) - len(kept)
+        if kept:
+            out.append((sels, kept))
+    return out, dropped
+
+
+def minify(rules):
+    return "".join(
+        ",".join(sels) + "{" + ";".join(f"{p}:{v}{'!important' if imp else ''}" for p, v, imp in decls) + "}"
+        for sels, decls in rules
+    )
+
+
+# ===== ビルド =====
+def build(bg_url=""):
+    """背景 URL を埋めた圧縮済み CSS と内容ハッシュ。ソースが変わったときだけ作り直す"""
+    mtime = os.stat(STYLE_SRC).st_mtime
+    key = (mtime, bg_url)
+    hit = _built.get(key)
+    if hit:
+        return hit
+    with _lock:
+        source = STYLE_SRC.read_text(encoding="utf-8")
+        rules, dropped = dedupe(parse(source))
+        css = minify(rules).replace(BG_PLACEHOLDER, f"url('{bg_url}')" if bg_url else "none")
+        hit = {"css": css, "hash": hashlib.sha1(css.encode("utf-8")).hexdigest()[:10]}
+        _built.clear()
+        _built[key] = hit
+        _stats.update(source_bytes=len(source.encode("utf-8")), built_bytes=len(css.encode("utf-8")),
+                      dropped_declarations=dropped)
+        return hit
+
+
+def _publish(built):
+    """static/_cache/app.<hash>.css に書き出して、その URL を返す"""
+    name = f"app.{built['hash']}.css"
+    if name not in _written:
+        path = assets.CACHE_DIR / name
+        if not path.exists():
+            assets.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(built["css"], encoding="utf-8")
+            os.replace(tmp, path)
+        _written.add(name)
+    return f"{CSS_URL_DIR}/{name}"
+
+
+def style_tag(bg_path=None):
+    """
+    ページに置く <style>。
+    - 静的配信が有効なら @import だけ（本体はハッシュ付き URL でブラウザがキャッシュ）
+    - 無効なら圧縮済み CSS をインラインで
+    """
+    static = assets.static_serving_enabled()
+    bg_url = assets.css_url(bg_path, assets.BG_MAX_WIDTH) if bg_path else ""
+    if static:
+        # CSS ファイル内の url() はファイルの場所（app/static/_cache/）からの相対になる
+        rel = posixpath.relpath(bg_url, CSS_URL_DIR) if bg_url.startswith("app/static/") else bg_url
+        try:
+            return f'<style>@import url("{_publish(build(rel))}");</style>'
+        except OSError:
+            pass  # 書き出せないときはインラインで
+    return f"<style>{build(bg_url)['css']}</style>"
+
+
+def stats():
+    return dict(_stats)
@@ -0,0 +1,195 @@
+# summary_export.py — summaries テーブルをページ送りで読みながら CSV / JSONL に書き出す（表が大きくてもメモリは一定）
+#
+#   python -m summary_export --out dumps/summaries.csv
+#   python -m summary_export --format jsonl --gzip --transcript --out dumps/summaries-$(date +%F).jsonl.gz
+#   python -m summary_export --nickname みすず --out -            # 標準出力へ
+import os
+import argparse
+import csv
+import io
+import json
+import sys
+import tempfile
+import time
+import zlib
+
+from metrics import span
+from supabase_pool import get_supabase_client
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))          # 1回の select で取る件数
+EXPORT_COLUMNS = ("id", "nickname", "created_at", "turns", "summary")  # 既定で出す列（transcript は指定したときだけ）
+EXPORT_TMP_DIR = os.path.join(tempfile.gettempdir(), "summary_export")  # 管理者ダウンロード用の一時ファイル置き場
+EXPORT_TMP_TTL = float(os.getenv("EXPORT_TMP_TTL", "3600"))           # これより古い一時ファイルは次の書き出しで消す（秒）
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+# ===== 読み出し（keyset ページング） =====
+def keyset_filter(cursor) -> str:
+    """(created_at, id) より古い行。値に : や + が入るので PostgREST 用にダブルクォートで囲む"""
+    created_at, row_id = cursor
+    return f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}")'
+
+
+def query_page(sb, columns, limit, nickname=None, cursor=None):
+    """
+    新しい順に limit 件。cursor は前ページ最後の (created_at, id)。失敗は例外のまま返す。
+    返り値: (rows, next_cursor)  次が無ければ next_cursor は None
+    """
+    q = (sb.table("summaries").select(columns)
+         .order("created_at", desc=True).order("id", desc=True)
+         .limit(limit + 1))  # 1件多く取って「次があるか」を判定
+    if nickname:
+        q = q.eq("nickname", nickname)
+    if cursor:
+        q = q.or_(keyset_filter(cursor))
+    with span("supabase.select"):
+        rows = q.execute().data or []
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]["created_at"], rows[-1]["id"])
+
+
+def _select_columns(columns):
+    # 次のページの位置に created_at と id が要るので、出さない列でも取る
+    return ",".join(dict.fromkeys([*columns, "created_at", "id"]))
+
+
+def iter_pages(columns=EXPORT_COLUMNS, *, nickname=None, page_size=EXPORT_PAGE_SIZE, sb=None):
+    """1ページずつ rows を返すジェネレータ（手元に置くのは常に1ページ分だけ）"""
+    sb = sb or get_supabase_client()
+    if sb is None:
+        raise RuntimeError("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY）")
+    select, cursor = _select_columns(columns), None
+    while True:
+        rows, cursor = query_page(sb, select, page_size, nickname, cursor)
+        if rows:
+            yield rows
+        if cursor is None:
+            return
+
+
+# ===== 書式 =====
+def _csv_chunks(pages, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(columns)
+    for rows in pages:
+        writer.writerows([("" if r.get(c) is None else r.get(c)) for c in columns] for r in rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()  # 行が1件も無いときのヘッダ
+
+
+def _jsonl_chunks(pages, columns):
+    for rows in pages:
+        yield "".join(json.dumps({c: r.get(c) for c in columns}, ensure_ascii=False) + "\n" for r in rows)
+
+
+def iter_export(fmt="csv", *, columns=EXPORT_COLUMNS, gzip=False, pages=None, **query):
+    """
+    CSV / JSONL を bytes の塊で返すジェネレータ（1ページごとに1塊）。gzip=True なら .gz の中身をそのまま。
+    pages を渡さなければ Supabase から iter_pages(**query) で読む。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format: {fmt}")
+    columns = list(columns)
+    pages = iter_pages(columns, **query) if pages is None else pages
+    chunks = (_csv_chunks if fmt == "csv" else _jsonl_chunks)(pages, columns)
+    if not gzip:
+        for text in chunks:
+            yield text.encode("utf-8")
+        return
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 → gzip 形式
+    for text in chunks:
+        out = z.compress(text.encode("utf-8"))
+        if out:
+            yield out
+    yield z.flush()
+
+
+def write_export(fp, fmt="csv", **kwargs) -> int:
+    """バイナリのファイルに書き出す。返り値は書いたバイト数"""
+    size = 0
+    for chunk in iter_export(fmt, **kwargs):
+        fp.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def file_name(fmt, gzip=False, nickname=None):
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    base = f"summaries-{nickname}-{stamp}" if nickname else f"summaries-{stamp}"
+    return f"{base}.{fmt}" + (".gz" if gzip else "")
+
+
+def mime_type(fmt, gzip=False):
+    return "application/gzip" if gzip else FORMATS[fmt]
+
+
+# ===== 管理者パネル用（一時ファイルに書いてから渡す） =====
+def _prune_tmp(now=None):
+    now = time.time() if now is None else now
+    try:
+        names = os.listdir(EXPORT_TMP_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(EXPORT_TMP_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > EXPORT_TMP_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def export_to_tempfile(fmt="csv", **kwargs) -> str:
+    """書き出した一時ファイルのパス。失敗したら途中のファイルを消して例外をそのまま上げる"""
+    os.makedirs(EXPORT_TMP_DIR, exist_ok=True)
+    _prune_tmp()
+    fd, path = tempfile.mkstemp(dir=EXPORT_TMP_DIR, suffix=f".{fmt}")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            write_export(fp, fmt, **kwargs)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+# ===== CLI =====
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Supabase の summaries を CSV / JSONL に書き出す")
+    ap.add_argument("--format", choices=sorted(FORMATS), default="csv", help="出力形式")
+    ap.add_argument("--gzip", action="store_true", help="gzip で圧縮する")
+    ap.add_argument("--nickname", default=None, help="このニックネームの行だけ")
+    ap.add_argument("--columns", default=",".join(EXPORT_COLUMNS), help="出す列（カンマ区切り）")
+    ap.add_argument("--transcript", action="store_true", help="transcript 列も出す")
+    ap.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE, help="1回の select で取る件数")
+    ap.add_argument("--out", default=None, help="保存先（- で標準出力。省略時は日時入りの名前でカレントに）")
+    args = ap.parse_args(argv)
+
+    columns = [c.strip() for c in args.columns.split(",") if c.strip()]
+    if args.transcript and "transcript" not in columns:
+        columns.append("transcript")
+    kwargs = {"columns": columns, "gzip": args.gzip, "nickname": args.nickname, "page_size": args.page_size}
+    out = args.out or file_name(args.format, args.gzip, args.nickname)
+    if out == "-":
+        write_export(sys.stdout.buffer, args.format, **kwargs)
+        return
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    tmp = out + ".part"
+    try:
+        with open(tmp, "wb") as fp:
+            size = write_export(fp, args.format, **kwargs)
+    except BaseException:
+        os.remove(tmp)  # 途中で落ちても中途半端なファイルを残さない
+        raise
+    os.replace(tmp, out)
+    print(f"{out}: {size} bytes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,19 @@
 # summary_mailer.py
-import os, smtplib, textwrap, base64
-from email.mime.text import MIMEText
+import os, hmac, threading
 from typing import Tuple
 from typing import Optional
 import streamlit as st
-import pandas as pd
-from datetime import datetime
+from supabase_pool import get_supabase_client
+from conversation_state import (get_conversation, find_conversation, save_session, restore_session,
+                                claim_turns, release_turns, SESSION_TTL)
+from shared_state import get_shared_state
+from conversation_log import load_recent
+from metrics import span, timed
+import llm_gateway
+import usage_meter
+import summary_export
 
 
-# --- OpenAIは“あれば使う”オプション ---
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
-
 # ===== 環境変数 =====
 GMAIL_FROM = os.getenv("GMAIL_FROM")                  # 送信元（あなたのGmail）
 GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD")  # アプリパスワード
@@ -21,39 +21,49 @@ RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")        # 受信先（もりえみ
 BOOKING_URL = os.getenv("BOOKING_URL", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")                # 未設定なら .env / Secrets([ADMIN] TOKEN) を見る。どれも無ければ管理者ログイン不可
 
 
 
 def _supabase_client():
-    # .env と Secrets の両対応
-    try:
-        from dotenv import load_dotenv
-        load_dotenv()
-    except Exception:
-        pass
-    url = os.getenv("SUPABASE_URL") or st.secrets.get("SUPABASE", {}).get("URL")
-    key = os.getenv("SUPABASE_ANON_KEY") or st.secrets.get("SUPABASE", {}).get("ANON_KEY")
-    if not url or not key:
-        return None
-    from supabase import create_client
-    return create_client(url, key)
+    # プロセス共有のクライアント（未設定なら None）。接続・設定読み込みは初回だけ
+    return get_supabase_client()
 
-def fetch_summaries_from_supabase(limit: int = 100, nickname: Optional[str] = None):
-    """Supabase から要約一覧を取得。失敗時は空配列を返す。"""
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "20"))
+ADMIN_LIST_COLUMNS = "id,nickname,created_at,summary"  # 一覧に出す列だけ（transcript は開いたときに取る）
+
+
+def fetch_summaries_page(limit: int = ADMIN_PAGE_SIZE, nickname: Optional[str] = None,
+                         cursor: Optional[Tuple[str, str]] = None):
+    """
+    要約一覧を1ページ分だけ取得（新しい順）。cursor は前ページ最後の (created_at, id)。
+    OFFSET を使わないので、表が大きくなっても後ろのページが遅くならない。
+    返り値: (rows, next_cursor)  次が無ければ next_cursor は None。失敗時は ([], None)
+    """
     sb = _supabase_client()
     if not sb:
         st.warning("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY または Secrets）")
-        return []
+        return [], None
     try:
-        q = sb.table("summaries").select("*").order("created_at", desc=True).limit(limit)
-        if nickname:
-            q = q.eq("nickname", nickname)
-        res = q.execute()
-        return res.data or []
+        return summary_export.query_page(sb, ADMIN_LIST_COLUMNS, limit, nickname, cursor)
     except Exception as e:
         st.warning(f"Supabase 取得失敗: {e}")
-        return []
+        return [], None
+
+
+def fetch_transcript(summary_id) -> str:
+    """1件分の会話ログ（transcript 列だけ）を取得。失敗時は空文字。"""
+    sb = _supabase_client()
+    if not sb:
+        return ""
+    try:
+        with span("supabase.select"):
+            res = sb.table("summaries").select("transcript").eq("id", summary_id).limit(1).execute()
+        rows = res.data or []
+        return (rows[0].get("transcript") or "") if rows else ""
+    except Exception as e:
+        st.warning(f"会話ログの取得失敗: {e}")
+        return ""
 
 
 def delete_summary_from_supabase(summary_id: str):
@@ -62,26 +72,40 @@ def delete_summary_from_supabase(summary_id: str):
         st.error("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY または Secrets）")
         return False
     try:
-        sb.table("summaries").delete().eq("id", summary_id).execute()
+        with span("supabase.delete"):
+            sb.table("summaries").delete().eq("id", summary_id).execute()
         return True
     except Exception as e:
         st.error(f"削除失敗: {e}")
         return False
 
 
-def save_summary_to_supabase(*, nickname: str, turns: int, summary: str, transcript: str) -> bool:
-    """要約を Supabase に保存。成功 True / 失敗 False。"""
+def _summary_row(*, nickname: str, turns: int, summary: str, transcript: str) -> dict:
+    return {
+        "nickname": nickname or "",
+        "turns": int(turns),
+        "summary": summary,
+        "transcript": transcript
+    }
+
+
+def _insert_summaries(rows) -> None:
+    """UIを触らない保存（バックグラウンド用）。未設定・失敗は例外で返す。"""
     sb = _supabase_client()
     if not sb:
-        st.error("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY または Secrets）")
+        raise RuntimeError("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY）")
+    with span("supabase.insert"):
+        sb.table("summaries").insert(list(rows)).execute()
+
+
+def save_summary_to_supabase(*, nickname: str, turns: int, summary: str, transcript: str) -> bool:
+    """要約を Supabase に保存。成功 True / 失敗 False。"""
+    if not _supabase_client():
+        st.error("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY）")
         return False
     try:
-        sb.table("summaries").insert({
-            "nickname": nickname or "",
-            "turns": int(turns),
-            "summary": summary,
-            "transcript": transcript
-        }).execute()
+        _insert_summaries([_summary_row(nickname=nickname, turns=turns,
+                                        summary=summary, transcript=transcript)])
         return True
     except Exception as e:
         st.error(f"Supabase 保存失敗: {e}")
@@ -95,44 +119,211 @@ def summarize_and_store(messages, nickname: str, turns: int) -> str:
     summary, transcript = _summarize(messages)  # ←あなたの既存関数をそのまま利用
     ok = save_summary_to_supabase(nickname=nickname, turns=turns,
                                   summary=summary, transcript=transcript)
-    st.toast("Supabaseに保存しました" if ok else "Supabase保存に失敗", icon="✅" if ok else "⚠️")
+    if ok:
+        st.toast("Supabaseに保存しました", icon="✅")
+    else:
+        st.toast("Supabase保存に失敗", icon="⚠️")
     return summary
-_client = None
-if OPENAI_API_KEY and OpenAI:
-    _client = OpenAI(api_key=OPENAI_API_KEY)
 
 
-def _summarize(messages):
-    """st.session_state.messages を要約（OpenAIが無ければ簡易）。"""
+def queue_summary_mail(nickname: str, turns: int, summary: str) -> bool:
+    """要約をダイジェストメールの送信待ちに積む。メール未設定なら何もしない。"""
+    from digest_mailer import get_digest_mailer
+    mailer = get_digest_mailer()
+    if mailer is None:
+        return False
+    return mailer.add(nickname, turns, summary)
+
+
+def summarize_and_store_async(conv, nickname: str, turns: int) -> bool:
+    """
+    定期要約のバックグラウンド版。前回の要約（定期・放置時の見回りどちらでも）より後のターンだけを
+    取り置いてワーカーに任せ、すぐ返る。保存できたら mark_summarized() で記録が進む。
+    Supabase 未設定なら積まずに False（要約のLLM呼び出しを無駄にしない）。
+    """
+    if not _supabase_client():
+        return False
+    since = claim_turns(conv, turns)
+    if since is None:
+        return False  # 新しいターンが無い・ほかのレプリカが拾った
+    from summary_queue import get_summary_queue
+    if get_summary_queue().submit(conv, nickname, since, turns):
+        return True
+    release_turns(conv, since, turns)  # 受け付けられなかった分は見回りに任せる
+    return False
+
+
+SUMMARY_WINDOW = 40  # 1回の要約に渡す件数（これより多い新着は複数回に分けて畳み込む）
+
+
+@timed("summary.summarize")
+def _summarize(messages, prev_summary: str = "", raise_errors: bool = False):
+    """
+    会話（dict のリスト / ConversationState）を要約（OpenAIが無ければ簡易）。
+    prev_summary があれば「これまでの要約＋新しい会話」を1つの要約にまとめ直す。
+    raise_errors=True なら失敗時に例外のまま返す（失敗文を要約として使われたくないとき）。
+    """
     lines = []
-    for m in messages[-40:]:  # 直近40件だけ見る
+    for m in messages[-SUMMARY_WINDOW:]:  # 直近40件だけ見る
         role = "ユーザー" if m["role"] == "user" else "Bot"
         lines.append(f"{role}: {m['content']}")
     transcript = "\n".join(lines)
 
-    if not _client:
+    if not llm_gateway.available():
         # 簡易サマリ：先頭抜粋
         head = "\n".join(lines[:12])
         return f"【簡易要約（APIキー未設定）】\n{head}\n…（続く）", transcript
 
-    prompt = f"""以下は会話ログです。日本語で：
+    if prev_summary:
+        prompt = f"""以下は「これまでの要約」と、その後の新しい会話ログです。両方を踏まえて日本語で：
+1) 重要ポイントを箇条書きで5つ以内（古い内容は必要なものだけ残す）
+2) 次の一歩を3つ提案
+--- これまでの要約 ---
+{prev_summary}
+--- 新しい会話ログ ---
+{transcript}
+"""
+    else:
+        prompt = f"""以下は会話ログです。日本語で：
 1) 重要ポイントを箇条書きで5つ以内
 2) 次の一歩を3つ提案
 ---
 {transcript}
 """
     try:
-        r = _client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role":"user","content":prompt}],
-            max_tokens=400,
-            temperature=0.4
-        )
-        summary = r.choices[0].message.content.strip()
+        # チャットと同じゲートウェイ（接続プール・期限・再試行・ブレーカー）を通す
+        with span("llm.summary"):
+            summary = llm_gateway.chat(
+                [{"role":"user","content":prompt}],
+                model=OPENAI_MODEL,
+                max_tokens=400,
+                temperature=0.4,
+                kind="summary"
+            )
         return summary, transcript
     except Exception as e:
+        if raise_errors:
+            raise
         return f"（要約失敗: {e}）\n\n{transcript}", transcript
 
+
+# ===== ユーザーごとの差分要約 =====
+# セッション -> [そのセッションで要約済みのユーザー発話数, 最新の要約] は共有状態の "summary_progress" に、
+# nickname -> 最新の要約 は "summary_latest" に置く（レプリカ間で同じ値）。
+# 発話数はセッションごとの数え方なので、別のセッション（再訪・別タブ）の値とは比べない。
+_progress_lock = threading.Lock()
+_user_locks = {}
+
+
+def _user_lock(nickname):
+    with _progress_lock:
+        return _user_locks.setdefault(nickname, threading.Lock())
+
+
+def fetch_latest_summary(nickname: str) -> Tuple[int, str]:
+    """そのユーザーの最新の要約行から (turns, summary)。無い・取れないときは (0, "")"""
+    sb = _supabase_client()
+    if not sb or not nickname:
+        return 0, ""
+    try:
+        with span("supabase.select"):
+            res = (sb.table("summaries").select("turns,summary").eq("nickname", nickname)
+                   .order("created_at", desc=True).limit(1).execute())
+        rows = res.data or []
+    except Exception:
+        return 0, ""
+    if not rows:
+        return 0, ""
+    return int(rows[0].get("turns") or 0), rows[0].get("summary") or ""
+
+
+def _progress_key(conv):
+    # session_id の無い会話（テスト・古い形式）はこのプロセスの中だけで区別する
+    return conv.session_id or f"local:{id(conv)}"
+
+
+def _first_user_turns(messages, n):
+    """messages の先頭から n 回目のユーザー発話の返事まで"""
+    for i, m in enumerate(messages):
+        if m["role"] == "user":
+            if n == 0:
+                return messages[:i]
+            n -= 1
+    return messages
+
+
+def incremental_summary_row(nickname: str, conv, only_since_last: bool = True, since: Optional[int] = None,
+                            upto: Optional[int] = None):
+    """
+    前回の要約以降の新しいターンだけを要約した保存用の行を作る（保存はしない）。
+    「どこまで要約したか」はそのセッション（conv）の発話数で数える。新しいセッションは0発話目から、
+    そのユーザーの最新の要約を土台にまとめ直す。
+    since / upto を渡すと記録ではなくそのセッションの何発話目から何発話目までかで区切る（取り置き用）。
+    返り値: (row, summary)  新しいターンが無ければ row は None で summary は前回のもの。
+    保存できたら mark_summarized() で記録を進める。
+    """
+    turns = conv.user_turns if upto is None else min(upto, conv.user_turns)
+    shared = get_shared_state()
+    done, summary = 0, ""
+    if only_since_last:
+        progress = shared.get("summary_progress", _progress_key(conv))
+        if progress:
+            done, summary = progress
+        else:
+            done = conv.reaped_turns  # 読み戻した前回までの分は要約済み
+            summary = shared.get("summary_latest", nickname)
+            if summary is None:
+                summary = fetch_latest_summary(nickname)[1]
+                shared.set("summary_latest", nickname, summary, ttl=SESSION_TTL)
+    if since is not None:
+        done = since
+    if turns <= done:
+        return None, summary
+
+    new = conv.since_user_turn(done)
+    if turns < conv.user_turns:
+        new = _first_user_turns(new, turns - done)  # 取り置いた後に増えた発話は次の回に
+    transcripts = []
+    for i in range(0, len(new), SUMMARY_WINDOW):
+        summary, transcript = _summarize(new[i:i + SUMMARY_WINDOW], prev_summary=summary)
+        transcripts.append(transcript)
+    row = _summary_row(nickname=nickname, turns=turns, summary=summary, transcript="\n".join(transcripts))
+    return row, summary
+
+
+def mark_summarized(conv, turns: int, summary: str) -> None:
+    """conv のセッションを turns 発話目まで要約済みにする（ユーザーの最新の要約も更新）"""
+    shared = get_shared_state()
+    with _progress_lock:
+        shared.set("summary_progress", _progress_key(conv), [turns, summary], ttl=SESSION_TTL)
+        if conv.nickname:
+            shared.set("summary_latest", conv.nickname, summary, ttl=SESSION_TTL)
+
+
+def admin_summarize_user(nickname: str, only_since_last: bool = True) -> Optional[str]:
+    """
+    進行中の会話を要約して保存する（管理者パネル用）。返り値は最新の要約（会話が無ければ None）。
+    - only_since_last=True: 前回の要約＋それ以降の新しいターンだけを LLM に渡してまとめ直す
+      （どれだけ長く話しているユーザーでも1回のコストはほぼ一定）
+    - 新しいターンが無ければ LLM も保存も呼ばない（何度押しても同じ結果・無料）
+    """
+    nickname = (nickname or "").strip()
+    conv = find_conversation(nickname)
+    if conv is None:
+        return None
+    with _user_lock(nickname), usage_meter.attribute(nickname):
+        row, summary = incremental_summary_row(nickname, conv, only_since_last)
+        if row is None:
+            return summary
+        try:
+            _insert_summaries([row])
+        except Exception as e:
+            st.error(f"Supabase 保存失敗: {e}")
+            return summary
+        mark_summarized(conv, row["turns"], summary)
+        return summary
+
+
 def ensure_registration(st):
     """
     いまはニックネームだけ必須。登録完了後は rerun して即チャット画面へ。
@@ -140,7 +331,6 @@ def ensure_registration(st):
     # すでに登録済みなら何もしない
     if "nickname" in st.session_state:
         return
-
     # --- 登録フォーム ---
     with st.form("register"):
         st.subheader("🧍最初にニックネームだけ教えてね")
@@ -148,105 +338,199 @@ def ensure_registration(st):
         submitted = st.form_submit_button("はじめる")  # ← フォーム用のフラグは submitted で固定
 
     # --- フォーム直下に“目立たない”管理者ログイン ---
-    # with st.expander("管理者ログインはこちら", expanded=False):
-    #     admin_token = st.text_input("管理者トークン", type="password", key="adm_tok", placeholder="●●●●●")
-    #     if st.button("ログイン", key="adm_btn"):
-    #         # .envの値を優先
-    #         valid_token = ADMIN_TOKEN or (("ADMIN" in st.secrets) and st.secrets["ADMIN"].get("TOKEN"))
-    #         admin_ok = (admin_token == valid_token)
-    #         st.session_state["is_admin"] = bool(admin_ok)
-    #         st.success("管理者ログイン成功 ✅") if admin_ok else st.error("認証失敗 ❌")
+    if not st.session_state.get("is_admin"):
+        with st.expander("管理者ログインはこちら", expanded=False):
+            admin_token = st.text_input("管理者トークン", type="password", key="adm_tok", placeholder="●●●●●")
+            if st.button("ログイン", key="adm_btn"):
+                admin_ok = check_admin_token(admin_token)
+                st.session_state["is_admin"] = admin_ok
+                st.success("管理者ログイン成功 ✅") if admin_ok else st.error("認証失敗 ❌")
 
     # --- フォームの判定は管理者かどうかに関係なく実行する（←重要） ---
     if submitted:
         if nickname.strip():
+            # 同じタブ（?sid=）を別のレプリカ（や再起動前のプロセス）で使っていて、名前も同じなら続きから
+            if restore_session(st, nickname.strip()):
+                st.rerun()
             st.session_state["nickname"] = nickname.strip()
+            # 同じタブ（?sid=）で前に話していれば直近の会話だけ読み戻して続きから
+            history = load_recent(st, nickname.strip())
+            if history:
+                greeting = f"おかえりなさい、{nickname.strip()} さん✨前回の続きからどうぞ"
+            else:
+                greeting = f"{nickname.strip()} さん、どんなことでも相談してみて✨もりえみAIが答えるよ✨"
             # 初期メッセージが無ければ入れる
-            st.session_state.setdefault(
-                "messages",
-                [{"role": "assistant", "content": f"{nickname.strip()} さん、どんなことでも相談してみて✨もりえみAIが答えるよ✨"}]
-            )
+            get_conversation(st, greeting=greeting, history=history)
             st.session_state.setdefault("mail_sent", False)
+            save_session(st)
             st.rerun()  # 登録後に即進める
         else:
             st.warning("ニックネームを入れてください。")
 
-    # --- 管理者パネル（ログ閲覧/ダウンロード） ---
     # --- 管理者パネル（要約一覧：Supabase） ---
-    # if st.session_state.get("is_admin"):
-    #     st.divider()
-    #     st.subheader("📚 要約ログ（管理者専用）")
-    #
-    #     nick = st.text_input("ニックネームで絞り込み（任意）", key="adm_nick", placeholder="例: みすず")
-    #     limit = st.number_input("取得件数", min_value=10, max_value=500, value=50, step=10, key="adm_limit")
-    #     refresh = st.button("最新を取得", key="adm_refresh", use_container_width=True)
-    #     if (nick or "").strip():
-    #         # このニックでまだ自動要約を走らせていなければ実行
-    #         done_key = st.session_state.get("_adm_autosum_done_for")
-    #         if done_key != nick.strip():
-    #             st.info(f"🔄 {nick.strip()} の要約を作成しています…")
-    #             admin_summarize_user(nickname=nick.strip(), only_since_last=True)
-    #             st.session_state["_adm_autosum_done_for"] = nick.strip()
-    #             st.success(f"{nick.strip()} の最新要約を作成しました ✅")
-    #
-    #     if refresh or st.session_state.get("_adm_first", True):
-    #         rows = fetch_summaries_from_supabase(limit=int(limit), nickname=(nick or "").strip() or None)
-    #         st.session_state["_adm_rows"] = rows
-    #         st.session_state["_adm_first"] = False
-    #     else:
-    #         rows = st.session_state.get("_adm_rows", [])
-
-        # --- 💅 カード風UI ---
-        if not rows:
-            st.info("データがありません。")
-        else:
-            for row in rows:
-                nickname = row.get("nickname", "(不明)")
-                created = row.get("created_at", "日時不明")
-                summary = row.get("summary", "(要約なし)")
-                transcript = row.get("transcript", "")
-
-                st.markdown(
-                    f"""
-                    <div style="
-                        background:rgba(255,255,255,0.8);
-                        border:1px solid #ddd;
-                        border-radius:14px;
-                        padding:14px 20px;
-                        margin:10px 0;
-                        box-shadow:0 4px 12px rgba(160,130,255,0.12);
-                    ">
-                        <h4>👤 {nickname}</h4>
-                        <p style="font-size:13px;color:#666;">🕒 {created}</p>
-                        <p style="white-space:pre-wrap;">📝 {summary}</p>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-
-                with st.expander("💬 会話ログを見る"):
-                    st.text_area("全文", transcript or "(なし)", height=200)
-
-                if st.button(f"🗑️ この要約を削除", key=f"del_{row['id']}"):
-                    delete_summary_from_supabase(row['id'])
-                    st.success(f"{nickname} のログを削除しました ✅")
-                    st.rerun()
-
-            # ---- CSV ダウンロード（整形後の列で）----
-            buf = io.StringIO()
-            df[cols].to_csv(buf, index=False)
-            st.download_button(
-                "CSVをダウンロード",
-                buf.getvalue().encode("utf-8"),
-                file_name="summaries_admin.csv",
-                mime="text/csv"
-            )
+    if st.session_state.get("is_admin"):
+        render_admin_panel(st)
 
     # 未登録の間はここで止める（ガードはそのまま）
     st.stop()
 
 
+# ===== 管理者パネル =====
+def _admin_token():
+    # .env の値を優先（app.py の load_dotenv はこのモジュールの import 後なので呼ぶたびに読む）
+    token = ADMIN_TOKEN or os.getenv("ADMIN_TOKEN")
+    if token:
+        return token
+    try:
+        return st.secrets.get("ADMIN", {}).get("TOKEN")
+    except Exception:
+        return None  # secrets.toml が無い環境
+
+
+def check_admin_token(given) -> bool:
+    """管理者トークンの照合。トークン未設定のときは誰も通さない"""
+    token = _admin_token()
+    if not token or not given:
+        return False
+    return hmac.compare_digest(str(given).encode(), str(token).encode())
+
 
+def _lazy_expander(st, label, key):
+    """開いているときだけ中身を作る expander。返り値: (container, is_open)"""
+    try:
+        exp = st.expander(label, key=key, on_change="rerun")
+        return exp, bool(getattr(exp, "open", False))
+    except TypeError:
+        # 開閉状態が取れない古い Streamlit ではトグルで代用
+        return st.container(), st.toggle(label, key=key)
+
+
+def render_admin_panel(st):
+    """要約一覧（列を絞ってページ送り）。会話ログは開いたときに1件ずつ取りに行く"""
+    st.divider()
+    st.subheader("📚 要約ログ（管理者専用）")
+
+    nick = (st.text_input("ニックネームで絞り込み（任意）", key="adm_nick", placeholder="例: みすず") or "").strip()
+    limit = int(st.number_input("1ページの件数", min_value=10, max_value=100,
+                                value=ADMIN_PAGE_SIZE, step=10, key="adm_limit"))
+    refresh = st.button("最新を取得", key="adm_refresh", use_container_width=True)
+    if nick and st.session_state.get("_adm_autosum_done_for") != nick:
+        # このニックでまだ要約していなければ、前回以降の新しいターンだけ要約して保存
+        with st.spinner(f"🔄 {nick} の要約を作成しています…"):
+            latest = admin_summarize_user(nickname=nick, only_since_last=True)
+        st.session_state["_adm_autosum_done_for"] = nick
+        if latest is not None:
+            st.success(f"{nick} の最新要約を作成しました ✅")
+            refresh = True
+
+    # ページ位置: cursors[i] が i ページ目の開始位置（0ページ目は None）
+    query = (nick, limit)
+    if refresh or st.session_state.get("_adm_query") != query:
+        st.session_state["_adm_query"] = query
+        st.session_state["_adm_cursors"] = [None]
+        st.session_state.pop("_adm_page", None)
+    cursors = st.session_state["_adm_cursors"]
+
+    page = st.session_state.get("_adm_page")
+    if page is None:
+        rows, next_cursor = fetch_summaries_page(limit=limit, nickname=nick or None, cursor=cursors[-1])
+        page = st.session_state["_adm_page"] = {"rows": rows, "next": next_cursor}
+    rows = page["rows"]
+
+    if not rows:
+        st.info("データがありません。")
+        return
+
+    transcripts = st.session_state.setdefault("_adm_transcripts", {})
+    for row in rows:
+        nickname = row.get("nickname", "(不明)")
+        created = row.get("created_at", "日時不明")
+        summary = row.get("summary", "(要約なし)")
+
+        st.markdown(
+            f"""
+            <div style="
+                background:rgba(255,255,255,0.8);
+                border:1px solid #ddd;
+                border-radius:14px;
+                padding:14px 20px;
+                margin:10px 0;
+                box-shadow:0 4px 12px rgba(160,130,255,0.12);
+            ">
+                <h4>👤 {nickname}</h4>
+                <p style="font-size:13px;color:#666;">🕒 {created}</p>
+                <p style="white-space:pre-wrap;">📝 {summary}</p>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+
+        box, is_open = _lazy_expander(st, "💬 会話ログを見る", key=f"adm_tx_{row['id']}")
+        if is_open:
+            if row["id"] not in transcripts:
+                transcripts[row["id"]] = fetch_transcript(row["id"])
+            with box:
+                st.text_area("全文", transcripts[row["id"]] or "(なし)", height=200, key=f"adm_txt_{row['id']}")
+
+        if st.button(f"🗑️ この要約を削除", key=f"del_{row['id']}"):
+            if delete_summary_from_supabase(row['id']):
+                transcripts.pop(row["id"], None)
+                st.session_state.pop("_adm_page", None)
+                st.success(f"{nickname} のログを削除しました ✅")
+                st.rerun()
+
+    # ---- ページ送り ----
+    prev_col, info_col, next_col = st.columns([1, 2, 1])
+    if prev_col.button("◀ 前へ", key="adm_prev", disabled=len(cursors) <= 1):
+        cursors.pop()
+        st.session_state.pop("_adm_page", None)
+        st.rerun()
+    info_col.caption(f"{len(cursors)} ページ目")
+    if next_col.button("次へ ▶", key="adm_next", disabled=page["next"] is None):
+        cursors.append(page["next"])
+        st.session_state.pop("_adm_page", None)
+        st.rerun()
+
+    render_export(st, nick or None)
+
+
+def render_export(st, nickname=None):
+    """
+    絞り込み中の全件を書き出す。ページ送りで読みながら一時ファイルに書くので、表が大きくても
+    メモリに載るのは1ページ分だけ（ダウンロードボタンに渡すときにファイル1つ分）。
+    """
+    st.markdown("**⬇️ 書き出し（絞り込み中の全件）**")
+    fmt_col, gz_col, tx_col = st.columns(3)
+    fmt = fmt_col.radio("形式", list(summary_export.FORMATS), horizontal=True, key="adm_exp_fmt")
+    gzip = gz_col.checkbox("gzip で圧縮", key="adm_exp_gz")
+    with_transcript = tx_col.checkbox("会話ログも含める", key="adm_exp_tx")
+
+    prev = st.session_state.get("_adm_export")
+    if st.button("書き出しファイルを作成", key="adm_exp_make"):
+        if prev:
+            try:
+                os.remove(prev["path"])
+            except OSError:
+                pass
+        columns = list(summary_export.EXPORT_COLUMNS) + (["transcript"] if with_transcript else [])
+        try:
+            with st.spinner("書き出しています…"):
+                path = summary_export.export_to_tempfile(fmt, columns=columns, gzip=gzip, nickname=nickname,
+                                                         sb=_supabase_client())
+        except Exception as e:
+            st.session_state.pop("_adm_export", None)
+            st.error(f"書き出し失敗: {e}")
+            return
+        prev = st.session_state["_adm_export"] = {
+            "path": path,
+            "name": summary_export.file_name(fmt, gzip, nickname),
+            "mime": summary_export.mime_type(fmt, gzip),
+        }
+
+    if prev and os.path.exists(prev["path"]):
+        st.caption(f"{prev['name']}（{os.path.getsize(prev['path']):,} バイト）")
+        with open(prev["path"], "rb") as fp:
+            st.download_button("ダウンロード", fp, file_name=prev["name"], mime=prev["mime"], key="adm_exp_dl")
 
 
 # --- 予約フォーム（または外部予約リンク）をチャット内に出す ---
@@ -257,11 +541,11 @@ def maybe_show_booking_cta(st, *, threshold:int=10, embed_iframe:bool=False):
     - embed_iframe=True なら iframe でフォームを埋め込む（URLが埋め込み対応のとき）
     - False ならリンクボタンを表示（安全）
     """
-    if not st.session_state.get("messages"):
+    conv = st.session_state.get("conversation")
+    if not conv:
         return
 
-    user_cnt = sum(1 for m in st.session_state["messages"] if m["role"] == "user")
-    if user_cnt < threshold:
+    if conv.user_turns < threshold:
         return
     if st.session_state.get("booking_shown"):
         return
@@ -271,7 +555,7 @@ def maybe_show_booking_cta(st, *, threshold:int=10, embed_iframe:bool=False):
         "ここまでお話しありがとう！\n\n"
         "▶ ご予約は下のフォーム（またはボタン）からどうぞ。"
     )
-    st.session_state["messages"].append({"role": "assistant", "content": bot_text})
+    conv.append("assistant", bot_text)
     st.session_state["booking_shown"] = True
 
     # 画面に実UIを出す（チャット気泡として）
@@ -301,11 +585,8 @@ def render_booking_cta_persistent(st, *, threshold:int=3, embed_iframe:bool=Fals
       place="sidebar": サイドバー固定表示
     - embed_iframe=True なら iframe 埋め込み（予約サービスが許可している場合のみ）
     """
-    if not st.session_state.get("messages"):
-        return
-
-    user_cnt = sum(1 for m in st.session_state["messages"] if m["role"] == "user")
-    if user_cnt < threshold:
+    conv = st.session_state.get("conversation")
+    if not conv or conv.user_turns < threshold:
         return
 
     container = st.sidebar if place == "sidebar" else st
@@ -331,48 +612,3 @@ def render_booking_cta_persistent(st, *, threshold:int=3, embed_iframe:bool=Fals
         """, height=740, scrolling=True)
     else:
         container.link_button("予約フォームを開く", BOOKING_URL, use_container_width=True)
-
-
-def _supabase_client():
-    # .env と Secrets の両対応
-    try:
-        from dotenv import load_dotenv
-        load_dotenv()
-    except Exception:
-        pass
-    url = os.getenv("SUPABASE_URL") or st.secrets.get("SUPABASE", {}).get("URL")
-    key = os.getenv("SUPABASE_ANON_KEY") or st.secrets.get("SUPABASE", {}).get("ANON_KEY")
-    if not url or not key:
-        return None
-    from supabase import create_client
-    return create_client(url, key)
-
-def save_summary_to_supabase(*, nickname: str, turns: int, summary: str, transcript: str) -> bool:
-    sb = _supabase_client()
-    if not sb:
-        st.error("Supabase未設定（SUPABASE_URL / SUPABASE_ANON_KEY）")
-        return False
-    try:
-        sb.table("summaries").insert({
-            "nickname": nickname or "",
-            "turns": int(turns),
-            "summary": summary,
-            "transcript": transcript
-        }).execute()
-        return True
-    except Exception as e:
-        st.error(f"Supabase 保存失敗: {e}")
-        return False
-
-def summarize_and_store(messages, nickname: str, turns: int) -> str:
-    # 既存の _summarize(messages) を利用（要約, 全文）
-    summary, transcript = _summarize(messages)
-    ok = save_summary_to_supabase(
-        nickname=nickname, turns=turns,
-        summary=summary, transcript=transcript
-    )
-    if ok:
-        st.toast("Supabaseに保存しました", icon="✅")
-    else:
-        st.toast("Supabase保存に失敗", icon="⚠️")
-    return summary
@@ -0,0 +1,199 @@
+# summary_queue.py — 要約→Supabase保存をリクエストスレッドから外すライトビハインドキュー
+import os
+import atexit
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from metrics import observe
+import usage_meter
+
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))              # 要約（LLM）を並列に回す数
+SUMMARY_QUEUE_MAX = int(os.getenv("SUMMARY_QUEUE_MAX", "200"))         # これ以上溜まったら受け付けない
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "20"))        # 1回の insert にまとめる行数
+SUMMARY_FLUSH_INTERVAL = float(os.getenv("SUMMARY_FLUSH_INTERVAL", "2.0"))  # 行が溜まらなくても書く間隔（秒）
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", "4"))
+SUMMARY_RETRY_BASE = float(os.getenv("SUMMARY_RETRY_BASE", "0.5"))     # バックオフの初期値（秒）
+
+
+class SummaryQueue:
+    """
+    submit() は取り置き済みのターン（conv の since〜turns 発話目）を積んですぐ返る。
+    - ワーカースレッドが前回の要約＋その分だけを要約（LLM）し、結果の行をバッファへ（ダイジェストメールにも回す）
+    - フラッシュスレッドがバッファをまとめて insert（失敗時はジッタ付き指数バックオフで再試行）
+    - 保存できた行は commit で「ここまで要約済み」に、要約・保存できなかった取り置きは release で戻す
+    - プロセス終了時（atexit）は残りを処理してから書き切る
+    """
+
+    def __init__(self, *, summarize=None, insert=None, commit=None, release=None, notify=None,
+                 workers=SUMMARY_WORKERS,
+                 maxsize=SUMMARY_QUEUE_MAX, batch_size=SUMMARY_BATCH_SIZE,
+                 flush_interval=SUMMARY_FLUSH_INTERVAL, max_retries=SUMMARY_MAX_RETRIES,
+                 retry_base=SUMMARY_RETRY_BASE):
+        if None in (summarize, insert, commit, release, notify):
+            import summary_mailer
+            summarize = summarize or summary_mailer.incremental_summary_row
+            insert = insert or summary_mailer._insert_summaries
+            commit = commit or summary_mailer.mark_summarized
+            release = release or summary_mailer.release_turns
+            notify = notify or summary_mailer.queue_summary_mail
+        self._summarize = summarize
+        self._insert = insert
+        self._commit = commit    # 保存できた要約を「ここまで要約済み」として記録
+        self._release = release  # 保存できなかった取り置きを戻す
+        self._notify = notify  # 要約ができたら呼ぶ（ダイジェストメールへ回す）
+        self._jobs = queue.Queue(maxsize=maxsize)
+        self._rows = []                 # (row, submitted_at, job)
+        self._rows_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+
+        self._counts = {"submitted": 0, "rejected": 0, "stored": 0, "failed": 0, "batches": 0, "retries": 0}
+        self._latencies = deque(maxlen=500)  # submit → 保存完了までの秒数
+        self._in_flight = 0
+        self._stat_lock = threading.Lock()
+
+        self._workers = [threading.Thread(target=self._work, name=f"summary-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        self._flusher = threading.Thread(target=self._flush_loop, name="summary-flusher", daemon=True)
+        for t in self._workers:
+            t.start()
+        self._flusher.start()
+
+    # ===== 受付 =====
+    def submit(self, conv, nickname, since, turns) -> bool:
+        if self._stop.is_set():
+            return False
+        job = (conv, nickname or "", int(since), int(turns), time.monotonic())
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("submitted")
+        return True
+
+    # ===== ワーカー =====
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            conv, nickname, since, turns, submitted_at = job
+            with self._stat_lock:
+                self._in_flight += 1
+            try:
+                with usage_meter.attribute(nickname):
+                    row, summary = self._summarize(nickname, conv, since=since, upto=turns)
+                if row is not None:
+                    with self._rows_lock:
+                        self._rows.append((row, submitted_at, job))
+                        if len(self._rows) >= self.batch_size:
+                            self._wake.set()
+                    try:
+                        self._notify(nickname, row["turns"], summary)
+                    except Exception:
+                        pass
+            except Exception:
+                self._release(conv, since, turns)
+                self._count("failed")
+            finally:
+                with self._stat_lock:
+                    self._in_flight -= 1
+                self._jobs.task_done()
+
+    # ===== 書き込み =====
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """バッファの行を batch_size ずつ insert する"""
+        while True:
+            with self._rows_lock:
+                batch, self._rows = self._rows[:self.batch_size], self._rows[self.batch_size:]
+            if not batch:
+                return
+            self._insert_with_retry(batch)
+
+    def _insert_with_retry(self, batch):
+        rows = [row for row, _, _ in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._insert(rows)
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    for _, _, (conv, _, since, turns, _) in batch:
+                        self._release(conv, since, turns)
+                    self._count("failed", len(rows))
+                    return
+                self._count("retries")
+                delay = self.retry_base * (2 ** attempt)
+                time.sleep(delay / 2 + random.random() * delay / 2)
+        for row, _, (conv, *_) in batch:
+            self._commit(conv, row["turns"], row["summary"])
+        now = time.monotonic()
+        with self._stat_lock:
+            self._counts["stored"] += len(rows)
+            self._counts["batches"] += 1
+            self._latencies.extend(now - t for _, t, _ in batch)
+        for _, t, _ in batch:
+            observe("summary_queue.latency", now - t)
+
+    # ===== 終了処理 =====
+    def shutdown(self, timeout=30.0):
+        """受付を止め、積まれているジョブを処理し切ってから書き切る"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        for _ in self._workers:
+            self._jobs.put(None)
+        deadline = time.monotonic() + timeout
+        for t in self._workers:
+            t.join(max(0.0, deadline - time.monotonic()))
+        self._wake.set()
+        self._flusher.join(max(0.0, deadline - time.monotonic()))
+        self.flush()
+
+    # ===== 可視化 =====
+    def _count(self, key, n=1):
+        with self._stat_lock:
+            self._counts[key] += n
+
+    def stats(self):
+        """キュー深さ・処理中件数・保存までの遅延（p50/p95）など"""
+        with self._stat_lock:
+            lat = sorted(self._latencies)
+            s = dict(self._counts)
+            s["in_flight"] = self._in_flight
+        with self._rows_lock:
+            s["pending_rows"] = len(self._rows)
+        s["queue_depth"] = self._jobs.qsize()
+        s["latency_p50"] = lat[len(lat) // 2] if lat else None
+        s["latency_p95"] = lat[min(len(lat) - 1, int(len(lat) * 0.95))] if lat else None
+        return s
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_summary_queue():
+    """プロセス共有のキュー（初回呼び出しでワーカーを起動）"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = SummaryQueue()
+                atexit.register(_queue.shutdown)
+    return _queue
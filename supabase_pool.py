@@ -0,0 +1,101 @@
+# supabase_pool.py — プロセスで1つだけ Supabase クライアントを作り、HTTP接続ごと使い回す
+import os
+import threading
+
+import streamlit as st
+
+from lazy import lazy_import
+
+httpx = lazy_import("httpx")
+supabase = lazy_import("supabase")
+client_options = lazy_import("supabase.lib.client_options")
+
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))                  # 読み書き全体の上限（秒）
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "3"))  # 接続確立の上限（秒）
+
+_lock = threading.Lock()
+_state = {"client": None, "config": None, "override": None, "dotenv_loaded": False}
+
+
+def _load_dotenv_once():
+    if _state["dotenv_loaded"]:
+        return
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except Exception:
+        pass
+    _state["dotenv_loaded"] = True
+
+
+def _secret(name):
+    try:
+        return st.secrets.get("SUPABASE", {}).get(name)
+    except Exception:
+        return None  # secrets.toml が無い環境
+
+
+def supabase_config():
+    """(url, key, timeout, connect_timeout)。未設定なら url/key が None"""
+    if _state["override"]:
+        return _state["override"]
+    # .env と Secrets の両対応
+    _load_dotenv_once()
+    url = os.getenv("SUPABASE_URL") or _secret("URL")
+    key = os.getenv("SUPABASE_ANON_KEY") or _secret("ANON_KEY")
+    return url, key, SUPABASE_TIMEOUT, SUPABASE_CONNECT_TIMEOUT
+
+
+def _create(url, key, timeout, connect_timeout):
+    # supabase / httpx の import は最初にクライアントを作るとき（登録画面の表示には要らない）
+    opts = client_options.ClientOptions(
+        postgrest_client_timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        storage_client_timeout=int(timeout),
+    )
+    sb = supabase.create_client(url, key, options=opts)
+    sb.postgrest  # 遅延生成されるので、ロック内で作っておく（スレッド間で共有するため）
+    return sb
+
+
+def get_supabase_client():
+    """
+    共有クライアントを返す。Supabase 未設定なら None（呼び出し側はこれまで通り None を見て分岐）。
+    中の httpx クライアントはスレッドセーフなので、Streamlit の各セッションスレッドから共有してよい。
+    """
+    config = supabase_config()
+    if not config[0] or not config[1]:
+        return None
+    sb = _state["client"]
+    if sb is not None and _state["config"] == config:
+        return sb
+    with _lock:
+        if _state["client"] is None or _state["config"] != config:
+            _close(_state["client"])
+            _state["client"] = _create(*config)
+            _state["config"] = config
+        return _state["client"]
+
+
+def configure(url=None, key=None, *, timeout=SUPABASE_TIMEOUT, connect_timeout=SUPABASE_CONNECT_TIMEOUT):
+    """
+    接続先を明示的に差し替える（テストでローカルのHTTPスタブに向ける用）。
+    url=None で環境変数/Secrets に戻す。key は JWT 形式（a.b.c）でないと supabase が弾くので注意。
+    """
+    with _lock:
+        _state["override"] = (url, key, timeout, connect_timeout) if url else None
+        _close(_state["client"])
+        _state["client"] = None
+        _state["config"] = None
+
+
+def reset_supabase_client():
+    configure(None)
+
+
+def _close(sb):
+    if sb is None:
+        return
+    try:
+        sb.postgrest.aclose()
+    except Exception:
+        pass
@@ -0,0 +1,23 @@
+# tests/conftest.py — 外部サービス無し・一時ディレクトリだけで動かす（python -m pytest -q）
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# モジュール定数は import 時に読まれるので、どのテストより先に設定する
+_tmp = tempfile.mkdtemp(prefix="morie-tests-")
+os.environ.update({
+    "CONV_LOG_BACKEND": "sqlite",
+    "CONV_LOG_PATH": os.path.join(_tmp, "conversation_log.sqlite3"),
+    "SHARED_STATE_BACKEND": "memory",
+    "SESSION_RESUME": "1",  # つなぎ直し（?sid=）のテストもするので有効に
+    "USAGE_BACKEND": "off",
+    "IDLE_TIMEOUT": "0",  # 見回りスレッドは立てない（テストから scan を呼ぶ）
+    "OPENAI_API_KEY": "",
+    "SUPABASE_URL": "",
+    "SUPABASE_ANON_KEY": "",
+    "GMAIL_FROM": "",
+    "RECIPIENT_EMAIL": "",
+})
@@ -0,0 +1,47 @@
+import os
+
+from streamlit.testing.v1 import AppTest
+
+import summary_mailer
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def _login(token):
+    at = AppTest.from_file(APP, default_timeout=30)
+    at.run()
+    at.text_input(key="adm_tok").input(token)
+    at.button(key="adm_btn").click()
+    at.run()
+    assert not at.exception, at.exception
+    return at
+
+
+def _panel_shown(at):
+    return any("管理者専用" in h.value for h in at.subheader)
+
+
+def test_wrong_token_does_not_open_panel(monkeypatch):
+    monkeypatch.setattr(summary_mailer, "ADMIN_TOKEN", "s3cret")
+    at = _login("nope")
+    assert not at.session_state["is_admin"]
+    assert not _panel_shown(at)
+
+
+def test_no_token_configured_never_logs_in(monkeypatch):
+    monkeypatch.setattr(summary_mailer, "ADMIN_TOKEN", None)
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    at = _login("")
+    assert not at.session_state["is_admin"]
+    assert not _panel_shown(at)
+
+
+def test_admin_login_opens_panel(monkeypatch):
+    monkeypatch.setattr(summary_mailer, "ADMIN_TOKEN", "s3cret")
+    at = _login("s3cret")
+    assert at.session_state["is_admin"]
+    assert _panel_shown(at)
+    # 次の rerun でもパネルはそのまま（ログイン欄は消える）
+    at.run()
+    assert _panel_shown(at)
+    assert not [t for t in at.text_input if t.key == "adm_tok"]
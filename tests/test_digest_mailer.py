@@ -0,0 +1,69 @@
+import smtplib
+
+import digest_mailer
+from digest_mailer import DigestMailer
+
+SETTINGS = {"host": "localhost", "port": 2525, "ssl": False, "starttls": False,
+            "user": None, "password": None, "sender": "bot@example.com", "recipient": "admin@example.com"}
+
+
+class FakeSMTP:
+    """sendmail の結果を順に返す（例外なら投げる）"""
+    results = []
+    sent = []
+
+    def __init__(self, host, port, timeout=None):
+        pass
+
+    def sendmail(self, sender, recipients, body):
+        result = FakeSMTP.results.pop(0) if FakeSMTP.results else None
+        if isinstance(result, Exception):
+            raise result
+        FakeSMTP.sent.append(body)
+
+    def quit(self):
+        pass
+
+
+def _mailer(monkeypatch, results, **kwargs):
+    FakeSMTP.results = list(results)
+    FakeSMTP.sent = []
+    monkeypatch.setattr(digest_mailer.smtplib, "SMTP", FakeSMTP)
+    kwargs.setdefault("backoff", 0.01)
+    return DigestMailer(dict(SETTINGS), batch_size=10, flush_interval=60, **kwargs)
+
+
+def test_rejected_first_attempt_is_retried(monkeypatch):
+    mailer = _mailer(monkeypatch, [smtplib.SMTPDataError(451, b"try again later")])
+    mailer.add("みすず", 3, "要約その1")
+    mailer.add("ゆき", 5, "要約その2")
+    mailer.shutdown(timeout=5)
+
+    s = mailer.stats()
+    assert len(FakeSMTP.sent) == 1
+    assert s["sent_items"] == 2
+    assert s["retries"] == 1
+    assert s["failed_mails"] == 0
+
+
+def test_disconnect_reconnects_without_waiting(monkeypatch):
+    mailer = _mailer(monkeypatch, [smtplib.SMTPServerDisconnected("gone")], backoff=60)
+    mailer.add("みすず", 3, "要約")
+    mailer.shutdown(timeout=5)
+
+    s = mailer.stats()
+    assert s["sent_mails"] == 1
+    assert s["retries"] == 0
+
+
+def test_failed_batch_is_requeued(monkeypatch):
+    reject = smtplib.SMTPDataError(451, b"busy")
+    mailer = _mailer(monkeypatch, [reject, reject], retries=2)
+    mailer.add("みすず", 3, "要約")
+    mailer.shutdown(timeout=5)
+
+    s = mailer.stats()
+    assert s["failed_mails"] == 1
+    assert s["requeued_items"] == 1
+    assert s["sent_items"] == 1  # 戻した分が次の回で送られる
+    assert s["dropped_items"] == 0
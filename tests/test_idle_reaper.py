@@ -0,0 +1,52 @@
+import gc
+import time
+import weakref
+
+import conversation_state
+from conversation_state import ConversationState, register_conversation, pin_conversation
+from idle_reaper import IdleReaper
+
+
+def _reaper(stored):
+    def summarize(nickname, conv, since=None, upto=None):
+        row = {"nickname": nickname, "turns": conv.user_turns, "summary": f"{nickname}:{since}", "transcript": ""}
+        return row, row["summary"]
+
+    return IdleReaper(summarize=summarize, insert=stored.extend, commit=lambda *a: None,
+                      notify=lambda *a: None, enabled=lambda: True, timeout=600, workers=1)
+
+
+def _closed_tab(nickname, sid):
+    """登録して発話し、タブが閉じた（Streamlit がセッションを捨てた）会話。弱参照だけ返す"""
+    conv = ConversationState()
+    register_conversation(nickname, conv, sid)
+    conv.append("user", "相談です")
+    conv.append("assistant", "はい")
+    pin_conversation(conv)
+    ref = weakref.ref(conv)
+    del conv
+    gc.collect()
+    return ref
+
+
+def test_closed_and_collected_session_is_still_summarized():
+    stored = []
+    reaper = _reaper(stored)
+    ref = _closed_tab("はな", "e" * 32)
+    assert ref() is not None  # 要約するまでは台帳が持っている
+
+    assert reaper.run_once(now=time.time() + 601) == 1
+    assert [r["nickname"] for r in stored] == ["はな"]
+
+    # 要約し終えたら手放す
+    gc.collect()
+    assert ref() is None
+    reaper.shutdown()
+
+
+def test_unsummarized_session_is_released_after_pin_ttl(monkeypatch):
+    monkeypatch.setattr(conversation_state, "CONV_PIN_TTL", 60)
+    ref = _closed_tab("そら", "f" * 32)
+    conversation_state.live_conversations(now=time.time() + 61)
+    gc.collect()
+    assert ref() is None
@@ -0,0 +1,117 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import admission
+import llm_gateway
+from admission import AdmissionController
+
+
+class FlakyCompletions:
+    """最初の fail 回は失敗し、その後は返信を返す"""
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.calls = 0
+
+    def create(self, timeout=None, **kwargs):
+        self.calls += 1
+        if self.calls <= self.fail:
+            raise TimeoutError("temporary")
+        message = SimpleNamespace(content="こんにちは")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def _install(monkeypatch, fail, backoff):
+    completions = FlakyCompletions(fail)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    gate = AdmissionController(concurrency=1)
+    monkeypatch.setattr(llm_gateway, "get_client", lambda: client)
+    monkeypatch.setattr(llm_gateway, "is_transient", lambda e: isinstance(e, TimeoutError))
+    monkeypatch.setattr(llm_gateway, "_backoff", lambda attempt: backoff)
+    monkeypatch.setattr(llm_gateway, "admission", gate)
+    llm_gateway.breaker.record_success()
+    return completions, gate
+
+
+def test_backoff_releases_admission_slot(monkeypatch):
+    completions, gate = _install(monkeypatch, fail=1, backoff=0.5)
+    result = {}
+    t = threading.Thread(target=lambda: result.setdefault("text", llm_gateway.chat(
+        [{"role": "user", "content": "hi"}], model="m", kind="summary")))
+    t.start()
+    while completions.calls == 0:
+        time.sleep(0.01)
+
+    # 1回目が失敗して待っている間に、別の呼び出しが枠を取れる
+    t0 = time.monotonic()
+    gate.acquire("chat", max_wait=0.4)
+    assert time.monotonic() - t0 < 0.4
+    gate.release()
+
+    t.join(5)
+    assert result["text"] == "こんにちは"
+    assert completions.calls == 2
+    assert gate.stats()["active"] == 0
+
+
+def test_slot_released_after_giving_up(monkeypatch):
+    completions, gate = _install(monkeypatch, fail=100, backoff=0.0)
+    try:
+        llm_gateway.chat([{"role": "user", "content": "hi"}], model="m")
+    except llm_gateway.LLMUnavailable:
+        pass
+    else:
+        raise AssertionError("LLMUnavailable expected")
+    assert completions.calls == llm_gateway.LLM_MAX_RETRIES + 1
+    assert gate.stats()["active"] == 0
+
+
+class StreamCompletions:
+    """ストリーム（chunks の本文を1つずつ）を返す"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def create(self, timeout=None, **kwargs):
+        delta = lambda text: SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))],
+                                             usage=None)
+        return iter([delta(t) for t in self.chunks])
+
+
+def _half_open(monkeypatch, chunks):
+    client = SimpleNamespace(chat=SimpleNamespace(completions=StreamCompletions(chunks)))
+    monkeypatch.setattr(llm_gateway, "get_client", lambda: client)
+    monkeypatch.setattr(llm_gateway, "admission", AdmissionController(concurrency=1))
+    breaker = llm_gateway.CircuitBreaker(failures=1, reset=0)
+    breaker.record_failure()
+    monkeypatch.setattr(llm_gateway, "breaker", breaker)
+    return breaker
+
+
+def test_abandoned_stream_closes_breaker(monkeypatch):
+    breaker = _half_open(monkeypatch, ["こん", "にちは"])
+    gen = llm_gateway.stream_chat([{"role": "user", "content": "hi"}], model="m")
+    assert next(gen) == "こん"
+    gen.close()  # Streamlit の rerun / stop で読むのをやめた
+    assert breaker.state == "closed"
+    assert llm_gateway.admission.stats()["active"] == 0
+
+
+def test_empty_stream_closes_breaker(monkeypatch):
+    breaker = _half_open(monkeypatch, [])
+    assert list(llm_gateway.stream_chat([{"role": "user", "content": "hi"}], model="m")) == []
+    assert breaker.state == "closed"
+
+
+def test_trial_is_released_when_admission_times_out(monkeypatch):
+    breaker = _half_open(monkeypatch, ["はい"])
+    monkeypatch.setattr(admission, "LLM_MAX_WAIT_CHAT", 0.1)
+    llm_gateway.admission.acquire("chat")  # 枠を埋めておく
+    try:
+        llm_gateway.chat([{"role": "user", "content": "hi"}], model="m")
+    except llm_gateway.AdmissionTimeout:
+        pass
+    finally:
+        llm_gateway.admission.release()
+    assert breaker.allow()  # 次の1件を試せる
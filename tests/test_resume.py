@@ -0,0 +1,74 @@
+import os
+
+from streamlit.testing.v1 import AppTest
+
+from conversation_log import get_conversation_log
+from shared_state import get_shared_state
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def _register(nickname, sid=None):
+    at = AppTest.from_file(APP, default_timeout=30)
+    if sid:
+        at.query_params["sid"] = sid
+    at.run()
+    at.text_input[0].input(nickname)
+    at.button[0].click()
+    at.run()
+    assert not at.exception, at.exception
+    return at
+
+
+def _said(at):
+    return [m["content"] for m in at.session_state["conversation"] if m["role"] == "user"]
+
+
+def test_same_nickname_in_another_session_starts_empty():
+    first = _register("みすず")
+    first.chat_input[0].set_value("ひみつの相談").run()
+    assert not first.exception, first.exception
+    sid = first.session_state["_session_id"]
+    get_conversation_log().flush()
+
+    other = _register("みすず")
+    assert other.session_state["_session_id"] != sid
+    assert _said(other) == []
+
+
+
+def test_shared_link_alone_does_not_restore():
+    first = _register("みすず")
+    first.chat_input[0].set_value("ひみつの相談です").run()
+    assert not first.exception, first.exception
+    sid = first.session_state["_session_id"]
+
+    # リンク（?sid=）を開いただけでは登録フォームのまま、何も戻らない
+    at = AppTest.from_file(APP, default_timeout=30)
+    at.query_params["sid"] = sid
+    at.run()
+    assert at.text_input, "registration form expected"
+    assert "nickname" not in at.session_state
+    assert "conversation" not in at.session_state
+
+    # 別の名前で入っても空から。元のセッションは上書きしない（別の ID になる）
+    stranger = _register("たろう", sid=sid)
+    assert _said(stranger) == []
+    assert stranger.session_state["_session_id"] != sid
+
+    # 同じ名前で入り直したときだけ続きから
+    back = _register("みすず", sid=sid)
+    assert _said(back) == ["ひみつの相談です"]
+
+
+def test_resume_from_log_when_shared_state_expired():
+    first = _register("みすず")
+    first.chat_input[0].set_value("ひみつの相談").run()
+    assert not first.exception, first.exception
+    sid = first.session_state["_session_id"]
+    get_conversation_log().flush()
+
+    # 同じタブ（?sid=）に同じ名前で戻ってきたときだけ、共有状態が切れていてもログから続きを読み戻す
+    get_shared_state().delete("session", sid)
+    back = _register("みすず", sid=sid)
+    assert _said(back) == ["ひみつの相談"]
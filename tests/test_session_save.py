@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+
+import conversation_state
+from conversation_state import ConversationState, save_session, restore_session
+from shared_state import MemoryBackend, SharedState
+
+
+class CountingBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.written = 0
+
+    def set(self, key, value, ttl=None):
+        self.written += len(value.encode("utf-8"))
+        super().set(key, value, ttl)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = CountingBackend()
+    shared = SharedState(backend)
+    monkeypatch.setattr(conversation_state, "get_shared_state", lambda: shared)
+    return backend
+
+
+def _tab(sid):
+    return SimpleNamespace(session_state={"_session_id": sid}, query_params={})
+
+
+def test_save_cost_does_not_grow_with_history(backend):
+    st = _tab("1" * 32)
+    conv = ConversationState(max_in_memory=100)
+    st.session_state.update(nickname="みすず", conversation=conv)
+
+    per_turn = []
+    for turn in range(300):
+        conv.append("user", f"相談その{turn}：流れを整えたい")
+        conv.append("assistant", "やさしい返信です。" * 10)
+        before = backend.written
+        save_session(st)
+        per_turn.append(backend.written - before)
+
+    first, last = max(per_turn[10:30]), max(per_turn[-20:])
+    assert last <= first * 1.2, (first, last)
+
+
+def test_restore_from_blocks(backend):
+    st = _tab("2" * 32)
+    conv = ConversationState(max_in_memory=100)
+    st.session_state.update(nickname="ゆき", conversation=conv)
+    for turn in range(130):
+        conv.append("user", f"u{turn}")
+        conv.append("assistant", f"a{turn}")
+        if turn % 7 == 0:
+            save_session(st)
+    conv.reaped_turns = 120
+    save_session(st)
+
+    assert not restore_session(_tab("2" * 32), "みすず")  # sid を知っているだけでは戻らない
+
+    other = _tab("2" * 32)
+    assert restore_session(other, "ゆき")
+    back = other.session_state["conversation"]
+    assert back[:] == conv[:]
+    assert back.user_turns == 130
+    assert back.reaped_turns == 120
+    assert other.session_state["nickname"] == "ゆき"
@@ -0,0 +1,103 @@
+import pytest
+
+import summary_mailer
+from conversation_state import ConversationState
+from summary_mailer import incremental_summary_row, mark_summarized
+
+
+@pytest.fixture(autouse=True)
+def fake_summarize(monkeypatch):
+    """要約 = 前回の要約 + 今回渡されたユーザー発話（何を渡されたかがそのまま見える）"""
+    def summarize(messages, prev_summary=""):
+        said = [m["content"] for m in messages if m["role"] == "user"]
+        return " ".join([prev_summary, *said]).strip(), "\n".join(said)
+
+    monkeypatch.setattr(summary_mailer, "_summarize", summarize)
+    monkeypatch.setattr(summary_mailer, "fetch_latest_summary", lambda nickname: (0, ""))
+
+
+def _session(sid, nickname, turns, tag):
+    conv = ConversationState()
+    conv.session_id, conv.nickname = sid, nickname
+    for i in range(1, turns + 1):
+        conv.append("user", f"{tag}{i}")
+        conv.append("assistant", "はい")
+    return conv
+
+
+def test_second_session_is_not_hidden_by_a_longer_first_one():
+    first = _session("a" * 32, "みすず", 30, "A")
+    row, summary = incremental_summary_row("みすず", first)
+    mark_summarized(first, row["turns"], summary)
+
+    second = _session("b" * 32, "みすず", 22, "B")
+    row, summary = incremental_summary_row("みすず", second)
+    assert row is not None
+    assert row["turns"] == 22
+    assert summary.startswith("A1 ")          # 前のセッションの要約を土台に
+    assert summary.endswith(" B1 " + " ".join(f"B{i}" for i in range(2, 23)))  # 2つ目は最初から全部
+
+
+def test_shorter_first_session_does_not_resummarize_the_second():
+    first = _session("c" * 32, "ゆき", 5, "C")
+    row, summary = incremental_summary_row("ゆき", first)
+    mark_summarized(first, row["turns"], summary)
+
+    second = _session("d" * 32, "ゆき", 22, "D")
+    row, summary = incremental_summary_row("ゆき", second)
+    mark_summarized(second, row["turns"], summary)
+
+    # 最初のセッションが続いたら、その新しい分（C6 以降）だけ
+    for i in range(6, 9):
+        first.append("user", f"C{i}")
+    row, summary = incremental_summary_row("ゆき", first)
+    assert row["turns"] == 8
+    assert row["transcript"] == "C6\nC7\nC8"
+
+    # 2つ目は新しい発話が無いので何もしない
+    row, _ = incremental_summary_row("ゆき", second)
+    assert row is None
+
+
+def test_periodic_and_idle_summaries_do_not_overlap(monkeypatch):
+    import time
+    import summary_queue
+    from conversation_state import register_conversation
+    from idle_reaper import IdleReaper
+    from summary_mailer import summarize_and_store_async
+
+    stored = []
+    queue = summary_queue.SummaryQueue(insert=stored.extend, notify=lambda *a: None, workers=1,
+                                       flush_interval=60)
+    monkeypatch.setattr(summary_queue, "_queue", queue)
+    monkeypatch.setattr(summary_mailer, "_supabase_client", lambda: object())
+    reaper = IdleReaper(insert=stored.extend, notify=lambda *a: None, enabled=lambda: True,
+                        timeout=600, workers=1)
+
+    conv = _session("e" * 32, "るり", 5, "R")
+    register_conversation("るり", conv, conv.session_id)
+
+    def periodic(turns):
+        assert summarize_and_store_async(conv, "るり", turns)
+        queue._jobs.join()
+        queue.flush()
+
+    def more(frm, to):
+        for i in range(frm, to + 1):
+            conv.append("user", f"R{i}")
+            conv.append("assistant", "はい")
+
+    periodic(5)                                      # 5ターン目の定期要約
+    more(6, 7)
+    reaper.run_once(now=time.time() + 601)           # 放置 → 6, 7 だけ
+    reaper.run_once(now=time.time() + 601)           # もう拾うものは無い
+    more(8, 10)
+    periodic(10)                                     # 見回りの後の定期要約は 8〜10 だけ
+    assert not summarize_and_store_async(conv, "るり", 10)  # 同じターンは二度積まない
+
+    mine = [r for r in stored if r["nickname"] == "るり"]  # 台帳にはほかのテストの会話も残っている
+    assert [(r["turns"], r["transcript"]) for r in mine] == [
+        (5, "R1\nR2\nR3\nR4\nR5"), (7, "R6\nR7"), (10, "R8\nR9\nR10")]
+    assert mine[-1]["summary"] == " ".join(f"R{i}" for i in range(1, 11))
+    queue.shutdown()
+    reaper.shutdown()
@@ -0,0 +1,247 @@
+# usage_meter.py — LLM 呼び出しごとの usage（トークン・キャッシュ・所要時間）を数え、まとめてローカルに保存する
+import os
+import json
+import atexit
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+USAGE_BACKEND = os.getenv("USAGE_BACKEND", "sqlite")  # sqlite / off（off でもメモリ上の集計はする）
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "data", "usage.sqlite3"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))   # 溜まった記録を書く間隔（秒）
+USAGE_BATCH = int(os.getenv("USAGE_BATCH", "200"))                     # これだけ溜まったら間隔を待たずに書く
+USAGE_WINDOW = int(os.getenv("USAGE_WINDOW", "300"))                   # 時間帯ごとの集計の幅（秒）
+USAGE_WINDOWS_KEPT = int(os.getenv("USAGE_WINDOWS_KEPT", "288"))       # 手元に残す時間帯の数（既定で1日分）
+USAGE_MAX_USERS = int(os.getenv("USAGE_MAX_USERS", "10000"))           # ニックネーム別の集計を持つ上限
+
+# 100万トークンあたりの USD（入力, キャッシュ済み入力, 出力）。USAGE_PRICES='{"model": [in, cached, out]}' で上書き
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+try:
+    PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv("USAGE_PRICES", "{}")).items()})
+except Exception:
+    pass
+
+FIELDS = ("calls", "prompt", "cached", "completion", "latency", "cost")
+
+_who = ContextVar("usage_nickname", default="")
+
+
+def set_nickname(nickname):
+    """このスレッド（Streamlit のスクリプト実行）でのこれ以降の呼び出しを nickname の分として数える"""
+    _who.set(nickname or "")
+
+
+@contextmanager
+def attribute(nickname):
+    """この with の中の LLM 呼び出しを nickname の分として数える（スレッド・ジェネレータをまたいでも安全）"""
+    token = _who.set(nickname or "")
+    try:
+        yield
+    finally:
+        _who.reset(token)
+
+
+def _usage_numbers(usage):
+    """SDK の usage（オブジェクト / dict）から (prompt, cached, completion)"""
+    if usage is None:
+        return None
+    get = usage.get if isinstance(usage, dict) else (lambda k, d=None: getattr(usage, k, d))
+    details = get("prompt_tokens_details")
+    if details is None:
+        cached = 0
+    elif isinstance(details, dict):
+        cached = details.get("cached_tokens") or 0
+    else:
+        cached = getattr(details, "cached_tokens", 0) or 0
+    return int(get("prompt_tokens") or 0), int(cached), int(get("completion_tokens") or 0)
+
+
+def cost_usd(model, prompt, cached, completion):
+    price = PRICES.get(model)
+    if price is None:
+        # 日付付きのモデル名（gpt-4o-mini-2024-07-18 など）は前方一致で
+        price = next((p for m, p in sorted(PRICES.items(), key=lambda kv: -len(kv[0])) if model.startswith(m)), None)
+    if price is None:
+        return 0.0
+    p_in, p_cached, p_out = price
+    return ((prompt - cached) * p_in + cached * p_cached + completion * p_out) / 1_000_000
+
+
+# ===== 保存先 =====
+class SQLiteStore:
+    def __init__(self, path=USAGE_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)  # 書くのはフラッシュ側だけ
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS llm_usage (
+                ts REAL NOT NULL, kind TEXT NOT NULL, model TEXT NOT NULL, nickname TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL, cached_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL, latency REAL NOT NULL, cost_usd REAL NOT NULL,
+                estimated INTEGER NOT NULL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS llm_usage_ts ON llm_usage (ts)")
+
+    def write(self, rows):
+        with self.db:
+            self.db.executemany("INSERT INTO llm_usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+# ===== 本体 =====
+class UsageMeter:
+    """
+    record() はカウンタを足して保存待ちに積むだけ（ロック内は数個の足し算）。
+    - 合計: (kind, model) ごと
+    - ニックネーム別: 最近使った USAGE_MAX_USERS 人まで
+    - 時間帯別: USAGE_WINDOW 秒ごとに (kind, model) の合計を USAGE_WINDOWS_KEPT 個
+    カウンタは [calls, prompt, cached, completion, latency, cost] のリスト。
+    """
+
+    def __init__(self, store=None, *, flush_interval=USAGE_FLUSH_INTERVAL, batch=USAGE_BATCH,
+                 window=USAGE_WINDOW, windows_kept=USAGE_WINDOWS_KEPT, max_users=USAGE_MAX_USERS):
+        self.store = store
+        self.batch = batch
+        self.window = window
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._totals = {}                  # (kind, model) -> counters
+        self._users = OrderedDict()        # nickname -> counters
+        self._windows = deque(maxlen=windows_kept)  # [(window_start, {(kind, model): counters}), ...]
+        self._pending = []
+        self._counts = {"recorded": 0, "estimated": 0, "flushed": 0, "flush_errors": 0}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if store is not None:
+            self.flush_interval = flush_interval
+            self._thread = threading.Thread(target=self._loop, name="usage-meter", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _add(counters, values):
+        for i, v in enumerate(values):
+            counters[i] += v
+
+    def record(self, *, kind, model, usage, latency, nickname=None, estimate=None):
+        """
+        1回分の呼び出しを記録。usage が無い（プロバイダが返さない）ときは estimate()（→ (prompt, completion)）の
+        概算を使い、estimated として数える。
+        """
+        nums = _usage_numbers(usage)
+        estimated = nums is None
+        if estimated:
+            if estimate is None:
+                return
+            prompt, completion = estimate() if callable(estimate) else estimate
+            nums = (int(prompt), 0, int(completion))
+        prompt, cached, completion = nums
+        nickname = _who.get() if nickname is None else nickname
+        cost = cost_usd(model, prompt, cached, completion)
+        values = (1, prompt, cached, completion, latency, cost)
+        now = time.time()
+        start = now - now % self.window
+        key = (kind, model)
+        with self._lock:
+            self._add(self._totals.setdefault(key, [0] * len(FIELDS)), values)
+            if nickname:
+                user = self._users.pop(nickname, None) or [0] * len(FIELDS)
+                self._add(user, values)
+                self._users[nickname] = user
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            if not self._windows or self._windows[-1][0] != start:
+                self._windows.append((start, {}))
+            self._add(self._windows[-1][1].setdefault(key, [0] * len(FIELDS)), values)
+            self._counts["recorded"] += 1
+            self._counts["estimated"] += estimated
+            if self.store is not None:
+                self._pending.append((now, kind, model, nickname or "", prompt, cached, completion,
+                                      round(latency, 4), cost, int(estimated)))
+                if len(self._pending) >= self.batch:
+                    self._wake.set()
+
+    # ===== 集計の読み出し =====
+    @staticmethod
+    def _row(counters):
+        return dict(zip(FIELDS, (round(v, 6) if isinstance(v, float) else v for v in counters)))
+
+    def snapshot(self, top_users=20):
+        """{totals, users(上位), windows(直近), counts}。tokens/cost の多い順"""
+        with self._lock:
+            totals = {f"{k}:{m}": self._row(c) for (k, m), c in self._totals.items()}
+            users = sorted(self._users.items(), key=lambda kv: -(kv[1][1] + kv[1][3]))[:top_users]
+            users = {n: self._row(c) for n, c in users}
+            windows = [{"start": s, "by_call": {f"{k}:{m}": self._row(c) for (k, m), c in w.items()}}
+                       for s, w in list(self._windows)[-12:]]
+            counts = dict(self._counts)
+        counts["pending"] = len(self._pending)
+        return {"totals": totals, "users": users, "windows": windows, "counts": counts}
+
+    def user(self, nickname):
+        with self._lock:
+            c = self._users.get(nickname)
+            return self._row(c) if c else self._row([0] * len(FIELDS))
+
+    # ===== 保存 =====
+    def flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows or self.store is None:
+            return
+        try:
+            self.store.write(rows)
+            self._counts["flushed"] += len(rows)
+        except Exception:
+            self._counts["flush_errors"] += 1
+            with self._lock:
+                self._pending = rows[-self.batch * 10:] + self._pending  # 次の回にやり直す（溜めすぎない）
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def shutdown(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+
+def _make_meter():
+    store = None
+    if USAGE_BACKEND == "sqlite":
+        try:
+            store = SQLiteStore()
+        except Exception:
+            store = None  # 書けない環境でも集計だけはする
+    meter = UsageMeter(store)
+    atexit.register(meter.shutdown)
+    return meter
+
+
+meter = None
+_meter_lock = threading.Lock()
+
+
+def get_usage_meter():
+    """プロセス共有のメーター（初回呼び出しで保存スレッドを起動）"""
+    global meter
+    if meter is None:
+        with _meter_lock:
+            if meter is None:
+                meter = _make_meter()
+    return meter
+
+
+def record(**kwargs):
+    get_usage_meter().record(**kwargs)